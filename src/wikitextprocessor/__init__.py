@@ -1,4 +1,11 @@
 from .core import Wtp, MAGIC_FIRST, MAGIC_LAST, Page
+from .page_pack import PackPageStore, write_page_pack
+from .page_store import (
+    MemoryPageStore,
+    PageStore,
+    SQLitePageStore,
+    UnsupportedPageStoreError,
+)
 from .parser import NodeKind, WikiNode
 
 __all__ = (
@@ -7,5 +14,11 @@ __all__ = (
     "WikiNode",
     "MAGIC_FIRST",  # Some applications with to use the same ranges
     "MAGIC_LAST",
-    "Page"
+    "Page",
+    "PageStore",
+    "SQLitePageStore",
+    "MemoryPageStore",
+    "PackPageStore",
+    "UnsupportedPageStoreError",
+    "write_page_pack",
 )
@@ -0,0 +1,322 @@
+# Templates and template arguments in template bodies, for
+# Wtp.analyze_templates()
+#
+# Copyright (c) 2020-2022 Tatu Ylonen.  See file LICENSE and https://ylonen.org
+
+import re
+from bisect import bisect_right
+from typing import Iterator, List, Optional, Tuple
+
+# Template arguments and templates that don't contain other arguments or
+# templates
+TEMPLATE_ARG_RE = re.compile(
+    # re.X, ignore white space and comments
+    r"""(?sx)\{\{\{                # {{{
+                   (    [^{}]      # no {} except...
+                   |    \}[^}]     # no }} unless...
+                   |    \}\}[^}]   # they're definitely not }}}
+                   )*?
+             \}\}\}                # }}}
+    """
+)
+TEMPLATE_RE = re.compile(
+    r"""(?sx)\{\{
+                (    [^{}]
+                |    \}[^}]
+                )*?
+            \}\}"""
+)
+BRACE_RE = re.compile(r"[{}]")
+TEMPLATE_START_RE = re.compile(r"\{\{+")
+TEMPLATE_NAME_END_RE = re.compile(r"[{|]|\}\}")
+NOWIKI_RE = re.compile(r"(?si)<nowiki\s*/>")
+
+# Number of passes of the regular expressions above that remove the innermost
+# arguments or templates before scan_braces() does the rest of the passes.
+# The regular expressions are faster for shallowly nested templates (most of
+# them), but each pass goes through the whole text to remove one level of
+# nesting.
+BRACE_REGEX_PASSES = 8
+
+
+def template_names(text: str) -> Iterator[str]:
+    r"""Yields the names of the templates called in ``text``, up to the first
+    "|" or "}}".  Same as the matches of this expression, but without trying
+    it at every character::
+
+        (^|[^{])(\{\{)?\{\{([^{]*?)(\||\}\})
+
+    i.e. a template starts with two or four braces (not an argument) after
+    a character that isn't a part of the previous match, and names that
+    contain "{" are skipped."""
+    match_end = 0
+    for m in TEMPLATE_START_RE.finditer(text):
+        start, end = m.span()
+        if end - start not in (2, 4) or 0 < start <= match_end:
+            continue
+        name_end = TEMPLATE_NAME_END_RE.search(text, end)
+        if name_end is None or name_end.group() == "{":
+            continue
+        name = text[end : name_end.start()]
+        if "<" in name:
+            name = NOWIKI_RE.sub("", name)
+        if len(name) > 0:
+            yield name
+        match_end = name_end.end()
+
+
+def remove_templates(text: str) -> str:
+    """Removes template arguments and templates (including the arguments
+    and templates they contain) from ``text``, innermost first.  Text with
+    unbalanced braces is left as it is, e.g. "{|" starts a table, and a
+    template that contains one isn't removed."""
+    for _ in range(BRACE_REGEX_PASSES):
+        newt = TEMPLATE_ARG_RE.sub("", text)
+        if newt == text:
+            newt = TEMPLATE_RE.sub("", text)
+            if newt == text:
+                return text
+        text = newt
+    return scan_braces(text)
+
+
+class RemainingText:
+    """The characters of a text that haven't been removed by
+    ``scan_braces()``.  Removed characters are skipped with union-find
+    pointers in both directions, so that the text isn't copied after each
+    pass."""
+
+    __slots__ = ("text", "length", "next_index", "prev_index", "removed")
+
+    def __init__(self, text: str) -> None:
+        self.text = text
+        self.length = len(text)
+        # index -> index of a later character, the index itself if the
+        # character hasn't been removed (``length`` is never removed)
+        self.next_index = list(range(self.length + 1))
+        # index + 1 -> index + 1 of an earlier character, 0 is never removed
+        self.prev_index = list(range(self.length + 1))
+        # removed (start, end) ranges, the end is inclusive
+        self.removed: List[Tuple[int, int]] = []
+
+    def find_next(self, index: int) -> int:
+        """Returns the first index from ``index`` on that hasn't been
+        removed, or the length of the text."""
+        parent = self.next_index
+        root = index
+        while parent[root] != root:
+            root = parent[root]
+        while parent[index] != root:
+            parent[index], index = root, parent[index]
+        return root
+
+    def find_prev(self, index: int) -> int:
+        """Returns the last index up to ``index`` that hasn't been removed,
+        or -1."""
+        parent = self.prev_index
+        root = index + 1
+        while parent[root] != root:
+            root = parent[root]
+        index += 1
+        while parent[index] != root:
+            parent[index], index = root, parent[index]
+        return root - 1
+
+    def remove(self, start: int, end: int) -> None:
+        self.removed.append((start, end))
+        index = start
+        while index <= end:
+            next_index = self.find_next(index + 1)
+            self.next_index[index] = index + 1
+            self.prev_index[index + 1] = index
+            index = next_index
+
+    def remaining_ranges(self) -> List[Tuple[int, int]]:
+        """Returns the (start, end) ranges of the characters that haven't
+        been removed, the end is exclusive."""
+        ranges = []
+        pos = 0
+        for start, end in sorted(self.removed):
+            if start > pos:
+                ranges.append((pos, start))
+            pos = max(pos, end + 1)
+        ranges.append((pos, self.length))
+        return ranges
+
+    def get_text(self) -> str:
+        return "".join(
+            self.text[start:end] for start, end in self.remaining_ranges()
+        )
+
+    def skip_text(self, index: int) -> int:
+        """Returns the index of the first brace from ``index`` on that hasn't
+        been removed, or the length of the text."""
+        while index < self.length and self.text[index] not in "{}":
+            m = BRACE_RE.search(self.text, index)
+            index = self.find_next(self.length if m is None else m.start())
+        return index
+
+    def match_template(self, start: int) -> int:
+        """Returns the end index of ``TEMPLATE_RE`` matched at ``start``, or
+        -1.  The expression never backtracks: ``}`` ends the template if the
+        next character is ``}`` and is followed by any other character
+        otherwise, and ``{`` can only follow ``}``."""
+        text = self.text
+        index = self.find_next(start + 1)
+        if index == self.length or text[index] != "{":
+            return -1
+        index = self.skip_text(self.find_next(index + 1))
+        while index < self.length:
+            if text[index] == "{":
+                return -1
+            index = self.find_next(index + 1)
+            if index == self.length:
+                return -1
+            if text[index] == "}":
+                return index
+            index = self.skip_text(self.find_next(index + 1))
+        return -1
+
+    def match_arg(self, start: int) -> int:
+        """Returns the end index of ``TEMPLATE_ARG_RE`` matched at
+        ``start``, or -1, like ``match_template()``."""
+        text = self.text
+        index = start
+        for _ in range(2):
+            index = self.find_next(index + 1)
+            if index == self.length or text[index] != "{":
+                return -1
+        index = self.skip_text(self.find_next(index + 1))
+        while index < self.length:
+            if text[index] == "{":
+                return -1
+            index = self.find_next(index + 1)
+            if index == self.length:
+                return -1
+            if text[index] == "}":
+                index = self.find_next(index + 1)
+                if index == self.length:
+                    return -1
+                if text[index] == "}":
+                    return index
+            index = self.skip_text(self.find_next(index + 1))
+        return -1
+
+    def last_start(
+        self, pos: int, width: int, stop: int, stop_result: int
+    ) -> int:
+        """Returns the last index before ``pos`` where ``width`` "{"
+        characters start, if a match started there could include ``pos``.
+        A match can't include a run of two or more "{" after its start, so
+        the search stops at the first such run.  If the search reaches
+        ``stop``, the result is ``stop_result``, the result for ``stop``."""
+        text = self.text
+        index = self.find_prev(pos - 1)
+        while index >= 0:
+            if index < stop:
+                return stop_result
+            if text[index] != "{":
+                brace = text.rfind("{", 0, index)
+                if brace < 0:
+                    return -1
+                index = self.find_prev(brace)
+                continue
+            # the run of "{" before ``pos`` and the braces after it
+            following = 0
+            next_index = index
+            while following < width - 1:
+                next_index = self.find_next(next_index + 1)
+                if next_index == self.length or text[next_index] != "{":
+                    break
+                following += 1
+            start = index
+            run_length = following + 1
+            while run_length < width:
+                prev_index = self.find_prev(start - 1)
+                if prev_index < 0 or text[prev_index] != "{":
+                    break
+                start = prev_index
+                run_length += 1
+            if run_length >= width:
+                return start
+            if run_length >= 2:
+                return -1
+            index = self.find_prev(start - 1)
+        return -1
+
+    def remove_matches(
+        self, positions: Optional[List[int]], width: int
+    ) -> List[int]:
+        """Does one ``re.sub()`` pass of ``TEMPLATE_ARG_RE`` (if ``width`` is
+        3) or ``TEMPLATE_RE`` (if it is 2).  Every new match includes one of
+        the ``positions`` where characters were removed since the last pass
+        of the same expression, or any position if ``positions`` is None.
+        Returns the positions after the removed matches."""
+        matches: List[Tuple[int, int]] = []
+        if positions is None:
+            # the first pass, with the regular expression
+            ranges = self.remaining_ranges()
+            offsets = []
+            offset = 0
+            for start, end in ranges:
+                offsets.append(offset)
+                offset += end - start
+            regex = TEMPLATE_ARG_RE if width == 3 else TEMPLATE_RE
+
+            def original_index(index: int) -> int:
+                i = bisect_right(offsets, index) - 1
+                return ranges[i][0] + index - offsets[i]
+
+            for m in regex.finditer(self.get_text()):
+                matches.append(
+                    (original_index(m.start()), original_index(m.end() - 1))
+                )
+        else:
+            match = self.match_arg if width == 3 else self.match_template
+            starts = set()
+            stop = stop_result = -1
+            for pos in sorted({self.find_next(pos) for pos in positions}):
+                if pos < self.length:
+                    stop_result = self.last_start(pos, width, stop, stop_result)
+                    stop = pos
+                    if stop_result >= 0:
+                        starts.add(stop_result)
+            for start in sorted(starts):
+                end = match(start)
+                if end >= 0:
+                    matches.append((start, end))
+        new_positions = []
+        last_end = -1
+        for start, end in matches:
+            if start > last_end:
+                self.remove(start, end)
+                new_positions.append(end + 1)
+                last_end = end
+        return new_positions
+
+
+def scan_braces(text: str) -> str:
+    """Does what the regular expression passes of ``remove_templates()``
+    do until nothing changes: template arguments are removed until none are
+    left, then templates once, and again.  A character can only start a new
+    match in a pass if the match includes a position where characters were
+    removed since the last pass of the same expression, so each pass only
+    looks at the text around those positions instead of all of it."""
+    remaining = RemainingText(text)
+    arg_positions: Optional[List[int]] = None
+    template_positions: Optional[List[int]] = None
+    while True:
+        positions = remaining.remove_matches(arg_positions, 3)
+        arg_positions = positions
+        if template_positions is not None:
+            template_positions.extend(positions)
+        if len(positions) > 0:
+            continue
+        positions = remaining.remove_matches(template_positions, 2)
+        if len(positions) == 0:
+            break
+        template_positions = positions
+        arg_positions.extend(positions)
+    if len(remaining.removed) == 0:
+        return text
+    return remaining.get_text()
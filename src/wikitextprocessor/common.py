@@ -2,8 +2,10 @@
 #
 # Copyright (c) 2020-2022 Tatu Ylonen.  See file LICENSE and https://ylonen.org
 
+import multiprocessing.pool
 import re
-from typing import Iterator, Dict
+import threading
+from typing import Callable, Dict, Iterable, Iterator, TypeVar
 
 
 # Character range used for marking magic sequences.  This package
@@ -67,3 +69,38 @@ def add_newline_to_expansion(text: str) -> str:
     if isinstance(text, str) and text.startswith(("*", ";", ":", "#", "{|")):
         return "\n" + text
     return text
+
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+def imap_bounded(
+    pool: "multiprocessing.pool.Pool",
+    func: Callable[[T], R],
+    iterable: Iterable[T],
+    max_pending: int,
+) -> Iterator[R]:
+    """Like ``pool.imap()``, but at most ``max_pending`` items are taken from
+    ``iterable`` ahead of the results consumed from this generator.  The
+    pool's task thread would otherwise read the whole iterable and keep all
+    unconsumed results in memory when the consumer is slower than the
+    workers."""
+    semaphore = threading.Semaphore(max_pending)
+    stop_event = threading.Event()
+
+    def bounded_iter() -> Iterator[T]:
+        for item in iterable:
+            semaphore.acquire()
+            if stop_event.is_set():
+                return
+            yield item
+
+    try:
+        for result in pool.imap(func, bounded_iter()):
+            semaphore.release()
+            yield result
+    finally:
+        # let the pool's task thread finish if the consumer stopped early
+        stop_event.set()
+        semaphore.release()
@@ -0,0 +1,153 @@
+# Compression of the page bodies saved in the database
+#
+# Copyright (c) 2020-2022 Tatu Ylonen.  See file LICENSE and https://ylonen.org
+
+import zlib
+from collections import Counter
+from typing import Any, Callable, Dict, Iterable, List, Optional, Union
+
+# Bodies shorter than this many bytes are saved uncompressed, they wouldn't
+# get much smaller and most of them are read often (short templates).
+COMPRESS_MIN_SIZE = 256
+
+# zlib can only use the last 32 KiB of a preset dictionary
+DICTIONARY_SIZE = 32 * 1024
+# Number of bodies needed for training a dictionary, and the maximum number
+# of bodies used
+DICTIONARY_MIN_SAMPLES = 100
+DICTIONARY_MAX_SAMPLES = 10000
+
+# Compressed bodies are saved as a BLOB of a dictionary id byte followed by
+# raw deflate data.  Dictionary id 0 means no dictionary.
+NO_DICTIONARY = 0
+
+
+def train_dictionary(
+    samples: Iterable[str], size: int = DICTIONARY_SIZE
+) -> bytes:
+    """Builds a zlib preset dictionary from sample page bodies.  Wikitext
+    pages repeat the same lines (section titles, template calls) and line
+    prefixes ending with a template argument separator, the dictionary has
+    the repeated ones that save the most bytes.  zlib finds matches closer
+    to the end of the dictionary with fewer bits, so the most valuable
+    strings are placed last."""
+    counter: Counter[str] = Counter()
+    for sample in samples:
+        strings = set()
+        for line in sample.splitlines():
+            if 3 <= len(line) <= 200:
+                strings.add(line)
+            arg_start = line.rfind("|")
+            if arg_start > 0:
+                strings.add(line[: arg_start + 1])
+        counter.update(strings)
+
+    scored = sorted(
+        (
+            (count * len(string.encode("utf-8")), string)
+            for string, count in counter.items()
+            if count > 1
+        ),
+        reverse=True,
+    )
+    parts: List[bytes] = []
+    total_size = 0
+    for _, string in scored:
+        data = string.encode("utf-8") + b"\n"
+        if total_size + len(data) <= size:
+            parts.append(data)
+            total_size += len(data)
+    return b"".join(reversed(parts))
+
+
+def compress_body(
+    body: Optional[str], dictionary_id: int, dictionary: Optional[bytes]
+) -> Union[str, bytes, None]:
+    """Returns the value saved to the body column: compressed bytes or the
+    body itself if it is short or doesn't compress."""
+    if body is None:
+        return None
+    data = body.encode("utf-8")
+    if len(data) < COMPRESS_MIN_SIZE:
+        return body
+    if dictionary is None:
+        compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+    else:
+        compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS, zdict=dictionary)
+    compressed = (
+        bytes((dictionary_id,))
+        + compressor.compress(data)
+        + compressor.flush()
+    )
+    return compressed if len(compressed) < len(data) else body
+
+
+def decompress_body(
+    value: Union[str, bytes, None], dictionaries: Dict[int, bytes]
+) -> Optional[str]:
+    """Returns the page body of a body column value."""
+    if not isinstance(value, bytes):
+        return value
+    if value[0] == NO_DICTIONARY:
+        decompressor = zlib.decompressobj(wbits=-zlib.MAX_WBITS)
+    else:
+        decompressor = zlib.decompressobj(
+            wbits=-zlib.MAX_WBITS, zdict=dictionaries[value[0]]
+        )
+    return (decompressor.decompress(value[1:]) + decompressor.flush()).decode(
+        "utf-8"
+    )
+
+
+class CompressedBody:
+    """A compressed page body, decompressed when it is first used."""
+
+    __slots__ = ("data", "dictionaries")
+
+    def __init__(self, data: bytes, dictionaries: Dict[int, bytes]) -> None:
+        self.data = data
+        self.dictionaries = dictionaries
+
+    def decompress(self) -> Optional[str]:
+        return decompress_body(self.data, self.dictionaries)
+
+    load = decompress
+
+
+class DeferredBody:
+    """A page body that hasn't been read from the database yet.  ``loader``
+    reads it when it is first used, ``length`` is its length in UTF-8
+    bytes."""
+
+    __slots__ = ("loader", "length")
+
+    def __init__(
+        self, loader: Callable[[], Optional[str]], length: int
+    ) -> None:
+        self.loader = loader
+        self.length = length
+
+    def load(self) -> Optional[str]:
+        return self.loader()
+
+
+class LazyBody:
+    """Descriptor of the ``Page.body`` field, which can be set to a
+    ``CompressedBody`` or a ``DeferredBody``.  The body is decompressed or
+    read when it is used the first time, so pages whose body isn't used are
+    never decompressed."""
+
+    def __set_name__(self, owner: type, name: str) -> None:
+        self.attr_name = "_" + name
+
+    def __get__(self, obj: Any, objtype: Optional[type] = None) -> Any:
+        if obj is None:
+            return None  # default value of the dataclass field
+        value = getattr(obj, self.attr_name)
+        if isinstance(value, (CompressedBody, DeferredBody)):
+            value = value.load()
+            setattr(obj, self.attr_name, value)
+        return value
+
+    def __set__(self, obj: Any, value: Any) -> None:
+        setattr(obj, self.attr_name, value)
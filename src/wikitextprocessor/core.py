@@ -3,19 +3,25 @@
 #
 # Copyright (c) 2020-2022 Tatu Ylonen.  See file LICENSE and https://ylonen.org
 
+import dataclasses
 import html
 import html.entities
+import itertools
 import json
 import logging
+import multiprocessing
+import os
 import re
 import sqlite3
 import sys
 import tempfile
+import time
 import urllib.parse
-from collections import defaultdict, deque
+from collections import OrderedDict, defaultdict, deque
 from collections.abc import Sequence
-from dataclasses import dataclass
-from functools import lru_cache
+from contextlib import ExitStack, closing, contextmanager
+from dataclasses import dataclass, field
+from functools import partial
 
 if sys.version_info < (3, 10):
     from importlib_resources import files
@@ -26,10 +32,13 @@ from pathlib import Path
 from types import TracebackType
 from typing import (
     TYPE_CHECKING,
+    Any,
     Callable,
     DefaultDict,
     Dict,
     Generator,
+    Iterable,
+    Iterator,
     List,
     Optional,
     Set,
@@ -38,16 +47,36 @@ from typing import (
     Union,
 )
 
+from .braces import remove_templates, template_names
 from .common import (
     MAGIC_FIRST,
     MAGIC_LAST,
     MAGIC_NOWIKI_CHAR,
     MAX_MAGICS,
     add_newline_to_expansion,
+    imap_bounded,
     nowiki_quote,
 )
+from .compression import (
+    COMPRESS_MIN_SIZE,
+    DICTIONARY_MAX_SAMPLES,
+    DICTIONARY_MIN_SAMPLES,
+    CompressedBody,
+    LazyBody,
+    decompress_body,
+    train_dictionary,
+)
 from .luaexec import call_lua_sandbox
 from .node_expand import NodeHandlerFnCallable, to_html, to_text, to_wikitext
+from .page_cache import NamespaceIndex, PageCache, TitleFilter, TitleFilters
+from .page_store import (
+    MemoryPageStore,
+    PageStore,
+    SQLitePageStore,
+    UnsupportedPageStoreError,
+    like_pattern_regex,
+    page_matches,
+)
 from .parser import KIND_TO_LEVEL, WikiNode, parse_encoded
 from .parserfns import PARSER_FUNCTIONS, call_parser_function, init_namespaces
 from .wikihtml import ALLOWED_HTML_TAGS
@@ -116,6 +145,8 @@ CookieData = Tuple[str, Sequence[str], bool]
 
 CookieChar = str
 
+MAGIC_CHAR_RE = re.compile(f"[{chr(MAGIC_FIRST)}-{chr(MAGIC_LAST)}]")
+
 EMPTY_NAMESPACEDATA: NamespaceDataEntry = {
     "id": -1,
     "name": "NAMESPACE_DATA_ERROR",
@@ -126,14 +157,124 @@ EMPTY_NAMESPACEDATA: NamespaceDataEntry = {
 }
 
 
+# Version of the database schema, saved in "PRAGMA user_version".  Older
+# database files are migrated when they are opened.
+SCHEMA_VERSION = 2
+
+# Columns added to the pages table in version 2, the unversioned (0)
+# schema only has the columns before them
+ADDED_PAGE_COLUMNS: Dict[str, str] = {
+    # page id, revision id and revision text SHA-1 from the dump file
+    "page_id": "INTEGER",
+    "revision_id": "INTEGER",
+    "sha1": "TEXT",
+    "title_key": "TEXT",  # see Wtp.title_key()
+    "length": "INTEGER",  # body length in UTF-8 bytes
+    "flags": "INTEGER",  # PAGE_FLAG_* bits
+}
+
+PAGE_FLAG_REDIRECT = 1
+PAGE_FLAG_COMPRESSED = 2  # the body is saved compressed
+
+# Page fields that can be selected in Wtp.iter_pages(), in addition to the
+# title and namespace id
+PAGE_COLUMNS = ("redirect_to", "need_pre_expand", "body", "model", "page_id")
+
+# Status of a redirect chain in the redirect_targets table
+REDIRECT_RESOLVED = 0
+REDIRECT_BROKEN = 1  # ends at a missing page
+REDIRECT_CYCLE = 2  # loops
+
+# Maximum sizes of the get_page() cache pools in bytes
+TEMPLATE_CACHE_SIZE = 64 * 1024 * 1024
+MODULE_CACHE_SIZE = 64 * 1024 * 1024
+PAGE_CACHE_SIZE = 16 * 1024 * 1024
+# Number of templates sent to a worker process of analyze_templates() at a
+# time, fewer templates are analyzed in the main process
+ANALYZE_BATCH_SIZE = 1000
+# Number of compiled template bodies kept in memory for expand()
+COMPILED_BODY_CACHE_SIZE = 4096
+# Number of consecutive rowids in a shard of Wtp.iter_pages()
+SHARD_BLOCK_SIZE = 10000
+
+# Memory-mapped size of read-only database files, SQLite limits it to the
+# compile-time maximum (2 GiB by default)
+READ_ONLY_MMAP_SIZE = 1 << 40
+
+# SQLite settings used while bulk loading pages, the original values are
+# restored afterwards.  Losing the database file in a crash doesn't matter
+# here because it would be recreated from the dump file anyway.
+BULK_LOAD_PRAGMAS: Dict[str, Union[int, str]] = {
+    "synchronous": "OFF",
+    "cache_size": -256 * 1024,  # KiB
+    "temp_store": "MEMORY",
+}
+
+
 @dataclass
 class Page:
     title: str
     namespace_id: int
     redirect_to: Optional[str] = None
     need_pre_expand: bool = False
-    body: Optional[str] = None
+    # decompressed when first used
+    body: Optional[str] = LazyBody()  # type: ignore[assignment]
     model: Optional[str] = None
+    page_id: Optional[int] = None  # page id in the dump file
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # pickle the decompressed body
+        state = self.__dict__.copy()
+        state["_body"] = self.body
+        return state
+
+
+# Literal text and indexes of CompiledBody.cookies
+CompiledParts = Tuple[Union[str, int], ...]
+
+
+def split_cookies(text: str) -> CompiledParts:
+    """Splits encoded text into its literal text and the indexes of its
+    magic characters."""
+    parts: List[Union[str, int]] = []
+    pos = 0
+    for m in MAGIC_CHAR_RE.finditer(text):
+        if m.start() > pos:
+            parts.append(text[pos : m.start()])
+        parts.append(ord(m.group(0)) - MAGIC_FIRST)
+        pos = m.end()
+    if pos < len(text):
+        parts.append(text[pos:])
+    return tuple(parts)
+
+
+@dataclass(frozen=True)
+class CompiledBody:
+    """A template body encoded by ``Wtp._encode()`` once for all pages.
+    ``text`` is the literal text with magic characters in place of the
+    templates, parser function calls, template arguments and links, and the
+    magic characters refer to ``cookies`` (from ``MAGIC_FIRST`` on) instead
+    of the cookies of the current page.  The arguments of a cookie only
+    refer to the cookies before it.  ``parts`` is ``text`` and
+    ``arg_parts`` are the arguments of each cookie split by
+    ``split_cookies()``, so template arguments are substituted without
+    searching for the magic characters again."""
+
+    text: str
+    cookies: Tuple[CookieData, ...]
+    parts: CompiledParts
+    arg_parts: Tuple[Tuple[CompiledParts, ...], ...]
+
+
+@dataclass
+class RedirectReport:
+    """Results of ``Wtp.resolve_redirects()``: the number of redirect pages
+    whose chain ends at an existing page, and the titles and namespace ids
+    of the redirect pages whose chain is broken or cyclic."""
+
+    resolved: int = 0
+    broken: List[Tuple[str, int]] = field(default_factory=list)
+    cyclic: List[Tuple[str, int]] = field(default_factory=list)
 
 
 class BegLineDisableManager:
@@ -205,6 +346,23 @@ class Wtp:
         "lua_env_stack",
         "lua_frame_stack",
         "project",  # "wiktionary" or "wikipedia"
+        "bulk_rows",  # Buffered page rows in bulk_load(), otherwise None
+        "bulk_batch_size",  # Number of buffered rows written at a time
+        "compress_bodies",  # Save new page bodies compressed
+        "body_dictionaries",  # Compression dictionaries by id
+        "body_dictionary_id",  # Dictionary used for new bodies, 0 if none
+        "read_only",  # Database is opened read-only, for worker processes
+        "page_cache",  # Cache of get_page() lookups
+        "namespace_index",  # Pages of some namespaces in memory, or None
+        "title_filters",  # Bloom filters of page titles, or None
+        "title_filters_saved",  # title_filters are saved in the database
+        "first_letter_namespaces",  # Namespace ids of case-insensitive titles
+        "redirect_targets_resolved",  # redirect_targets table is up to date
+        "has_search_index",  # The page_search full-text index exists
+        "page_store",  # Storage of the saved pages
+        "page_overrides",  # Pages that replace saved pages, in memory
+        "pre_expand_overrides",  # (title, namespace id) -> need_pre_expand
+        "compiled_bodies",  # Template body -> CompiledBody, least recent first
     )
 
     def __init__(
@@ -213,12 +371,16 @@ class Wtp:
         lang_code="en",
         template_override_funcs: Dict[str, Callable[[Sequence[str]], str]] = {},
         project: str = "wiktionary",
+        compress_bodies: bool = False,
+        read_only: bool = False,
+        page_store: Optional[PageStore] = None,
     ):
         if isinstance(db_path, str):
             self.db_path: Optional[Path] = Path(db_path)
         else:
             self.db_path = db_path
         self.cookies: List[CookieData] = []
+        self.compiled_bodies: OrderedDict[str, CompiledBody] = OrderedDict()
         self.errors: List[ErrorMessageData] = []
         self.warnings: List[ErrorMessageData] = []
         self.debugs: List[ErrorMessageData] = []
@@ -241,7 +403,23 @@ class Wtp:
         self.init_namespace_data()
         self.namespaces: Dict[int, Namespace] = {}
         init_namespaces(self)
-        self.create_db()
+        self.namespace_index: Optional[NamespaceIndex] = None
+        self.page_cache = PageCache(
+            {
+                self.NAMESPACE_DATA["Template"]["id"]: TEMPLATE_CACHE_SIZE,
+                self.NAMESPACE_DATA["Module"]["id"]: MODULE_CACHE_SIZE,
+                None: PAGE_CACHE_SIZE,
+            }
+        )
+        self.compress_bodies = compress_bodies
+        self.read_only = read_only
+        if read_only:
+            self.open_read_only_db()
+        else:
+            self.create_db()
+        self.page_store = page_store or SQLitePageStore()
+        self.page_store.open(self)
+        self.load_page_overrides()
         self.template_override_funcs = template_override_funcs
         self.beginning_of_line = False
         self.begline_enabled = True
@@ -254,6 +432,8 @@ class Wtp:
         self.lua_env_stack = deque()
         self.lua_frame_stack = deque()
         self.project = project
+        self.bulk_rows: Optional[List[Tuple]] = None
+        self.bulk_batch_size = 0
 
     def create_db(self) -> None:
         if self.db_path is None:
@@ -277,18 +457,346 @@ class Wtp:
         need_pre_expand INTEGER,
         body TEXT,
         model TEXT,
+        page_id INTEGER,
+        revision_id INTEGER,
+        sha1 TEXT,
+        title_key TEXT,
+        length INTEGER,
+        flags INTEGER,
         PRIMARY KEY(title, namespace_id));
 
+        CREATE TABLE IF NOT EXISTS body_dictionaries (
+        id INTEGER PRIMARY KEY,
+        data BLOB);
+
+        CREATE TABLE IF NOT EXISTS title_filters (
+        namespace_id INTEGER PRIMARY KEY,
+        num_hashes INTEGER,
+        bits BLOB);
+
+        CREATE TABLE IF NOT EXISTS first_letter_namespaces (
+        namespace_id INTEGER PRIMARY KEY);
+
+        CREATE TABLE IF NOT EXISTS redirect_targets (
+        title TEXT,
+        namespace_id INTEGER,
+        target TEXT,
+        status INTEGER,
+        PRIMARY KEY(title, namespace_id)) WITHOUT ROWID;
+
+        CREATE TABLE IF NOT EXISTS redirect_chain_keys (
+        title_key TEXT,
+        namespace_id INTEGER,
+        title TEXT,
+        PRIMARY KEY(title_key, namespace_id, title)) WITHOUT ROWID;
+
+        CREATE TABLE IF NOT EXISTS page_overrides (
+        title TEXT,
+        namespace_id INTEGER,
+        body TEXT,
+        redirect_to TEXT,
+        need_pre_expand INTEGER,
+        model TEXT,
+        PRIMARY KEY(title, namespace_id));
+
+        CREATE TABLE IF NOT EXISTS pre_expand_overrides (
+        title TEXT,
+        namespace_id INTEGER,
+        need_pre_expand INTEGER,
+        PRIMARY KEY(title, namespace_id)) WITHOUT ROWID;
+
+        CREATE TABLE IF NOT EXISTS template_analysis (
+        title TEXT PRIMARY KEY,
+        pre_expand INTEGER) WITHOUT ROWID;
+
+        CREATE TABLE IF NOT EXISTS template_links (
+        template TEXT,
+        title TEXT,
+        redirect INTEGER,
+        PRIMARY KEY(template, title)) WITHOUT ROWID;
+
+        CREATE INDEX IF NOT EXISTS template_links_title
+        ON template_links(title);
+
         PRAGMA journal_mode = WAL;
         """
         )
+        self.load_body_dictionaries()
+        self.load_title_filters()
+        self.load_first_letter_namespaces()
+        self.load_redirect_targets_state()
+        self.load_search_index_state()
+        self.migrate_db()
+
+    def migrate_db(self) -> None:
+        """Updates the schema of a database file saved before the schema
+        was versioned (``PRAGMA user_version`` 0)."""
+        (version,) = self.db_conn.execute("PRAGMA user_version").fetchone()
+        if version >= SCHEMA_VERSION:
+            return
+        columns = {
+            row[1] for row in self.db_conn.execute("PRAGMA table_info(pages)")
+        }
+        for column, column_type in ADDED_PAGE_COLUMNS.items():
+            if column not in columns:
+                self.db_conn.execute(
+                    f"ALTER TABLE pages ADD COLUMN {column} {column_type}"
+                )
+        self.db_conn.execute(
+            f"""UPDATE pages SET
+            title_key = page_title_key(title, namespace_id),
+            length = ifnull(length(CAST(page_body(body) AS BLOB)), 0),
+            flags = (redirect_to IS NOT NULL) * {PAGE_FLAG_REDIRECT}
+            | (typeof(body) = 'blob') * {PAGE_FLAG_COMPRESSED}"""
+        )
+        self.db_conn.executescript(
+            f"""
+        CREATE INDEX IF NOT EXISTS pages_title_key
+        ON pages(title_key, namespace_id);
+
+        CREATE INDEX IF NOT EXISTS pages_redirect_to
+        ON pages(redirect_to, namespace_id);
+
+        CREATE INDEX IF NOT EXISTS pages_need_pre_expand
+        ON pages(namespace_id) WHERE need_pre_expand = 1;
+
+        PRAGMA user_version = {SCHEMA_VERSION};
+        """
+        )
+
+    def open_read_only_db(self) -> None:
+        """Opens an existing database file for reading only.  The file is
+        opened as immutable: SQLite doesn't lock it or check it for changes,
+        so many processes can open it at the same time quickly, and it is
+        memory-mapped so they share the operating system's page cache.  The
+        file must not be changed while it is open."""
+        if self.db_path is None or not self.db_path.exists():
+            raise ValueError(f"Database file {self.db_path} doesn't exist")
+        wal_path = self.db_path.with_name(self.db_path.name + "-wal")
+        if wal_path.exists() and wal_path.stat().st_size > 0:
+            # immutable connections don't read the WAL file
+            raise ValueError(
+                f"Database file {self.db_path} has changes in its WAL file, "
+                "close the Wtp object that wrote them first"
+            )
+        self.db_conn = sqlite3.connect(
+            self.db_path.resolve().as_uri() + "?mode=ro&immutable=1",
+            uri=True,
+            check_same_thread=False,
+        )
+        self.db_conn.execute(f"PRAGMA mmap_size = {READ_ONLY_MMAP_SIZE}")
+        (version,) = self.db_conn.execute("PRAGMA user_version").fetchone()
+        if version < SCHEMA_VERSION:
+            raise ValueError(
+                f"Database file {self.db_path} uses an old schema, open it "
+                "once without read_only=True to update it"
+            )
+        self.load_body_dictionaries()
+        self.load_title_filters()
+        self.load_first_letter_namespaces()
+        self.load_redirect_targets_state()
+        self.load_search_index_state()
+
+    def load_redirect_targets_state(self) -> None:
+        (self.redirect_targets_resolved,) = self.db_conn.execute(
+            "SELECT EXISTS (SELECT 1 FROM redirect_targets)"
+        ).fetchone()
+
+    def load_search_index_state(self) -> None:
+        (self.has_search_index,) = self.db_conn.execute(
+            "SELECT EXISTS (SELECT 1 FROM sqlite_master WHERE name = ?)",
+            ("page_search",),
+        ).fetchone()
+
+    def load_body_dictionaries(self) -> None:
+        self.body_dictionaries: Dict[int, bytes] = dict(
+            self.db_conn.execute("SELECT id, data FROM body_dictionaries")
+        )
+        self.body_dictionary_id = max(self.body_dictionaries, default=0)
+        # For searching compressed bodies in SQL queries
+        self.db_conn.create_function(
+            "page_body",
+            1,
+            partial(decompress_body, dictionaries=self.body_dictionaries),
+            deterministic=True,
+        )
+
+    def load_first_letter_namespaces(self) -> None:
+        # Chinese Wiktionary and English Wikipedia capitalize the first
+        # letter of template/module page titles but use lower case in
+        # Wikitext and Lua code
+        self.first_letter_namespaces: Set[int] = {
+            self.NAMESPACE_DATA[ns]["id"] for ns in ("Template", "Module")
+        }
+        self.first_letter_namespaces.update(
+            namespace_id
+            for (namespace_id,) in self.db_conn.execute(
+                "SELECT namespace_id FROM first_letter_namespaces"
+            )
+        )
+        self.db_conn.create_function(
+            "page_title_key", 2, self.title_key, deterministic=True
+        )
+
+    def set_first_letter_namespaces(self, namespace_ids: Set[int]) -> None:
+        """Saves the namespaces whose page titles have a case-insensitive
+        first letter, from the <siteinfo> of a dump file.  Titles of the
+        Template and Module namespaces are always looked up this way."""
+        self.check_writable()
+        self.flush_bulk_rows()
+        old_namespace_ids = self.first_letter_namespaces
+        self.db_conn.execute("DELETE FROM first_letter_namespaces")
+        self.db_conn.executemany(
+            "INSERT INTO first_letter_namespaces VALUES (?)",
+            ((namespace_id,) for namespace_id in namespace_ids),
+        )
+        self.load_first_letter_namespaces()
+        changed_namespace_ids = (
+            old_namespace_ids ^ self.first_letter_namespaces
+        )
+        if len(changed_namespace_ids) > 0:
+            self.page_store.update_title_keys(changed_namespace_ids)
+            self.page_overrides.update_title_keys(changed_namespace_ids)
+            # the filters have the old title keys
+            self.db_conn.execute("DELETE FROM title_filters")
+            self.title_filters = None
+            self.title_filters_saved = False
+            self.clear_page_caches()
+        self.db_conn.commit()
+
+    def title_key(self, title: str, namespace_id: Optional[int]) -> str:
+        """Returns the key used for looking up a page title: the first
+        letter after the namespace prefix is in upper case if it is
+        case-insensitive in the namespace."""
+        if namespace_id not in self.first_letter_namespaces:
+            return title
+        prefix = ""
+        if namespace_id != 0:
+            prefix = self.LOCAL_NS_NAME_BY_ID.get(namespace_id, "") + ":"
+            if not title.startswith(prefix):
+                prefix = ""
+        name = title[len(prefix) :]
+        return prefix + name[:1].upper() + name[1:]
 
     @property
     def backup_db_path(self) -> Path:
         assert self.db_path
         return self.db_path.with_stem(self.db_path.stem + "_backup")
 
+    def load_title_filters(self) -> None:
+        filters = {
+            namespace_id: TitleFilter(bytearray(bits), num_hashes)
+            for namespace_id, num_hashes, bits in self.db_conn.execute(
+                "SELECT namespace_id, num_hashes, bits FROM title_filters"
+            )
+        }
+        self.title_filters = TitleFilters(filters) if filters else None
+        self.title_filters_saved = self.title_filters is not None
+
+    def build_title_filters(self) -> None:
+        """Builds and saves Bloom filters of the page titles of each
+        namespace.  ``get_page()`` uses them to find out that a page doesn't
+        exist without a database query, e.g. for undefined templates and
+        ``#ifexist``.  Pages saved later are added to the filters in memory,
+        and the saved filters are deleted until they are built again.
+        ``process_dump()`` calls this after saving all pages."""
+        self.check_writable()
+        if not isinstance(self.page_store, SQLitePageStore):
+            return  # the store answers lookups of missing pages itself
+        self.flush_bulk_rows()
+        filters = {
+            namespace_id: TitleFilter.for_capacity(page_nums)
+            for namespace_id, page_nums in self.db_conn.execute(
+                "SELECT namespace_id, count(*) FROM pages GROUP BY namespace_id"
+            )
+        }
+        for namespace_id, title, title_key in self.db_conn.execute(
+            "SELECT namespace_id, title, title_key FROM pages"
+        ):
+            filters[namespace_id].add(title)
+            if title_key != title:
+                filters[namespace_id].add(title_key)
+        self.db_conn.execute("DELETE FROM title_filters")
+        self.db_conn.executemany(
+            "INSERT INTO title_filters VALUES (?, ?, ?)",
+            (
+                (namespace_id, title_filter.num_hashes, title_filter.bits)
+                for namespace_id, title_filter in filters.items()
+            ),
+        )
+        self.db_conn.commit()
+        self.title_filters = TitleFilters(filters)
+        self.title_filters_saved = True
+        for page in self.page_overrides.iter_pages():
+            self._add_title_to_filters(page.title, page.namespace_id)
+        self.page_cache.clear()
+
+    def build_search_index(self) -> None:
+        """Builds a full-text index of the page bodies, used for the
+        ``search_pattern`` argument of ``get_all_pages()`` and
+        ``saved_page_nums()``.  The trigram tokenizer indexes all substrings
+        of three characters, so LIKE patterns are answered from the index
+        instead of reading every body.  The index doesn't copy the bodies,
+        it reads them from the pages table.  ``SQLitePageStore`` keeps it up
+        to date when pages are saved or deleted through ``Wtp``, until
+        ``drop_search_index()`` is called.  Other SQLite clients can change
+        the pages table, but their changes aren't indexed until this is
+        called again to rebuild the index."""
+        self.check_writable()
+        self.require_sqlite_store("The full-text search index")
+        self.flush_bulk_rows()
+        start_time = time.perf_counter()
+        self.db_conn.executescript(
+            """
+        CREATE VIEW IF NOT EXISTS page_search_content AS
+        SELECT rowid AS page_rowid, page_body(body) AS body FROM pages;
+
+        CREATE VIRTUAL TABLE IF NOT EXISTS page_search USING fts5(
+        body,
+        content='page_search_content',
+        content_rowid='page_rowid',
+        tokenize='trigram');
+
+        INSERT INTO page_search(page_search) VALUES ('rebuild');
+        """
+        )
+        self.db_conn.commit()
+        self.has_search_index = True
+        logging.info(
+            "Built the page full-text search index in "
+            f"{time.perf_counter() - start_time:.1f}s"
+        )
+
+    def drop_search_index(self) -> None:
+        self.check_writable()
+        self.db_conn.executescript(
+            """
+        DROP TABLE IF EXISTS page_search;
+        DROP VIEW IF EXISTS page_search_content;
+        """
+        )
+        self.db_conn.commit()
+        self.has_search_index = False
+
+    def require_sqlite_store(self, feature: str) -> None:
+        if not isinstance(self.page_store, SQLitePageStore):
+            raise UnsupportedPageStoreError(
+                f"{feature} needs pages saved by SQLitePageStore, not "
+                f"{type(self.page_store).__name__}"
+            )
+
+    def check_writable(self) -> None:
+        if self.read_only:
+            raise sqlite3.OperationalError(
+                f"Database file {self.db_path} is opened read-only"
+            )
+        if self.page_store.read_only:
+            raise sqlite3.OperationalError(
+                f"Pages of {type(self.page_store).__name__} are read-only"
+            )
+
     def backup_db(self) -> None:
+        self.check_writable()
         self.backup_db_path.unlink(True)
         self.db_conn.commit()
         backup_conn = sqlite3.connect(self.backup_db_path)
@@ -299,17 +807,26 @@ class Wtp:
     def close_db_conn(self) -> None:
         assert self.db_path
         self.db_conn.close()
+        self.page_store.close()
+        if self.read_only:
+            # other processes may still use the file
+            return
         if self.db_path.parent.samefile(Path(tempfile.gettempdir())):
             for path in self.db_path.parent.glob(self.db_path.name + "*"):
                 # also remove SQLite -wal and -shm file
                 path.unlink(True)
 
     def has_analyzed_templates(self) -> bool:
-        for (result,) in self.db_conn.execute(
-            "SELECT count(*) > 0 FROM pages WHERE need_pre_expand = 1"
-        ):
-            return result == 1
-        return False
+        self.flush_bulk_rows()
+        template_ns_ids = [self.NAMESPACE_DATA["Template"]["id"]]
+        return (
+            any(self.pre_expand_overrides.values())
+            or any(
+                page.need_pre_expand
+                for page in self.page_overrides.iter_pages(template_ns_ids)
+            )
+            or self.page_store.has_pre_expand_pages(template_ns_ids)
+        )
 
     def build_sql_where_query(
         self,
@@ -317,7 +834,7 @@ class Wtp:
         include_redirects: bool = True,
         model: Optional[str] = None,
         search_pattern: Optional[str] = None,
-    ) -> Tuple[str, List[Union[str, int]]]:
+    ) -> Tuple[str, Tuple[Union[str, int], ...]]:
         and_strs = []
         where_str = ""
         query_values = []
@@ -328,8 +845,14 @@ class Wtp:
             query_values.extend(namespace_ids)
         if not include_redirects:
             and_strs.append("redirect_to IS NULL")
-        if search_pattern:
-            and_strs.append("body LIKE ?")
+        if search_pattern and self.has_search_index:
+            # same LIKE pattern, answered from the trigram index
+            and_strs.append(
+                "rowid IN (SELECT rowid FROM page_search WHERE body LIKE ?)"
+            )
+            query_values.append(search_pattern)
+        elif search_pattern:
+            and_strs.append("page_body(body) LIKE ?")
             query_values.append(search_pattern)
         if model is not None:
             and_strs.append("model = ?")
@@ -347,21 +870,28 @@ class Wtp:
         model: Optional[str] = None,
         search_pattern: Optional[str] = None,
     ) -> int:
-        query_str = "SELECT count(*) FROM pages"
-
-        where_str, query_values = self.build_sql_where_query(
-            namespace_ids,
-            include_redirects,
-            model,
-            search_pattern,
+        self.flush_bulk_rows()
+        page_nums = self.page_store.count_pages(
+            namespace_ids, include_redirects, model, search_pattern
         )
-
-        query_str += where_str
-
-        for result in self.db_conn.execute(query_str, query_values):
-            return result[0]
-
-        return 0  # Mainly to satisfy the type checker
+        if len(self.page_overrides.pages) > 0:
+            regex = None
+            if search_pattern:
+                regex = like_pattern_regex(search_pattern)
+            page_nums += self.page_overrides.count_pages(
+                namespace_ids, include_redirects, model, search_pattern
+            )
+            # the replaced pages
+            page_nums -= sum(
+                1
+                for page in self.page_store.get_pages(
+                    self.page_overrides.pages, lazy_body=True
+                )
+                if page_matches(
+                    page, namespace_ids, include_redirects, model, regex
+                )
+            )
+        return page_nums
 
     def init_namespace_data(self) -> None:
         with self.data_folder.joinpath("namespaces.json").open(
@@ -526,6 +1056,63 @@ class Wtp:
         self.rev_ht[v] = ch
         return ch
 
+    def compile_template_body(self, body: str) -> CompiledBody:
+        """Encodes a template body like ``_encode()``, but with its own
+        cookies, so that the result can be used on any page."""
+        cookies, rev_ht = self.cookies, self.rev_ht
+        self.cookies, self.rev_ht = [], {}
+        try:
+            text = self._encode(body)
+            compiled_cookies = tuple(self.cookies)
+        finally:
+            self.cookies, self.rev_ht = cookies, rev_ht
+        return CompiledBody(
+            text,
+            compiled_cookies,
+            split_cookies(text),
+            tuple(
+                tuple(split_cookies(arg) for arg in args)
+                for _, args, _ in compiled_cookies
+            ),
+        )
+
+    def _get_compiled_body(self, body: str) -> Optional[CompiledBody]:
+        """Returns the compiled template body from the cache, or None if the
+        body has magic characters, which refer to the page's cookies."""
+        compiled = self.compiled_bodies.get(body)
+        if compiled is None:
+            if MAGIC_CHAR_RE.search(body) is not None:
+                return None
+            compiled = self.compile_template_body(body)
+            self.compiled_bodies[body] = compiled
+            if len(self.compiled_bodies) > COMPILED_BODY_CACHE_SIZE:
+                self.compiled_bodies.popitem(last=False)
+        else:
+            self.compiled_bodies.move_to_end(body)
+        return compiled
+
+    def _save_compiled_cookie(
+        self, compiled: CompiledBody, idx: int, saved: Dict[int, CookieChar]
+    ) -> CookieChar:
+        """Saves a cookie of the compiled body and the cookies in its
+        arguments for the current page, ``saved`` has the already saved
+        cookies."""
+        ch = saved.get(idx)
+        if ch is None:
+            kind, _, nowiki = compiled.cookies[idx]
+            args = tuple(
+                "".join(
+                    part
+                    if isinstance(part, str)
+                    else self._save_compiled_cookie(compiled, part, saved)
+                    for part in arg
+                )
+                for arg in compiled.arg_parts[idx]
+            )
+            ch = self._save_value(kind, args, nowiki)
+            saved[idx] = ch
+        return ch
+
     def _encode(self, text: str) -> str:
         """Encode all templates, template arguments, and parser function calls
         in the text, from innermost to outermost."""
@@ -746,34 +1333,7 @@ class Wtp:
         assert isinstance(text, str), (
             f"{text=!r} was passed " "into _template_to_body"
         )
-        # Remove all comments
-        text = re.sub(r"(?s)<!--.*?-->", "", text)
-        # Remove all text inside <noinclude> ... </noinclude>
-        text = re.sub(r"(?is)<noinclude\s*>.*?</noinclude\s*>", "", text)
-        # Handle <noinclude> without matching </noinclude> by removing the
-        # rest of the file.  <noinclude/> is handled specially elsewhere, as
-        # it appears to be used as a kludge to prevent normal interpretation
-        # of e.g. [[ ... ]] by placing it between the brackets.
-        text = re.sub(r"(?is)<noinclude\s*>.*", "", text)
-        # Apparently unclosed <!-- at the end of a template body is ignored
-        text = re.sub(r"(?s)<!--.*", "", text)
-        # <onlyinclude> tags, if present, include the only text that will be
-        # transcluded.  All other text is ignored.
-        onlys = list(
-            re.finditer(
-                r"(?is)<onlyinclude\s*>(.*?)"
-                r"</onlyinclude\s*>|"
-                r"<onlyinclude\s*/>",
-                text,
-            )
-        )
-        if onlys:
-            text = "".join(m.group(1) or "" for m in onlys)
-        # Remove <includeonly>.  They mark text that is not visible on the page
-        # itself but is included in transclusion.  Also text outside these tags
-        # is included in transclusion.
-        text = re.sub(r"(?is)<\s*(/\s*)?includeonly\s*(/\s*)?>", "", text)
-        return text
+        return template_to_body(text)
 
     def add_page(
         self,
@@ -788,6 +1348,20 @@ class Wtp:
         SQLite database file."""
         if model is None:
             model = "wikitext"
+        title, body = self._prepare_page(title, namespace_id, body, redirect_to)
+        self._insert_page(
+            title, namespace_id, body, redirect_to, need_pre_expand, model
+        )
+
+    def _prepare_page(
+        self,
+        title: str,
+        namespace_id: Optional[int],
+        body: Optional[str],
+        redirect_to: Optional[str],
+    ) -> Tuple[str, Optional[str]]:
+        """Returns the title with the namespace prefix and the body to save,
+        the transcluded part of a template body."""
         if namespace_id:
             ns_prefix = self.LOCAL_NS_NAME_BY_ID.get(namespace_id, "") + ":"
         else:
@@ -804,276 +1378,759 @@ class Wtp:
             and redirect_to is None
         ):
             body = self._template_to_body(title, body)
+        return title, body
 
-        self.db_conn.execute(
-            """INSERT INTO pages (title, namespace_id, body,
-        redirect_to, need_pre_expand, model) VALUES (?, ?, ?, ?, ?, ?)
-        ON CONFLICT(title, namespace_id) DO UPDATE SET
-        body=excluded.body, redirect_to=excluded.redirect_to,
-        need_pre_expand=excluded.need_pre_expand, model=excluded.model""",
-            (title, namespace_id, body, redirect_to, need_pre_expand, model),
-        )
-
-    def _analyze_template(self, name: str, body: str) -> Tuple[Set[str], bool]:
-        """Analyzes a template body and returns a set of the canonicalized
-        names of all other templates it calls and a boolean that is True
-        if it should be pre-expanded before final parsing and False if it
-        need not be pre-expanded.  The pre-expanded flag is determined
-        based on that body only; the caller should propagate it to
-        templates that include the given template.  This does not work for
-        template and template function calls where the name is generated by
-        other expansions."""
-        included_templates: Set[str] = set()
-        pre_expand = False
-
-        # Determine if the template starts with a list item
-        # XXX should we expand other templates that produce list items???
-        contains_list = body.startswith(("#", "*", ";", ":"))
-
-        # Remove paired tables.
-        # What is left is unpaired tables, which is an indication that a
-        # template somewhere should be generating those table eventually,
-        # and thus needs to be pre-expanded.
-        table_start_pos = []
-        table_end_pos = []
-        # `[[wikt:/|}]]` in Template:Mon standard keyboard
-        # and `{{l|mul|} }}` in Template:punctuation are not end of table token
-        # but `|}]]` in Template:Lithuania map is a table
-        for m in re.finditer(
-            r"""
-            (?<!{){\|  # `{|` not after `{`, like `{{{|}}}`
-            |
-            \|}(?!\s*})  # `|}` not before ` }`
-            """,
+    def _insert_page(
+        self,
+        title: str,
+        namespace_id: Optional[int],
+        body: Optional[str],
+        redirect_to: Optional[str],
+        need_pre_expand: bool,
+        model: str,
+        page_id: Optional[int] = None,
+        revision_id: Optional[int] = None,
+        sha1: Optional[str] = None,
+    ) -> None:
+        """Saves an already normalized page row.  ``add_page()`` prefixes the
+        title and extracts the transcluded part of template bodies before
+        calling this; the dump parser does the same work in its worker
+        processes.  Pages from dump files also have their page id, revision
+        id and revision SHA-1."""
+        self.check_writable()
+        title_key = self.title_key(title, namespace_id)
+        if self.redirect_targets_resolved:
+            self._invalidate_redirect_targets(title, title_key, namespace_id)
+        self.page_cache.invalidate(title)
+        self.page_cache.invalidate(title_key)
+        if self.title_filters is not None:
+            self.title_filters.add(namespace_id, title)
+            self.title_filters.add(namespace_id, title_key)
+            if self.title_filters_saved:
+                # the saved filters don't have the new title
+                self.db_conn.execute("DELETE FROM title_filters")
+                self.title_filters_saved = False
+        if self.namespace_index is not None:
+            self.namespace_index.add(
+                title,
+                title_key,
+                namespace_id,
+                redirect_to,
+                need_pre_expand,
+                body,
+                model,
+                page_id,
+            )
+        row = (
+            title,
+            namespace_id,
             body,
-            re.VERBOSE,
-        ):
-            if m.group() == "{|":
-                table_start_pos.append(m.start())
-            else:
-                table_end_pos.append(m.end())
-        num_table_start = len(table_start_pos)
-        num_table_end = len(table_end_pos)
-        contains_unpaired_table = num_table_start != num_table_end
-        table_start = len(body)
-        table_end = table_start
-        if num_table_start > num_table_end and num_table_end > 0:
-            table_start = table_start_pos[num_table_start - num_table_end - 1]
-            table_end = table_end_pos[-1]
-        elif num_table_start < num_table_end and num_table_start > 0:
-            table_start = table_start_pos[0]
-            table_end = table_end_pos[num_table_start]
-        elif num_table_start > 0 and num_table_end > 0:
-            table_start = table_start_pos[0]
-            table_end = table_end_pos[-1]
-        unpaired_text = body[:table_start] + body[table_end:]
-
-        # Determine if the template contains table element tokens
-        # outside paired table start/end.  We only try to look for
-        # these outside templates, as it is common to write each
-        # template argument on its own line starting with a "|".
-        outside = unpaired_text
-        while True:
-            # print("=== OUTSIDE ITER")
-            prev = outside
+            redirect_to,
+            need_pre_expand,
+            model,
+            page_id,
+            revision_id,
+            sha1,
+            title_key,
+            0 if body is None else len(body.encode("utf-8")),
+            PAGE_FLAG_REDIRECT if redirect_to is not None else 0,
+        )
+        if self.bulk_rows is not None:
+            self.bulk_rows.append(row)
+            if len(self.bulk_rows) >= self.bulk_batch_size:
+                self.flush_bulk_rows()
+        else:
+            self.page_store.put_pages((row,))
 
-            # handle {{{ }}} parameters without templates inside them
-            while True:
-                newt = re.sub(
-                    # re.X, ignore white space and comments
-                    r"""(?sx)\{\{\{                # {{{
-                                   (    [^{}]      # no {} except...
-                                   |    \}[^}]     # no }} unless...
-                                   |    \}\}[^}]   # they're definitely not }}}
-                                   )*?
-                             \}\}\}                # }}}
-                    """,
-                    "",
-                    prev,
-                )
-                if newt == prev:
-                    break
-                prev = newt
-            # print("After arg elim: {!r}".format(newt))
-
-            # Handle templates
-            newt = re.sub(
-                r"""(?sx)\{\{
-                                        (    [^{}]
-                                        |    \}[^}]
-                                        )*?
-                                    \}\}""",
-                "",
-                newt,
+    def _invalidate_redirect_targets(
+        self, title: str, title_key: str, namespace_id: Optional[int]
+    ) -> None:
+        """Deletes the saved redirect chains that the saved page could
+        change: its own chain and the chains that look up its title key,
+        which pass through the page or end at it or were broken at it.
+        ``get_page_resolve_redirect()`` follows these chains one page at a
+        time."""
+        titles = [title]
+        titles.extend(
+            row[0]
+            for row in self.db_conn.execute(
+                """SELECT title FROM redirect_chain_keys
+                WHERE title_key = ? AND namespace_id = ?""",
+                (title_key, namespace_id),
             )
-            # print("After templ elim: {!r}".format(newt))
-            if newt == outside:
-                break
-            outside = newt
-        # Check if the template contains certain table elements
-        # start of line plus |+, |- or |!
-        m = re.search(r"(?s)(^|\n)(\|\+|\|-|\!)", outside)
-        m2 = re.match(r"(?si)\s*(<includeonly>|<!--.*?-->)(\|\||!!)", outside)
-        contains_table_element = m is not None or m2 is not None
-        # if contains_table_element:
-        #     print("contains_table_element {!r} at {}"
-        #           .format(m.group(0), m.start()))
-        #     print("... {!r} ...".format(outside[m.start() - 10:m.end() + 10]))
-        #     print(repr(outside))
-
-        # Check for unpaired HTML tags
-        tag_cnts: DefaultDict[str, int] = defaultdict(int)
-        for m in re.finditer(
-            r"(?si)<(/)?({})\b\s*[^>]*(/)?>"
-            r"".format("|".join(PAIRED_HTML_TAGS)),
-            outside,
-        ):
-            start_slash = m.group(1)
-            tagname = m.group(2)
-            end_slash = m.group(3)
-            if start_slash:
-                tag_cnts[tagname] -= 1
-            elif not end_slash:
-                tag_cnts[tagname] += 1
-        contains_unbalanced_html = any(v != 0 for v in tag_cnts.values())
-        # if contains_unbalanced_html:
-        #     print(name, "UNBALANCED HTML")
-        #     for k, v in tag_cnts.items():
-        #         if v != 0:
-        #             print("  {} {}".format(v, k))
-
-        # if pre_expand:
-        #     print(name,
-        #           {"list": contains_list,
-        #            "unpaired_table": contains_unpaired_table,
-        #            "table_element": contains_table_element,
-        #            "unbalanced_html": contains_unbalanced_html,
-        #            "pre_expand": pre_expand,
-        #     })
-
-        # Determine which other templates are called from unpaired text.
-        # None of the flags we currently gather propagate outside a paired
-        # table start/end.
-        for m in re.finditer(
-            # capture the first parameter of a template, ie. the name
-            r"""(?sx)(^   |  [^{])            # start
-                        (\{\{)?\{\{([^{]*?)   # ( ({{) {{ (name) )
-                     (\|  |  \}\})            # | or }}""",
-            unpaired_text,
-        ):
-            called_template = m.group(3)
-            called_template = re.sub(r"(?si)<nowiki\s*/>", "", called_template)
-            if len(called_template) > 0:
-                included_templates.add(called_template)
-
-        # Chinese Wiktionary language and POS subtitle template
-        # uses "langhd" template, "langhd" redirects to "語言標題"
-        is_chinese_heading = self.lang_code == "zh" and (
-            len({"langhd", "語言標題", "语言标题"} & included_templates) > 0
-            or is_chinese_subtitle_template(self, name)
         )
+        # the chain keys are kept, they only delete the chains again
+        self.db_conn.executemany(
+            """DELETE FROM redirect_targets
+            WHERE title = ? AND namespace_id = ?""",
+            ((chain_title, namespace_id) for chain_title in titles),
+        )
+        for chain_title in titles:
+            self.page_cache.invalidate(chain_title)
+            self.page_cache.invalidate(
+                self.title_key(chain_title, namespace_id)
+            )
 
-        # Determine whether this template should be pre-expanded
-        pre_expand = (
-            contains_list
-            or contains_unpaired_table
-            or contains_table_element
-            or contains_unbalanced_html
-            or is_chinese_heading
+    def _train_body_dictionary(self, bodies: Iterable[Optional[str]]) -> None:
+        """Trains the compression dictionary of page bodies if there are
+        enough samples.  The dictionary is saved in the current
+        transaction."""
+        samples = [
+            body
+            for body in bodies
+            if body is not None and len(body) >= COMPRESS_MIN_SIZE
+        ][:DICTIONARY_MAX_SAMPLES]
+        if len(samples) < DICTIONARY_MIN_SAMPLES:
+            return
+        dictionary_id = self.body_dictionary_id + 1
+        dictionary = train_dictionary(samples)
+        self.db_conn.execute(
+            "INSERT INTO body_dictionaries VALUES (?, ?)",
+            (dictionary_id, dictionary),
         )
+        self.body_dictionaries[dictionary_id] = dictionary
+        self.body_dictionary_id = dictionary_id
+
+    def _page_body(
+        self, value: Union[str, bytes, None]
+    ) -> Union[str, CompressedBody, None]:
+        if isinstance(value, bytes):
+            return CompressedBody(value, self.body_dictionaries)
+        return value
+
+    @contextmanager
+    def bulk_load(self, batch_size: int = 50000) -> Iterator[None]:
+        """Context manager for adding many pages quickly.  Page rows saved by
+        ``add_page()`` are buffered and written with ``executemany()``, one
+        transaction per ``batch_size`` rows, and the database is made less
+        durable while loading (see ``BULK_LOAD_PRAGMAS``).  The buffered rows
+        are written and the original settings are restored on exit."""
+        if self.bulk_rows is not None:
+            # Already bulk loading
+            yield
+            return
+        self.check_writable()
+        self.db_conn.commit()
+        saved_pragmas = {
+            pragma: self.db_conn.execute(f"PRAGMA {pragma}").fetchone()[0]
+            for pragma in BULK_LOAD_PRAGMAS
+        }
+        for pragma, value in BULK_LOAD_PRAGMAS.items():
+            self.db_conn.execute(f"PRAGMA {pragma} = {value}")
+        self.bulk_rows = []
+        self.bulk_batch_size = batch_size
+        try:
+            yield
+        finally:
+            self.flush_bulk_rows()
+            self.bulk_rows = None
+            # the settings can't be changed in a transaction, e.g. of rows
+            # written to other tables without page rows to flush
+            self.db_conn.commit()
+            for pragma, value in saved_pragmas.items():
+                self.db_conn.execute(f"PRAGMA {pragma} = {value}")
+
+    def flush_bulk_rows(self) -> None:
+        """Writes the page rows buffered in ``bulk_load()`` mode."""
+        if self.bulk_rows:
+            if self.compress_bodies and self.body_dictionary_id == 0:
+                self._train_body_dictionary(row[2] for row in self.bulk_rows)
+            with self.db_conn:
+                self.page_store.put_pages(self.bulk_rows)
+            self.bulk_rows.clear()
 
-        return included_templates, pre_expand
+    def _analyze_template(self, name: str, body: str) -> Tuple[Set[str], bool]:
+        return analyze_template(
+            name, body, self.lang_code, self.NAMESPACE_DATA["Template"]["name"]
+        )
 
-    def analyze_templates(self) -> None:
+    def analyze_templates(self, num_processes: Optional[int] = None) -> None:
         """Analyzes templates to determine which of them might create elements
         essential to parsing Wikitext syntax, such as table start or end
         tags.  Such templates generally need to be expanded before
-        parsing the page."""
-
+        parsing the page.  Template bodies are analyzed in ``num_processes``
+        worker processes (defaults to the number of CPUs) if there are more
+        than ``ANALYZE_BATCH_SIZE`` templates, the pre-expand flags are
+        propagated in this process."""
+        self.check_writable()
         logging.info(
             "Analyzing which templates should be expanded before parsing"
         )
         template_ns_data = self.NAMESPACE_DATA.get("Template")
         template_ns_id = template_ns_data["id"]
         template_ns_local_name = template_ns_data["name"]
-        expand_stack: List[Page] = []
+        num_processes = num_processes or os.cpu_count() or 1
+        expand_stack: List[str] = []
         # the keys of included_map are template names without
         # the namespace prefix
         included_map: DefaultDict[str, Set[str]] = defaultdict(set)
+        titles: Set[str] = set()
+        redirects: Dict[str, str] = {}
+        saved_pre_expand: Set[str] = set()
+        # titles of the templates that need pre-expanding, and of those that
+        # need it because of their own body
+        need_pre_expand: Set[str] = set()
+        self_pre_expand: Set[str] = set()
+
+        def template_batches() -> Iterator[List[Tuple[str, str]]]:
+            batch: List[Tuple[str, str]] = []
+            for page in self.get_all_pages([template_ns_id]):
+                titles.add(page.title)
+                if page.redirect_to is not None:
+                    redirects[page.title] = page.redirect_to
+                if page.need_pre_expand:
+                    saved_pre_expand.add(page.title)
+                    need_pre_expand.add(page.title)
+                if page.body is not None:
+                    batch.append((page.title, page.body))
+                    if len(batch) == ANALYZE_BATCH_SIZE:
+                        yield batch
+                        batch = []
+                elif self.lang_code == "zh" and is_chinese_subtitle_title(
+                    page.title, template_ns_local_name
+                ):
+                    need_pre_expand.add(page.title)
+                    self_pre_expand.add(page.title)
+                    expand_stack.append(page.title)
+            if len(batch) > 0:
+                yield batch
+
+        analyze = partial(
+            analyze_template_batch,
+            lang_code=self.lang_code,
+            template_ns_local_name=template_ns_local_name,
+        )
+        batches = template_batches()
+        first_batch = next(batches, [])
+        batches = itertools.chain([first_batch], batches)
+        with ExitStack() as stack:
+            if num_processes > 1 and len(first_batch) == ANALYZE_BATCH_SIZE:
+                pool = stack.enter_context(multiprocessing.Pool(num_processes))
+                results = stack.enter_context(
+                    closing(
+                        imap_bounded(pool, analyze, batches, num_processes * 4)
+                    )
+                )
+            else:
+                results = map(analyze, batches)
+            for batch_results in results:
+                for title, used_templates, pre_expand in batch_results:
+                    for used_template in used_templates:
+                        included_map[used_template].add(title)
+                    if pre_expand:
+                        need_pre_expand.add(title)
+                        self_pre_expand.add(title)
+                        expand_stack.append(title)
+
+        # Template bodies are encoded when they are first expanded, with
+        # their own cookie numbers (see compile_template_body()).
+
+        # Propagate pre_expand from lower-level templates to all templates that
+        # refer to them, and between redirected source templates and their
+        # destination pages
+        for title, redirect_to in redirects.items():
+            included_map[
+                redirect_to.removeprefix(template_ns_local_name + ":")
+            ].add(title)
+        while len(expand_stack) > 0:
+            title = expand_stack.pop()
+            for template_title in self._template_dependents(
+                title, included_map, redirects, titles
+            ):
+                if template_title not in need_pre_expand:
+                    need_pre_expand.add(template_title)
+                    expand_stack.append(template_title)
+
+        self.set_templates_pre_expand(
+            sorted(need_pre_expand - saved_pre_expand)
+        )
+        self.save_template_links(
+            (
+                (title, title in self_pre_expand)
+                for title in titles
+            ),
+            (
+                (template, title, title in redirects)
+                for template, included_titles in included_map.items()
+                for title in included_titles
+            ),
+            replace=True,
+        )
+        self.db_conn.commit()
+        self.clear_page_caches()
 
-        for page in self.get_all_pages([template_ns_id]):
+    def save_template_links(
+        self,
+        analysis: Iterable[Tuple[str, bool]],
+        links: Iterable[Tuple[str, str, bool]],
+        replace: bool = False,
+    ) -> None:
+        """Saves the analysis results of templates (their titles, and whether
+        their own body needs pre-expanding) and the inclusion graph for
+        ``update_template_analysis()``.  ``links`` has the name of a template
+        without the namespace prefix, the title of a template that includes
+        it or redirects to it, and whether it is a redirect.  All saved rows
+        are deleted first if ``replace`` is True."""
+        if replace:
+            self.db_conn.execute("DELETE FROM template_analysis")
+            self.db_conn.execute("DELETE FROM template_links")
+        self.db_conn.executemany(
+            "INSERT OR REPLACE INTO template_analysis VALUES (?, ?)", analysis
+        )
+        self.db_conn.executemany(
+            "INSERT OR REPLACE INTO template_links VALUES (?, ?, ?)", links
+        )
+
+    def has_template_links(self) -> bool:
+        """Returns True if the inclusion graph of ``analyze_templates()`` is
+        saved in the database."""
+        (found,) = self.db_conn.execute(
+            "SELECT EXISTS (SELECT 1 FROM template_analysis)"
+        ).fetchone()
+        return found == 1
+
+    def update_template_analysis(self, titles: Iterable[str]) -> None:
+        """Analyzes the changed, added or deleted templates ``titles`` again
+        after ``analyze_templates()`` analyzed all of them.  Their
+        ``need_pre_expand`` flags and the flags of the templates that include
+        them or redirect to them (recursively) are set or cleared; the
+        flags of other templates stay as they are.  The inclusion graph is
+        saved in the database by ``analyze_templates()``, all templates are
+        analyzed if it hasn't been saved."""
+        self.check_writable()
+        self.flush_bulk_rows()
+        if not self.has_template_links():
+            self.analyze_templates()
+            return
+        template_ns_local_name = self.NAMESPACE_DATA["Template"]["name"]
+        prefix = template_ns_local_name + ":"
+        changed = {
+            title if title.startswith(prefix) else prefix + title
+            for title in titles
+        }
+        # templates whose flag could change: the changed templates, their
+        # old redirect destinations and the templates that include them
+        stack = list(changed)
+        for title in changed:
+            stack.extend(
+                prefix + template
+                for (template,) in self.db_conn.execute(
+                    """SELECT template FROM template_links
+                    WHERE title = ? AND redirect = 1""",
+                    (title,),
+                )
+            )
+        pages = self._get_templates(changed)
+        for title in changed:
+            self.db_conn.execute(
+                "DELETE FROM template_analysis WHERE title = ?", (title,)
+            )
+            self.db_conn.execute(
+                "DELETE FROM template_links WHERE title = ?", (title,)
+            )
+            page = pages.get(title)
+            if page is None:
+                continue
+            pre_expand = False
+            links: List[Tuple[str, str, bool]] = []
+            if page.redirect_to is not None:
+                links.append(
+                    (page.redirect_to.removeprefix(prefix), title, True)
+                )
+            # same as analyze_templates(), redirects included
             if page.body is not None:
-                used_templates, pre_expand = self._analyze_template(
-                    page.title, page.body
+                used_templates, pre_expand = analyze_template(
+                    title, page.body, self.lang_code, template_ns_local_name
+                )
+                links.extend(
+                    (template, title, False) for template in used_templates
+                )
+            else:
+                pre_expand = self.lang_code == "zh" and (
+                    is_chinese_subtitle_title(title, template_ns_local_name)
+                )
+            self.save_template_links(((title, pre_expand),), links)
+
+        # the saved inclusion graph, as in analyze_templates()
+        included_map: DefaultDict[str, Set[str]] = defaultdict(set)
+        redirects: Dict[str, str] = {}
+        for template, title, redirect in self.db_conn.execute(
+            "SELECT template, title, redirect FROM template_links"
+        ):
+            included_map[template].add(title)
+            if redirect:
+                redirects[title] = prefix + template
+        all_titles: Set[str] = set()
+        self_pre_expand: Set[str] = set()
+        for title, pre_expand in self.db_conn.execute(
+            "SELECT title, pre_expand FROM template_analysis"
+        ):
+            all_titles.add(title)
+            if pre_expand:
+                self_pre_expand.add(title)
+
+        affected: Set[str] = set()
+        while len(stack) > 0:
+            title = stack.pop()
+            if title not in affected:
+                affected.add(title)
+                stack.extend(
+                    self._template_dependents(
+                        title, included_map, redirects, all_titles
+                    )
                 )
-                for used_template in used_templates:
-                    included_map[used_template].add(page.title)
-                if pre_expand:
-                    self.set_template_pre_expand(page.title)
-                    expand_stack.append(page)
-            elif self.lang_code == "zh" and is_chinese_subtitle_template(
-                self, page.title
+
+        # The flags of the other templates are up to date, the affected
+        # templates need pre-expanding if their own body does or if a
+        # template they depend on does.
+        dependencies: DefaultDict[str, Set[str]] = defaultdict(set)
+        for title in all_titles - affected:
+            for template_title in self._template_dependents(
+                title, included_map, redirects, all_titles
+            ):
+                if template_title in affected:
+                    dependencies[template_title].add(title)
+        flagged_dependencies = self._pre_expand_titles(
+            set().union(*dependencies.values())
+        )
+        need_pre_expand: Set[str] = set()
+        for title in affected:
+            if title in self_pre_expand or not dependencies[
+                title
+            ].isdisjoint(flagged_dependencies):
+                need_pre_expand.add(title)
+                stack.append(title)
+        while len(stack) > 0:
+            title = stack.pop()
+            for template_title in self._template_dependents(
+                title, included_map, redirects, all_titles
             ):
-                self.set_template_pre_expand(page.title)
+                if (
+                    template_title in affected
+                    and template_title not in need_pre_expand
+                ):
+                    need_pre_expand.add(template_title)
+                    stack.append(template_title)
 
-        # XXX consider encoding template bodies here (also need to save related
-        # cookies).  This could speed up their expansion, where the first
-        # operation is to encode them.  (Consider whether cookie numbers from
-        # nested template expansions could conflict)
+        saved_pre_expand = self._pre_expand_titles(affected)
+        self.set_templates_pre_expand(
+            sorted(need_pre_expand - saved_pre_expand)
+        )
+        self.set_templates_pre_expand(
+            sorted(saved_pre_expand - need_pre_expand), False
+        )
+        self.db_conn.commit()
 
-        # Propagate pre_expand from lower-level templates to all templates that
-        # refer to them
-        while len(expand_stack) > 0:
-            page = expand_stack.pop()
-            title_no_ns_prefix = page.title.removeprefix(
-                template_ns_local_name + ":"
+    def _template_dependents(
+        self,
+        title: str,
+        included_map: Dict[str, Set[str]],
+        redirects: Dict[str, str],
+        titles: Set[str],
+    ) -> Set[str]:
+        """Returns the titles of the templates that need pre-expanding if the
+        template ``title`` does: the templates that include it or redirect
+        to it (``included_map``) and its redirect destination."""
+        template_ns_local_name = self.NAMESPACE_DATA["Template"]["name"]
+        title_no_ns_prefix = title.removeprefix(template_ns_local_name + ":")
+        if (
+            title_no_ns_prefix not in included_map
+            and self.lang_code == "zh"
+            and len(title_no_ns_prefix) > 0
+        ):
+            title_no_ns_prefix = (
+                title_no_ns_prefix[0].lower() + title_no_ns_prefix[1:]
             )
-            if title_no_ns_prefix not in included_map:
-                if self.lang_code == "zh":
-                    title_no_ns_prefix = (
-                        title_no_ns_prefix[0].lower() + title_no_ns_prefix[1:]
+        related = set(included_map.get(title_no_ns_prefix, ()))
+        redirect_to = redirects.get(title)
+        if redirect_to is not None and redirect_to in titles:
+            related.add(redirect_to)
+        return related
+
+    def _get_templates(
+        self, titles: Iterable[str], lazy_body: bool = False
+    ) -> Dict[str, Page]:
+        """Returns the templates with the exact titles, page overrides
+        first."""
+        template_ns_id = self.NAMESPACE_DATA["Template"]["id"]
+        pages = {}
+        keys = []
+        for title in titles:
+            page = self.page_overrides.pages.get((title, template_ns_id))
+            if page is not None:
+                pages[title] = page
+            else:
+                keys.append((title, template_ns_id))
+        for page in self.page_store.get_pages(keys, lazy_body):
+            pages[page.title] = self._with_pre_expand_override(page)
+        return pages
+
+    def _pre_expand_titles(self, titles: Iterable[str]) -> Set[str]:
+        return {
+            title
+            for title, page in self._get_templates(titles, True).items()
+            if page.need_pre_expand
+        }
+
+    def set_template_pre_expand(self, name: str) -> None:
+        self.set_templates_pre_expand((name,))
+
+    def set_templates_pre_expand(
+        self, names: Iterable[str], need_pre_expand: bool = True
+    ) -> None:
+        """Sets (or clears) ``need_pre_expand`` of the templates titled
+        ``names`` in one batched update."""
+        self.check_writable()
+        template_ns_id = self.NAMESPACE_DATA["Template"]["id"]
+        keys = [(name, template_ns_id) for name in names]
+        if len(self.page_overrides.pages) > 0:
+            # the flags of the saved pages are overridden, so that
+            # clear_page_overrides() also reverts the analysis results that
+            # depend on the overridden templates
+            saved_keys = []
+            for key in keys:
+                page = self.page_overrides.pages.get(key)
+                if page is None:
+                    saved_keys.append(key)
+                elif page.need_pre_expand != need_pre_expand:
+                    self._save_page_override(
+                        page.title,
+                        page.namespace_id,
+                        page.body,
+                        page.redirect_to,
+                        need_pre_expand,
+                        page.model,
                     )
-                    if title_no_ns_prefix not in included_map:
-                        continue
-                else:
-                    continue
+            keys = [
+                (page.title, page.namespace_id)
+                for page in self.page_store.get_pages(saved_keys, True)
+            ]
+            self._save_pre_expand_overrides(keys, need_pre_expand)
+        else:
+            self.page_store.set_need_pre_expand(keys, need_pre_expand)
+        for name, _ in keys:
+            self.page_cache.invalidate(name)
+            if self.namespace_index is not None:
+                self.namespace_index.set_need_pre_expand(name, need_pre_expand)
+
+    def _save_pre_expand_overrides(
+        self, keys: List[Tuple[str, int]], need_pre_expand: bool
+    ) -> None:
+        """Overrides the ``need_pre_expand`` flags of saved pages without
+        copying the pages.  The flags are set on the pages found in the
+        saved pages table by ``get_page()`` and the page iterators."""
+        self.db_conn.executemany(
+            "INSERT OR REPLACE INTO pre_expand_overrides VALUES (?, ?, ?)",
+            (
+                (title, namespace_id, need_pre_expand)
+                for title, namespace_id in keys
+            ),
+        )
+        for key in keys:
+            self.pre_expand_overrides[key] = need_pre_expand
 
-            for template_title in included_map[title_no_ns_prefix]:
-                self.get_page.cache_clear()  # avoid infinite loop
-                template = self.get_page(template_title, template_ns_id)
-                if not template or template.need_pre_expand:
-                    continue
-                # print("propagating EXP {} -> {}".format(name, inc))
-                self.set_template_pre_expand(template.title)
-                expand_stack.append(template)
+    def _with_pre_expand_override(self, page: Page) -> Page:
+        need_pre_expand = self.pre_expand_overrides.get(
+            (page.title, page.namespace_id)
+        )
+        if need_pre_expand is None or need_pre_expand == page.need_pre_expand:
+            return page
+        # a lazy body is copied without reading it
+        return dataclasses.replace(
+            page, need_pre_expand=need_pre_expand, body=vars(page)["_body"]
+        )
 
-        # Also set `need_pre_expand` value for redirected source templates
-        query_str = """
-        UPDATE pages SET need_pre_expand = 1
-        FROM pages AS dest
-        WHERE pages.redirect_to = dest.title
-        AND pages.namespace_id = dest.namespace_id
-        AND dest.need_pre_expand = 1
-        AND pages.need_pre_expand = 0
-        """
-        self.db_conn.execute(query_str)
+    def load_page_overrides(self) -> None:
+        self.page_overrides = MemoryPageStore()
+        self.page_overrides.open(self)
+        self.pre_expand_overrides = {}
+        for row in self.db_conn.execute(
+            """SELECT title, namespace_id, body, redirect_to, need_pre_expand,
+            model FROM page_overrides"""
+        ):
+            self._put_page_override(*row[:4], row[4] == 1, row[5])
+        for title, namespace_id, need_pre_expand in self.db_conn.execute(
+            """SELECT title, namespace_id, need_pre_expand
+            FROM pre_expand_overrides"""
+        ):
+            self.pre_expand_overrides[(title, namespace_id)] = (
+                need_pre_expand == 1
+            )
 
-        # set `need_pre_expand` value to redirected destination page
-        query_str = """
-        UPDATE pages SET need_pre_expand = 1
-        FROM pages AS source
-        WHERE pages.title = source.redirect_to
-        AND pages.namespace_id = source.namespace_id
-        AND source.need_pre_expand = 1
-        AND pages.need_pre_expand = 0
-        """
-        self.db_conn.execute(query_str)
-        self.db_conn.commit()
+    def add_page_override(
+        self,
+        title: str,
+        namespace_id: Optional[int],
+        body: Optional[str] = None,
+        redirect_to: Optional[str] = None,
+        need_pre_expand: bool = False,
+        model: Optional[str] = "wikitext",
+    ) -> None:
+        """Saves a page that replaces the saved page with the same title, or
+        adds a new page, without changing the pages table.  Overrides are
+        kept in the page_overrides table and in memory, and page lookups and
+        iterators find them before the saved pages.
+        ``clear_page_overrides()`` reverts all of them."""
+        self.check_writable()
+        if model is None:
+            model = "wikitext"
+        title, body = self._prepare_page(title, namespace_id, body, redirect_to)
+        self._save_page_override(
+            title, namespace_id, body, redirect_to, need_pre_expand, model
+        )
 
-    def set_template_pre_expand(self, name: str) -> None:
+    def _save_page_override(
+        self,
+        title: str,
+        namespace_id: Optional[int],
+        body: Optional[str],
+        redirect_to: Optional[str],
+        need_pre_expand: bool,
+        model: Optional[str],
+    ) -> None:
         self.db_conn.execute(
-            "UPDATE pages SET need_pre_expand = 1 WHERE title = ?", (name,)
+            "INSERT OR REPLACE INTO page_overrides VALUES (?, ?, ?, ?, ?, ?)",
+            (title, namespace_id, body, redirect_to, need_pre_expand, model),
+        )
+        self._put_page_override(
+            title, namespace_id, body, redirect_to, need_pre_expand, model
+        )
+
+    def _put_page_override(
+        self,
+        title: str,
+        namespace_id: Optional[int],
+        body: Optional[str],
+        redirect_to: Optional[str],
+        need_pre_expand: bool,
+        model: Optional[str],
+    ) -> None:
+        title_key = self.title_key(title, namespace_id)
+        self.page_overrides.put_pages(
+            (
+                (
+                    title,
+                    namespace_id,
+                    body,
+                    redirect_to,
+                    need_pre_expand,
+                    model,
+                    None,
+                    None,
+                    None,
+                    title_key,
+                    0,
+                    0,
+                ),
+            )
+        )
+        self.page_cache.invalidate(title)
+        self.page_cache.invalidate(title_key)
+        self._add_title_to_filters(title, namespace_id)
+        if self.namespace_index is not None:
+            self.namespace_index.add(
+                title,
+                title_key,
+                namespace_id,
+                redirect_to,
+                need_pre_expand,
+                body,
+                model,
+                None,
+            )
+
+    def _add_title_to_filters(
+        self, title: str, namespace_id: Optional[int]
+    ) -> None:
+        # overrides aren't in the saved filters, they are added again when
+        # the filters are loaded
+        if self.title_filters is not None:
+            self.title_filters.add(namespace_id, title)
+            self.title_filters.add(
+                namespace_id, self.title_key(title, namespace_id)
+            )
+
+    def clear_page_overrides(self) -> None:
+        """Deletes all page overrides, the saved pages are found again.  The
+        overridden templates are analyzed again if the template inclusion
+        graph is saved (see ``update_template_analysis()``)."""
+        self.check_writable()
+        if len(self.page_overrides.pages) == 0:
+            return
+        template_titles = [
+            page.title
+            for page in self.page_overrides.iter_pages(
+                [self.NAMESPACE_DATA["Template"]["id"]]
+            )
+        ]
+        self.db_conn.execute("DELETE FROM page_overrides")
+        self.db_conn.execute("DELETE FROM pre_expand_overrides")
+        self.db_conn.commit()
+        self.load_page_overrides()
+        self.clear_page_caches()
+        if len(template_titles) > 0 and self.has_template_links():
+            self.update_template_analysis(template_titles)
+
+    def clear_page_caches(self) -> None:
+        """Clears the cached page lookups after the pages table is changed
+        without ``add_page()``.  The in-memory namespace index is loaded
+        again if it was loaded."""
+        self.page_cache.clear()
+        if self.namespace_index is not None:
+            self.load_namespace_index(self.namespace_index.pages.keys())
+
+    def load_namespace_index(
+        self, namespace_ids: Optional[Iterable[int]] = None
+    ) -> NamespaceIndex:
+        """Loads all pages of the namespaces (templates and modules by
+        default) into memory.  ``get_page()`` then finds pages of these
+        namespaces without database queries, e.g. when expanding templates
+        in worker processes.  The load time and estimated memory use are
+        logged and saved in the returned object."""
+        self.require_sqlite_store("The namespace index")
+        start_time = time.perf_counter()
+        if namespace_ids is None:
+            namespace_ids = [
+                self.NAMESPACE_DATA[ns]["id"] for ns in ("Template", "Module")
+            ]
+        namespace_ids = list(namespace_ids)
+        index = NamespaceIndex(namespace_ids)
+        self.flush_bulk_rows()
+        for row in self.db_conn.execute(
+            f"""SELECT title, title_key, namespace_id, redirect_to,
+            need_pre_expand, body, model, page_id
+            FROM pages
+            WHERE namespace_id IN ({','.join('?' * len(namespace_ids))})""",
+            namespace_ids,
+        ):
+            need_pre_expand = self.pre_expand_overrides.get(
+                (row[0], row[2]), row[4] == 1
+            )
+            index.add(*row[:4], need_pre_expand, *row[5:])
+        for page in self.page_overrides.iter_pages(namespace_ids):
+            index.add(
+                page.title,
+                self.title_key(page.title, page.namespace_id),
+                page.namespace_id,
+                page.redirect_to,
+                page.need_pre_expand,
+                page.body,
+                page.model,
+                page.page_id,
+            )
+        index.load_time = time.perf_counter() - start_time
+        index.memory_size = index.estimate_memory_size()
+        logging.info(
+            f"Loaded {index.page_nums} pages of namespaces {namespace_ids} "
+            f"into memory in {index.load_time:.2f}s, using about "
+            f"{index.memory_size / 1024 / 1024:.1f} MiB"
         )
+        self.namespace_index = index
+        self.page_cache.clear()
+        return index
+
+    def unload_namespace_index(self) -> None:
+        self.namespace_index = None
 
     def start_page(self, title: str) -> None:
         """Starts a new page for expanding Wikitext.  This saves the title and
@@ -1319,6 +2376,92 @@ class Wtp:
                 parts.append(coded[pos:])
                 return "".join(parts)
 
+            def expand_compiled_args(
+                compiled: CompiledBody,
+                coded: CompiledParts,
+                argmap: TemplateArgs,
+                saved: Dict[int, CookieChar],
+            ) -> str:
+                """Does the work of ``expand_args()`` on the parts of a
+                compiled template body.  Only the cookies that remain in the
+                result are saved for the current page."""
+                parts: List[str] = []
+                for part in coded:
+                    if isinstance(part, str):
+                        parts.append(part)
+                        continue
+                    kind, args, nowiki = compiled.cookies[part]
+                    if nowiki or kind == "N":
+                        # kept as-is, see expand_args()
+                        parts.append(
+                            self._save_compiled_cookie(compiled, part, saved)
+                        )
+                        continue
+                    arg_parts = compiled.arg_parts[part]
+                    if kind == "A":
+                        # Template argument reference
+                        if len(args) > 2:
+                            self.debug(
+                                "too many args ({}) in argument "
+                                "reference: {!r}".format(len(args), args),
+                                sortid="core/1021",
+                            )
+                        k: Union[int, str]
+                        if all(isinstance(x, str) for x in arg_parts[0]):
+                            # expand_recurse() wouldn't change the name
+                            k = args[0].strip()
+                        else:
+                            self.expand_stack.append("ARG-NAME")
+                            k = expand_recurse(
+                                expand_compiled_args(
+                                    compiled, arg_parts[0], argmap, saved
+                                ),
+                                parent,
+                                True,
+                            ).strip()
+                            self.expand_stack.pop()
+                        if k.isdigit():
+                            k = int(k)
+                        else:
+                            k = re.sub(r"\s+", " ", k).strip()
+                        v = argmap.get(k, None)
+                        if v is not None:
+                            parts.append(v)
+                            continue
+                        if len(args) >= 2:
+                            self.expand_stack.append("ARG-DEFVAL")
+                            ret = expand_compiled_args(
+                                compiled, arg_parts[1], argmap, saved
+                            )
+                            self.expand_stack.pop()
+                            parts.append(ret)
+                            continue
+                        # The argument is not defined (or name is empty)
+                        parts.append(self._unexpanded_arg([str(k)], nowiki))
+                        continue
+                    new_args = tuple(
+                        expand_compiled_args(compiled, x, argmap, saved)
+                        for x in arg_parts
+                    )
+                    if kind == "T":
+                        # Template transclusion or parser function call
+                        parts.append(self._save_value(kind, new_args, nowiki))
+                    elif kind == "L":
+                        parts.append(self._unexpanded_link(new_args, nowiki))
+                    elif kind == "E":
+                        parts.append(self._unexpanded_extlink(new_args, nowiki))
+                    else:
+                        self.error(
+                            "expand_arg: unsupported cookie kind {!r}".format(
+                                kind
+                            ),
+                            sortid="core/1062",
+                        )
+                        parts.append(
+                            self._save_compiled_cookie(compiled, part, saved)
+                        )
+                return "".join(parts)
+
             def expand_parserfn(fn_name: str, args: Sequence[str]) -> str:
                 if not expand_parserfns:
                     if not args:
@@ -1525,16 +2668,20 @@ class Wtp:
                         )
                         if template_page is not None:
                             body = template_page.body
-                            # XXX optimize by pre-encoding bodies during
-                            # preprocessing
-                            # (Each template is typically used many times)
                             # Determine if the template starts with a list item
                             if body.startswith(("#", "*", ";", ":")):
                                 body = "\n" + body
-                            encoded_body = self._encode(body)
                             # Expand template arguments recursively.
                             # The arguments are already expanded.
-                            encoded_body = expand_args(encoded_body, ht)
+                            compiled = self._get_compiled_body(body)
+                            if compiled is None:
+                                encoded_body = expand_args(
+                                    self._encode(body), ht
+                                )
+                            else:
+                                encoded_body = expand_compiled_args(
+                                    compiled, compiled.parts, ht, {}
+                                )
                             # Expand the body using the calling template/page
                             # as the parent frame for any parserfn calls
                             new_parent = (template_page.title, ht)
@@ -1667,13 +2814,11 @@ class Wtp:
         # print("    _finalize_expand:{!r}".format(text))
         return text
 
-    @lru_cache(maxsize=1000)
-    def get_page(
-        self,
-        title: str,
-        namespace_id: Optional[int] = None,
-        no_redirect: bool = False,
-    ) -> Optional[Page]:
+    def _normalize_title(
+        self, title: str, namespace_id: Optional[int]
+    ) -> Optional[Tuple[str, str]]:
+        """Returns the title with the namespace prefix and its title key, or
+        None if the title is empty."""
         # " " in Lua Module name is replaced by "_" in Wiktionary Lua code
         # when call `require`
         title = title.replace("_", " ")
@@ -1682,63 +2827,95 @@ class Wtp:
         if len(title) == 0:
             return None
 
-        upper_case_title = title  # the first letter is upper case
         if namespace_id is not None and namespace_id != 0:
-            local_ns_name = self.LOCAL_NS_NAME_BY_ID[namespace_id]
-            ns_prefix = local_ns_name + ":"
-            if namespace_id in {
-                self.NAMESPACE_DATA[ns]["id"] for ns in ["Template", "Module"]
-            }:
-                # Chinese Wiktionary and English Wikipedia capitalize the first
-                # letter of template/module page titles but use lower case in
-                # Wikitext and Lua code
-                if title.startswith(ns_prefix):
-                    template_name = title[len(ns_prefix) :]
-                    upper_case_title = (
-                        ns_prefix + template_name[0].upper() + template_name[1:]
-                    )
-                else:
-                    upper_case_title = ns_prefix + title[0].upper() + title[1:]
-                    title = ns_prefix + title
-            elif not title.startswith(ns_prefix):
+            ns_prefix = self.LOCAL_NS_NAME_BY_ID[namespace_id] + ":"
+            if not title.startswith(ns_prefix):
                 # Add namespace prefix
                 title = ns_prefix + title
+        # The first letter is upper case if it's case-insensitive in the
+        # namespace.  This is also the title_key column value of the page.
+        upper_case_title = (
+            title
+            if namespace_id is None
+            else self.title_key(title, namespace_id)
+        )
+        return title, upper_case_title
 
-        query_str = """
-        SELECT title, namespace_id, redirect_to, need_pre_expand, body, model
-        FROM pages
-        WHERE title = ?
-        """
-        query_values = [title]
-        if namespace_id is not None:
-            query_str += " AND namespace_id = ?"
-            query_values.append(namespace_id)
-        if no_redirect:
-            query_str += " AND redirect_to IS NULL"
-        if upper_case_title != title:
-            query_str = query_str + " UNION ALL " + query_str
-            query_values = query_values + [upper_case_title] + query_values[1:]
-
-        query_str += " LIMIT 1"
-        try:
-            for result in self.db_conn.execute(query_str, tuple(query_values)):
-                return Page(
-                    title=result[0],
-                    namespace_id=result[1],
-                    redirect_to=result[2],
-                    need_pre_expand=result[3] == 1,
-                    body=result[4],
-                    model=result[5],
+    def get_page(
+        self,
+        title: str,
+        namespace_id: Optional[int] = None,
+        no_redirect: bool = False,
+        lazy_body: bool = False,
+    ) -> Optional[Page]:
+        """Returns the page with the title, or None if it doesn't exist.  If
+        ``lazy_body`` is True, the body isn't read from the database until
+        it is used, for callers that usually only need the other fields."""
+        cache_key = (title, namespace_id, no_redirect)
+        found, page = self.page_cache.get(cache_key)
+        if found:
+            return page
+        normalized = self._normalize_title(title, namespace_id)
+        if normalized is None:
+            return None
+        title, upper_case_title = normalized
+
+        if self.title_filters is not None and not (
+            self.title_filters.might_exist(namespace_id, (upper_case_title,))
+        ):
+            self.page_cache.put(cache_key, None, (title, upper_case_title))
+            return None
+        if len(self.page_overrides.pages) > 0:
+            page = self.page_overrides.get_page(
+                title, upper_case_title, namespace_id, no_redirect, lazy_body
+            )
+            if page is not None:
+                self.page_cache.put(cache_key, page, (title, upper_case_title))
+                return page
+        if (
+            self.namespace_index is not None
+            and namespace_id in self.namespace_index.pages
+        ):
+            found = self.namespace_index.lookup(
+                namespace_id, title, upper_case_title, no_redirect
+            )
+            if found is not None:
+                found_title, (
+                    redirect_to,
+                    need_pre_expand,
+                    body,
+                    model,
+                    page_id,
+                ) = found
+                page = Page(
+                    title=found_title,
+                    namespace_id=namespace_id,
+                    redirect_to=redirect_to,
+                    need_pre_expand=need_pre_expand,
+                    body=self._page_body(body),
+                    model=model,
+                    page_id=page_id,
                 )
+            self.page_cache.put(cache_key, page, (title, upper_case_title))
+            return page
+
+        self.flush_bulk_rows()
+        try:
+            page = self.page_store.get_page(
+                title, upper_case_title, namespace_id, no_redirect, lazy_body
+            )
         except sqlite3.ProgrammingError as e:
             raise sqlite3.ProgrammingError(
                 f"{' '.join(e.args)}"
                 f" Current database file path: {self.db_path}"
             ) from e
-        return None
+        if page is not None and len(self.pre_expand_overrides) > 0:
+            page = self._with_pre_expand_override(page)
+        self.page_cache.put(cache_key, page, (title, upper_case_title))
+        return page
 
     def page_exists(self, title: str, namespace_id: Optional[int] = 0) -> bool:
-        return self.get_page(title, namespace_id) is not None
+        return self.get_page(title, namespace_id, lazy_body=True) is not None
 
     def get_all_pages(
         self,
@@ -1746,29 +2923,126 @@ class Wtp:
         include_redirects: bool = True,
         model: Optional[str] = None,
         search_pattern: Optional[str] = None,
+        columns: Optional[Iterable[str]] = None,
     ) -> Generator[Page, None, None]:
-        query_str = """
-        SELECT title, namespace_id, redirect_to, need_pre_expand, body, model
-        FROM pages
-        """
+        """Yields the saved pages that match the arguments.  ``columns``
+        selects the ``PAGE_COLUMNS`` fields to read (all by default).  If
+        ``body`` isn't one of them, bodies are read when they are used."""
+        self.flush_bulk_rows()
+        overrides = self.page_overrides.pages
+        if len(overrides) > 0:
+            yield from self.page_overrides.iter_pages(
+                namespace_ids, include_redirects, model, search_pattern
+            )
+        for page in self.page_store.iter_pages(
+            namespace_ids, include_redirects, model, search_pattern, columns
+        ):
+            if (page.title, page.namespace_id) not in overrides:
+                yield self._with_pre_expand_override(page)
+
+    def _shard_rowid_ranges(
+        self, shard: int, num_shards: int, block_size: int, after: int
+    ) -> Iterator[Tuple[int, int]]:
+        """Yields the rowid ranges (start, end] of a shard after the rowid
+        ``after``.  The rowids are split into blocks of ``block_size``
+        rowids that are dealt to the shards in turn, so the shard of a page
+        only depends on its rowid and doesn't change when pages are
+        added."""
+        block = shard
+        if after > 0:
+            # the first block of the shard that ends after the cursor
+            after_block = (after - 1) // block_size
+            block = max(block, after_block + (shard - after_block) % num_shards)
+        while True:
+            (max_rowid,) = self.db_conn.execute(
+                "SELECT ifnull(max(rowid), 0) FROM pages"
+            ).fetchone()
+            if block * block_size >= max_rowid:
+                return
+            yield max(block * block_size, after), (block + 1) * block_size
+            block += num_shards
+
+    def iter_pages(
+        self,
+        shard: int = 0,
+        num_shards: int = 1,
+        after: Optional[int] = None,
+        batch_size: int = 1000,
+        columns: Optional[Iterable[str]] = None,
+        namespace_ids: Optional[List[int]] = None,
+        include_redirects: bool = True,
+        model: Optional[str] = None,
+        shard_block_size: int = SHARD_BLOCK_SIZE,
+    ) -> Iterator[Tuple[int, Page]]:
+        """Yields the cursors and pages of one of ``num_shards`` disjoint
+        shards of the pages table, in rowid order.  Each shard is every
+        ``num_shards``-th block of ``shard_block_size`` rowids, so parallel
+        workers can process their own shard, and a page stays in the same
+        shard when pages are added.  Pages are read ``batch_size`` at a
+        time with keyset pagination, no query stays open between the
+        yielded pages.  To resume after a crash, pass the cursor of the last
+        processed page as ``after``.  ``columns`` selects the
+        ``PAGE_COLUMNS`` fields to read like in ``get_all_pages()``.  The
+        first shard starts with the page overrides, in title order and with
+        negative cursors, and the overridden saved pages are skipped."""
+        if not 0 <= shard < num_shards:
+            raise ValueError(f"Invalid shard {shard} of {num_shards} shards")
+        if shard_block_size < 1:
+            raise ValueError(f"Invalid shard block size {shard_block_size}")
+        self.require_sqlite_store("Iterating pages by rowid")
+        assert isinstance(self.page_store, SQLitePageStore)
+        columns = self.page_store.select_columns(columns)
+        self.flush_bulk_rows()
+        overrides = self.page_overrides.pages
+        if shard == 0 and len(overrides) > 0:
+            keys = sorted(overrides, key=lambda key: (key[0], key[1] or 0))
+            for cursor, key in enumerate(keys, -len(keys)):
+                page = overrides[key]
+                if (after is None or cursor > after) and page_matches(
+                    page, namespace_ids, include_redirects, model, None
+                ):
+                    yield cursor, self._select_page_columns(page, columns)
         where_str, query_values = self.build_sql_where_query(
-            namespace_ids, include_redirects, model, search_pattern
+            namespace_ids, include_redirects, model
+        )
+        query_str = (
+            "SELECT rowid, title, namespace_id"
+            + "".join(", " + column for column in columns)
+            + " FROM pages WHERE rowid > ? AND rowid <= ?"
+            + where_str.replace(" WHERE ", " AND ", 1)
+            + " ORDER BY rowid LIMIT ?"
+        )
+        for last_rowid, end_rowid in self._shard_rowid_ranges(
+            shard, num_shards, shard_block_size, max(after or 0, 0)
+        ):
+            while True:
+                rows = self.db_conn.execute(
+                    query_str,
+                    (last_rowid, end_rowid) + query_values + (batch_size,),
+                ).fetchall()
+                for row in rows:
+                    if (row[1], row[2]) not in overrides:
+                        page = self.page_store.page_from_row(columns, row[1:])
+                        yield row[0], self._with_pre_expand_override(page)
+                if len(rows) < batch_size:
+                    break
+                last_rowid = rows[-1][0]
+
+    @staticmethod
+    def _select_page_columns(page: Page, columns: Iterable[str]) -> Page:
+        """Returns a copy of an in-memory page with the fields of
+        ``columns`` like ``SQLitePageStore.page_from_row()``, the body is
+        always copied."""
+        return Page(
+            title=page.title,
+            namespace_id=page.namespace_id,
+            body=page.body,
+            **{
+                column: getattr(page, column)
+                for column in columns
+                if column in PAGE_COLUMNS and column != "body"
+            },
         )
-        query_str += where_str  # + " ORDER BY title ASC"
-        # Seems that ORDER BY title doesn't actually matter in this case;
-        # for other orderings it does, title just happens to be default
-        # print("Getting all pages for query:"
-        #       f"{query_str=!r}, {placeholders=!r}")
-
-        for result in self.db_conn.execute(query_str, query_values):
-            yield Page(
-                title=result[0],
-                namespace_id=result[1],
-                redirect_to=result[2],
-                need_pre_expand=result[3],
-                body=result[4],
-                model=result[5],
-            )
 
     def check_template_need_expand(
         self,
@@ -1794,13 +3068,198 @@ class Wtp:
     def get_page_resolve_redirect(
         self, title: str, namespace_id: int
     ) -> Optional[Page]:
-        page = self.get_page(title, namespace_id)
-        if page is None:
+        """Returns the page, or the last page of its redirect chain if it is
+        a redirect.  Returns None if the page doesn't exist or its redirect
+        chain is broken or cyclic.  After ``resolve_redirects()`` the page
+        is found with one query, otherwise (or if a page saved later changed
+        the chain) the chain is followed one page at a time."""
+        if (
+            not self.redirect_targets_resolved
+            or not isinstance(self.page_store, SQLitePageStore)
+            or len(self.page_overrides.pages) > 0
+            or (
+                self.namespace_index is not None
+                and namespace_id in self.namespace_index.pages
+            )
+        ):
+            return self._follow_redirects(title, namespace_id)
+
+        cache_key = (title, namespace_id, None)
+        found, page = self.page_cache.get(cache_key)
+        if found:
+            return page
+        normalized = self._normalize_title(title, namespace_id)
+        if normalized is None:
+            return None
+        title, title_key = normalized
+        if self.title_filters is not None and not (
+            self.title_filters.might_exist(namespace_id, (title_key,))
+        ):
+            self.page_cache.put(cache_key, None, (title, title_key))
             return None
-        if page.redirect_to is not None:
-            return self.get_page(page.redirect_to, namespace_id, True)
+
+        # the page found by get_page(), joined to its final target page
+        query_str = """
+        SELECT
+        source.redirect_to IS NOT NULL AND redirect_targets.title IS NULL,
+        target.title, target.namespace_id, target.redirect_to,
+        target.need_pre_expand, target.body, target.model, target.page_id
+        FROM (
+            SELECT title, namespace_id, redirect_to FROM pages
+            WHERE title_key = ? AND namespace_id = ?
+            ORDER BY title = ? DESC, title LIMIT 1
+        ) AS source
+        LEFT JOIN redirect_targets
+        ON redirect_targets.title = source.title
+        AND redirect_targets.namespace_id = source.namespace_id
+        LEFT JOIN pages AS target
+        ON target.namespace_id = source.namespace_id
+        AND target.title = CASE WHEN source.redirect_to IS NULL
+        THEN source.title ELSE redirect_targets.target END
+        """
+        for result in self.db_conn.execute(
+            query_str, (title_key, namespace_id, title)
+        ):
+            if result[0]:
+                # the saved chain was deleted by _invalidate_redirect_targets()
+                return self._follow_redirects(title, namespace_id)
+            if result[1] is not None:
+                page = Page(
+                    title=result[1],
+                    namespace_id=result[2],
+                    redirect_to=result[3],
+                    need_pre_expand=result[4] == 1,
+                    body=self._page_body(result[5]),
+                    model=result[6],
+                    page_id=result[7],
+                )
+        self.page_cache.put(cache_key, page, (title, title_key))
+        return page
+
+    def _follow_redirects(
+        self, title: str, namespace_id: int
+    ) -> Optional[Page]:
+        page = self.get_page(title, namespace_id)
+        visited: Set[str] = set()
+        while page is not None and page.redirect_to is not None:
+            if page.title in visited:
+                return None  # cyclic redirects
+            visited.add(page.title)
+            page = self.get_page(page.redirect_to, namespace_id)
         return page
 
+    def _find_page_title(
+        self, normalized: Tuple[str, str], namespace_id: int
+    ) -> Optional[str]:
+        """Returns the title of the page ``get_page()`` would find with the
+        normalized title and title key, without reading the page."""
+        page = self.page_store.get_page(*normalized, namespace_id, False, True)
+        return None if page is None else page.title
+
+    def resolve_redirects(self) -> RedirectReport:
+        """Follows the redirect chain of every redirect page to its final
+        page and saves the results in the redirect_targets table, for
+        ``get_page_resolve_redirect()``.  Redirect chains that end at a
+        missing page or loop are saved as broken or cyclic.  The title keys
+        looked up in each chain are saved in the redirect_chain_keys table,
+        and the results of the chains that look up the title of a page saved
+        later are deleted, until this is called again.  ``process_dump()``
+        calls this after saving all pages.  Returns the report of
+        ``redirect_report()``."""
+        self.check_writable()
+        self.flush_bulk_rows()
+        redirects: Dict[Tuple[int, str], str] = {
+            (namespace_id, title): redirect_to
+            for title, namespace_id, redirect_to in (
+                self.page_store.iter_redirects()
+            )
+        }
+        # (namespace id, title) -> final page title or None, status
+        results: Dict[Tuple[int, str], Tuple[Optional[str], int]] = {}
+        # (namespace id, title) -> title keys looked up in the chain
+        chain_keys: Dict[Tuple[int, str], List[str]] = {}
+        for start in redirects:
+            if start in results:
+                continue
+            namespace_id = start[0]
+            chain = [start]
+            # title keys looked up from each page of the chain
+            lookups: List[str] = []
+            tail: List[str] = []
+            cycle_start = len(redirects)
+            while True:
+                normalized = self._normalize_title(
+                    redirects[chain[-1]], namespace_id
+                )
+                found_title = None
+                if normalized is not None:
+                    lookups.append(normalized[1])
+                    found_title = self._find_page_title(
+                        normalized, namespace_id
+                    )
+                if found_title is None:
+                    result: Tuple[Optional[str], int] = (None, REDIRECT_BROKEN)
+                    break
+                found = (namespace_id, found_title)
+                if found in results:
+                    result = results[found]
+                    tail = chain_keys[found]
+                    break
+                if found not in redirects:
+                    result = (found_title, REDIRECT_RESOLVED)
+                    break
+                if found in chain:
+                    result = (None, REDIRECT_CYCLE)
+                    cycle_start = chain.index(found)
+                    break
+                chain.append(found)
+            for i, redirect in enumerate(chain):
+                results[redirect] = result
+                chain_keys[redirect] = lookups[min(i, cycle_start) :] + tail
+
+        self.db_conn.execute("DELETE FROM redirect_targets")
+        self.db_conn.execute("DELETE FROM redirect_chain_keys")
+        self.db_conn.executemany(
+            "INSERT INTO redirect_targets VALUES (?, ?, ?, ?)",
+            (
+                (title, namespace_id, target, status)
+                for (namespace_id, title), (target, status) in results.items()
+            ),
+        )
+        self.db_conn.executemany(
+            "INSERT OR IGNORE INTO redirect_chain_keys VALUES (?, ?, ?)",
+            (
+                (title_key, namespace_id, title)
+                for (namespace_id, title), title_keys in chain_keys.items()
+                for title_key in title_keys
+            ),
+        )
+        self.db_conn.commit()
+        self.redirect_targets_resolved = len(results) > 0
+        self.page_cache.clear()
+        report = self.redirect_report()
+        logging.info(
+            f"Resolved {report.resolved} redirects, found "
+            f"{len(report.broken)} broken and {len(report.cyclic)} cyclic "
+            "redirect chains"
+        )
+        return report
+
+    def redirect_report(self) -> RedirectReport:
+        """Returns the redirect pages whose chain is broken or cyclic, from
+        the results of the last ``resolve_redirects()`` call."""
+        report = RedirectReport()
+        for title, namespace_id, status in self.db_conn.execute(
+            "SELECT title, namespace_id, status FROM redirect_targets"
+        ):
+            if status == REDIRECT_RESOLVED:
+                report.resolved += 1
+            elif status == REDIRECT_BROKEN:
+                report.broken.append((title, namespace_id))
+            else:
+                report.cyclic.append((title, namespace_id))
+        return report
+
     def get_page_body(self, title: str, namespace_id: int) -> Optional[str]:
         page = self.get_page_resolve_redirect(title, namespace_id)
         return None if page is None else page.body
@@ -1910,12 +3369,17 @@ class Wtp:
 
 
 def is_chinese_subtitle_template(wtp: Wtp, title: str) -> bool:
+    template_ns = wtp.NAMESPACE_DATA.get("Template", {"name": None})
+    return is_chinese_subtitle_title(title, template_ns.get("name"))
+
+
+def is_chinese_subtitle_title(
+    title: str, template_ns_local_name: Optional[str]
+) -> bool:
     # Chinese Wiktionary uses templates for language and POS headings
     # Language templates: https://zh.wiktionary.org/wiki/Category:语言模板
     # POS templates: https://zh.wiktionary.org/wiki/Category:詞類模板
     # and their titles are usually starts with "-" or "="
-    template_ns = wtp.NAMESPACE_DATA.get("Template", {"name": None})
-    template_ns_local_name = template_ns.get("name")
     if template_ns_local_name:
         title_no_prefix = title.removeprefix(template_ns_local_name + ":")
     else:
@@ -1926,3 +3390,180 @@ def is_chinese_subtitle_template(wtp: Wtp, title: str) -> bool:
         ):
             return True
     return False
+
+
+def analyze_template(
+    name: str, body: str, lang_code: str, template_ns_local_name: Optional[str]
+) -> Tuple[Set[str], bool]:
+    """Analyzes a template body and returns a set of the canonicalized
+    names of all other templates it calls and a boolean that is True
+    if it should be pre-expanded before final parsing and False if it
+    need not be pre-expanded.  The pre-expanded flag is determined
+    based on that body only; the caller should propagate it to
+    templates that include the given template.  This does not work for
+    template and template function calls where the name is generated by
+    other expansions.  This doesn't depend on the ``Wtp`` object so that
+    it can be called in worker processes."""
+    included_templates: Set[str] = set()
+    pre_expand = False
+
+    # Determine if the template starts with a list item
+    # XXX should we expand other templates that produce list items???
+    contains_list = body.startswith(("#", "*", ";", ":"))
+
+    # Remove paired tables.
+    # What is left is unpaired tables, which is an indication that a
+    # template somewhere should be generating those table eventually,
+    # and thus needs to be pre-expanded.
+    table_start_pos = []
+    table_end_pos = []
+    # `[[wikt:/|}]]` in Template:Mon standard keyboard
+    # and `{{l|mul|} }}` in Template:punctuation are not end of table token
+    # but `|}]]` in Template:Lithuania map is a table
+    for m in re.finditer(
+        r"""
+        \{\|(?<!\{\{\|)  # `{|` not after `{`, like `{{{|}}}`
+        |
+        \|}(?!\s*})  # `|}` not before ` }`
+        """,
+        body,
+        re.VERBOSE,
+    ):
+        if m.group() == "{|":
+            table_start_pos.append(m.start())
+        else:
+            table_end_pos.append(m.end())
+    num_table_start = len(table_start_pos)
+    num_table_end = len(table_end_pos)
+    contains_unpaired_table = num_table_start != num_table_end
+    table_start = len(body)
+    table_end = table_start
+    if num_table_start > num_table_end and num_table_end > 0:
+        table_start = table_start_pos[num_table_start - num_table_end - 1]
+        table_end = table_end_pos[-1]
+    elif num_table_start < num_table_end and num_table_start > 0:
+        table_start = table_start_pos[0]
+        table_end = table_end_pos[num_table_start]
+    elif num_table_start > 0 and num_table_end > 0:
+        table_start = table_start_pos[0]
+        table_end = table_end_pos[-1]
+    unpaired_text = body[:table_start] + body[table_end:]
+
+    # Determine if the template contains table element tokens
+    # outside paired table start/end.  We only try to look for
+    # these outside templates, as it is common to write each
+    # template argument on its own line starting with a "|".
+    outside = remove_templates(unpaired_text)
+    # Check if the template contains certain table elements
+    # start of line plus |+, |- or |!
+    m = re.search(r"(?s)(^|\n)(\|\+|\|-|\!)", outside)
+    m2 = re.match(r"(?si)\s*(<includeonly>|<!--.*?-->)(\|\||!!)", outside)
+    contains_table_element = m is not None or m2 is not None
+    # if contains_table_element:
+    #     print("contains_table_element {!r} at {}"
+    #           .format(m.group(0), m.start()))
+    #     print("... {!r} ...".format(outside[m.start() - 10:m.end() + 10]))
+    #     print(repr(outside))
+
+    # Check for unpaired HTML tags
+    tag_cnts: DefaultDict[str, int] = defaultdict(int)
+    for m in re.finditer(
+        r"(?si)<(/)?({})\b\s*[^>]*(/)?>"
+        r"".format("|".join(PAIRED_HTML_TAGS)),
+        outside,
+    ):
+        start_slash = m.group(1)
+        tagname = m.group(2)
+        end_slash = m.group(3)
+        if start_slash:
+            tag_cnts[tagname] -= 1
+        elif not end_slash:
+            tag_cnts[tagname] += 1
+    contains_unbalanced_html = any(v != 0 for v in tag_cnts.values())
+    # if contains_unbalanced_html:
+    #     print(name, "UNBALANCED HTML")
+    #     for k, v in tag_cnts.items():
+    #         if v != 0:
+    #             print("  {} {}".format(v, k))
+
+    # if pre_expand:
+    #     print(name,
+    #           {"list": contains_list,
+    #            "unpaired_table": contains_unpaired_table,
+    #            "table_element": contains_table_element,
+    #            "unbalanced_html": contains_unbalanced_html,
+    #            "pre_expand": pre_expand,
+    #     })
+
+    # Determine which other templates are called from unpaired text.
+    # None of the flags we currently gather propagate outside a paired
+    # table start/end.
+    included_templates.update(template_names(unpaired_text))
+
+    # Chinese Wiktionary language and POS subtitle template
+    # uses "langhd" template, "langhd" redirects to "語言標題"
+    is_chinese_heading = lang_code == "zh" and (
+        len({"langhd", "語言標題", "语言标题"} & included_templates) > 0
+        or is_chinese_subtitle_title(name, template_ns_local_name)
+    )
+
+    # Determine whether this template should be pre-expanded
+    pre_expand = (
+        contains_list
+        or contains_unpaired_table
+        or contains_table_element
+        or contains_unbalanced_html
+        or is_chinese_heading
+    )
+
+    return included_templates, pre_expand
+
+
+def analyze_template_batch(
+    batch: List[Tuple[str, str]],
+    lang_code: str,
+    template_ns_local_name: Optional[str],
+) -> List[Tuple[str, Set[str], bool]]:
+    """Analyzes a batch of (title, body) pairs of templates, in a worker
+    process of ``Wtp.analyze_templates()``."""
+    results = []
+    for title, body in batch:
+        included_templates, pre_expand = analyze_template(
+            title, body, lang_code, template_ns_local_name
+        )
+        results.append((title, included_templates, pre_expand))
+    return results
+
+
+def template_to_body(text: str) -> str:
+    """Extracts the portion to be transcluded from a template body.  This
+    doesn't depend on the context and can be called from worker processes
+    that parse dump files."""
+    # Remove all comments
+    text = re.sub(r"(?s)<!--.*?-->", "", text)
+    # Remove all text inside <noinclude> ... </noinclude>
+    text = re.sub(r"(?is)<noinclude\s*>.*?</noinclude\s*>", "", text)
+    # Handle <noinclude> without matching </noinclude> by removing the
+    # rest of the file.  <noinclude/> is handled specially elsewhere, as
+    # it appears to be used as a kludge to prevent normal interpretation
+    # of e.g. [[ ... ]] by placing it between the brackets.
+    text = re.sub(r"(?is)<noinclude\s*>.*", "", text)
+    # Apparently unclosed <!-- at the end of a template body is ignored
+    text = re.sub(r"(?s)<!--.*", "", text)
+    # <onlyinclude> tags, if present, include the only text that will be
+    # transcluded.  All other text is ignored.
+    onlys = list(
+        re.finditer(
+            r"(?is)<onlyinclude\s*>(.*?)"
+            r"</onlyinclude\s*>|"
+            r"<onlyinclude\s*/>",
+            text,
+        )
+    )
+    if onlys:
+        text = "".join(m.group(1) or "" for m in onlys)
+    # Remove <includeonly>.  They mark text that is not visible on the page
+    # itself but is included in transclusion.  Also text outside these tags
+    # is included in transclusion.
+    text = re.sub(r"(?is)<\s*(/\s*)?includeonly\s*(/\s*)?>", "", text)
+    return text
@@ -2,157 +2,921 @@
 #
 # Copyright (c) 2018-2022 Tatu Ylonen.  See file LICENSE and https://ylonen.org
 
+import bz2
+import gzip
 import hashlib
+import io
+import itertools
 import json
 import logging
+import lzma
+import multiprocessing
 import os
+import queue
+import re
 import shutil
 import subprocess
 import sys
+import threading
 import unicodedata
+from contextlib import ExitStack, closing, contextmanager
+from dataclasses import dataclass, field
+from functools import partial
 from pathlib import Path
-from typing import TYPE_CHECKING, List, Optional, Set
+from typing import (
+    TYPE_CHECKING,
+    BinaryIO,
+    Callable,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+
+from .common import imap_bounded
+from .core import template_to_body
 
 if TYPE_CHECKING:
+    from lxml import etree
+
     from .core import Wtp
 
 
-def decompress_dump_file(dump_path: str) -> subprocess.Popen:
-    if dump_path.endswith(".bz2"):
-        decompress_command = (
-            "lbzcat" if shutil.which("lbzcat") is not None else "bzcat"
-        )
-        p = subprocess.Popen(
-            [decompress_command, dump_path], stdout=subprocess.PIPE
-        )
-        if p.stdout is not None:
-            return p
+# A path, "-" for standard input or a binary file object
+DumpSource = Union[str, Path, BinaryIO]
+
+
+@dataclass
+class DumpCodec:
+    name: str
+    magic: bytes  # the first bytes of a compressed file
+    # Commands that decompress the file given as the last argument or from
+    # standard input to standard output.  The first installed command is
+    # used, otherwise the file is decompressed with ``open_fn`` in this
+    # process.
+    commands: List[List[str]] = field(default_factory=list)
+    open_fn: Optional[Callable[[BinaryIO], BinaryIO]] = None
+
+
+DUMP_CODECS: List[DumpCodec] = [
+    DumpCodec(
+        "bzip2",
+        b"BZh",
+        # lbzip2 and pbzip2 decompress in parallel
+        [["lbzcat"], ["pbzip2", "-dc"], ["bzcat"]],
+        lambda f: bz2.open(f, "rb"),
+    ),
+    DumpCodec("gzip", b"\x1f\x8b", [], lambda f: gzip.open(f, "rb")),
+    DumpCodec("xz", b"\xfd7zXZ\x00", [], lambda f: lzma.open(f, "rb")),
+    DumpCodec("zstd", b"\x28\xb5\x2f\xfd", [["zstd", "-dcq"]]),
+]
+
+
+def register_dump_codec(codec: DumpCodec) -> None:
+    """Adds a dump file compression format, it takes precedence over the
+    built-in formats with the same magic bytes."""
+    DUMP_CODECS.insert(0, codec)
+
+
+def detect_dump_codec(magic: bytes) -> Optional[DumpCodec]:
+    """Returns the codec of a compressed dump file from its first bytes, or
+    None for an uncompressed XML file."""
+    for codec in DUMP_CODECS:
+        if magic.startswith(codec.magic):
+            return codec
+    if magic.lstrip(b"\xef\xbb\xbf \t\r\n").startswith(b"<"):
+        return None
+    raise ValueError(f"Unknown dump file format, first bytes: {magic!r}")
+
+
+class _PrefixedReader(io.RawIOBase):
+    """Reader that returns the bytes already read from a stream to detect its
+    format, followed by the rest of the stream."""
+
+    def __init__(self, prefix: bytes, f: BinaryIO) -> None:
+        self.prefix = prefix
+        self.f = f
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        if len(self.prefix) > 0:
+            n = min(len(buffer), len(self.prefix))
+            buffer[:n] = self.prefix[:n]
+            self.prefix = self.prefix[n:]
+            return n
+        data = self.f.read(len(buffer))
+        buffer[: len(data)] = data
+        return len(data)
+
+
+@contextmanager
+def _decompress_in_subprocess(
+    command: List[str], path: Optional[Path], f: BinaryIO
+) -> Iterator[BinaryIO]:
+    """Runs a decompression command.  Files are passed by path so that
+    the command can read them itself, other streams are copied to its
+    standard input in a thread."""
+    p = subprocess.Popen(
+        command if path is None else command + [str(path)],
+        stdin=subprocess.PIPE if path is None else subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+    )
+    assert p.stdout is not None
+    feeder = None
+    if path is None:
+
+        def feed_stdin() -> None:
+            assert p.stdin is not None
+            try:
+                shutil.copyfileobj(f, p.stdin)
+            except BrokenPipeError:  # the command was killed
+                pass
+            finally:
+                p.stdin.close()
+
+        feeder = threading.Thread(target=feed_stdin, name=command[0])
+        feeder.start()
+    try:
+        yield p.stdout  # type: ignore[misc]
+    except BaseException:
+        p.kill()
+        raise
+    finally:
+        p.stdout.close()
+        p.wait()
+        if feeder is not None:
+            feeder.join()
+    if p.returncode != 0:
+        raise subprocess.CalledProcessError(p.returncode, p.args)
+
+
+@contextmanager
+def open_dump_file(dump: DumpSource) -> Iterator[BinaryIO]:
+    """Opens a dump file for reading the decompressed XML.  ``dump`` can be a
+    path, "-" for standard input or a binary file object.  The compression
+    format is detected from the first bytes of the file (see
+    ``DUMP_CODECS``)."""
+    with ExitStack() as stack:
+        path: Optional[Path] = None
+        if isinstance(dump, (str, Path)) and str(dump) == "-":
+            f: BinaryIO = sys.stdin.buffer
+        elif isinstance(dump, (str, Path)):
+            path = Path(dump)
+            f = stack.enter_context(path.open("rb"))
+        else:
+            f = dump
+        magic = f.read(max(len(codec.magic) for codec in DUMP_CODECS))
+        if path is not None:
+            f.seek(0)
         else:
-            raise Exception(f"No stdout from command {decompress_command}")
+            f = io.BufferedReader(_PrefixedReader(magic, f))  # type: ignore
+        codec = detect_dump_codec(magic)
+        if codec is None:
+            yield f
+            return
+        for command in codec.commands:
+            if shutil.which(command[0]) is not None:
+                yield stack.enter_context(
+                    _decompress_in_subprocess(command, path, f)
+                )
+                return
+        if codec.open_fn is None:
+            raise ValueError(
+                f"Can't decompress {codec.name} dump file, install one of "
+                "these commands: "
+                + ", ".join(command[0] for command in codec.commands)
+            )
+        yield stack.enter_context(codec.open_fn(f))
+
+
+MEDIAWIKI_XML_NAMESPACE = "http://www.mediawiki.org/xml/export-0.10/"
+
+# title, namespace id, body, redirect_to, model, page id, revision id,
+# revision text SHA-1
+PageRow = Tuple[
+    str,
+    int,
+    Optional[str],
+    Optional[str],
+    str,
+    Optional[int],
+    Optional[int],
+    Optional[str],
+]
+
+def parse_page_element(
+    page_element: "etree._Element",
+    namespace_ids: Set[int],
+    xml_namespace: str,
+    template_ns_id: Optional[int],
+) -> Optional[PageRow]:
+    """Converts a <page> element to a row for the pages table, or returns
+    None if the page should not be saved.  Template bodies are reduced to
+    their transcluded part here, so that this work is also done in the
+    worker processes when parsing multistream dump files."""
+    namespaces = {None: xml_namespace}
+    title = page_element.findtext("title", "", namespaces)
+    namespace_id = int(page_element.findtext("ns", "0", namespaces))
+    if (
+        namespace_id not in namespace_ids
+        or title.endswith("/documentation")
+        or "/testcases" in title
+    ):
+        return None
+
+    text: Optional[str] = None
+    redirect_to: Optional[str] = None
+    model = page_element.findtext("revision/model", "", namespaces)
+    if (
+        redirect_element := page_element.find("redirect", namespaces=namespaces)
+    ) is not None:
+        redirect_to = redirect_element.get("title", "")
+        # redirect_to existing implies a redirection, but having a
+        # .get default to "" is a bit weird: redirect to empty string?
+        # But you can't use None either..?
     else:
-        raise ValueError("Dump file extension is not .bz2")
+        if model not in {"wikitext", "Scribunto", "json"}:
+            # ignore css, javascript and sanitized-css pages
+            return None
+        text = page_element.findtext("revision/text", "", namespaces)
+        if namespace_id == template_ns_id:
+            text = template_to_body(text)
+
+    page_id = page_element.findtext("id", None, namespaces)
+    revision_id = page_element.findtext("revision/id", None, namespaces)
+    return (
+        title,
+        namespace_id,
+        text,
+        redirect_to,
+        model,
+        int(page_id) if page_id else None,
+        int(revision_id) if revision_id else None,
+        page_element.findtext("revision/sha1", None, namespaces),
+    )
+
+
+def get_xml_namespace(header: bytes) -> str:
+    """Returns the XML namespace of the <mediawiki> root element in the
+    beginning of a dump file."""
+    m = re.search(rb'xmlns="([^"]+)"', header)
+    return m.group(1).decode() if m is not None else MEDIAWIKI_XML_NAMESPACE
+
+
+def get_first_letter_namespaces(header: bytes) -> Optional[Set[int]]:
+    """Returns the ids of the namespaces whose page titles are
+    case-insensitive in the first letter, from the <siteinfo> element in the
+    beginning of a dump file.  Returns None if the header doesn't list the
+    namespaces."""
+    if b"<namespaces" not in header:
+        return None
+    m = re.search(rb"<case>([^<]*)</case>", header)
+    site_case = m.group(1).strip() if m is not None else b"first-letter"
+    namespace_ids = set()
+    for m in re.finditer(rb"<namespace\b([^>]*)>", header):
+        attrs = dict(re.findall(rb'(\w+)="([^"]*)"', m.group(1)))
+        if b"key" in attrs and attrs.get(b"case", site_case) == b"first-letter":
+            namespace_ids.add(int(attrs[b"key"]))
+    return namespace_ids
 
 
-def parse_dump_xml(ctx: "Wtp", dump_path: str, namespace_ids: Set[int]) -> None:
+def read_dump_header(ctx: "Wtp", header: bytes) -> str:
+    """Saves the title case rules of the dump file's namespaces and returns
+    the XML namespace of the dump."""
+    first_letter_namespaces = get_first_letter_namespaces(header)
+    if first_letter_namespaces is not None:
+        ctx.set_first_letter_namespaces(first_letter_namespaces)
+    return get_xml_namespace(header)
+
+
+def parse_pages_xml(
+    data: bytes,
+    namespace_ids: Set[int],
+    xml_namespace: str,
+    template_ns_id: Optional[int],
+) -> List[PageRow]:
+    """Parses a chunk of consecutive <page> elements cut from a dump file."""
     from lxml import etree
 
-    with decompress_dump_file(dump_path) as p:
-        namespace_str = "http://www.mediawiki.org/xml/export-0.10/"
-        namespaces = {None: namespace_str}
-        page_nums = 0
-        for _, page_element in etree.iterparse(
-            p.stdout, tag=f"{{{namespace_str}}}page"
-        ):
-            title = page_element.findtext("title", "", namespaces)
-            namespace_id = int(page_element.findtext("ns", "0", namespaces))
-            if (
-                namespace_id not in namespace_ids
-                or title.endswith("/documentation")
-                or "/testcases" in title
-            ):
-                page_element.clear(keep_tail=True)
+    # The chunk doesn't contain the root element, so the pages wouldn't be
+    # in the MediaWiki export namespace without this wrapper element.
+    root = etree.fromstring(
+        b'<mediawiki xmlns="'
+        + xml_namespace.encode()
+        + b'">'
+        + data
+        + b"</mediawiki>",
+        parser=etree.XMLParser(huge_tree=True),
+    )
+    rows = []
+    for page_element in root.iterchildren(f"{{{xml_namespace}}}page"):
+        row = parse_page_element(
+            page_element, namespace_ids, xml_namespace, template_ns_id
+        )
+        if row is not None:
+            rows.append(row)
+    return rows
+
+
+def iter_page_chunks(
+    f: BinaryIO, pages_per_chunk: int = 100, read_size: int = 1024 * 1024
+) -> Iterator[bytes]:
+    """Splits an uncompressed dump file into chunks of ``pages_per_chunk``
+    <page> elements without parsing the XML.  The first yielded chunk is the
+    header before the first page (the <mediawiki> start tag and
+    <siteinfo>).  Text content can't contain "<" characters in XML, so
+    the page tags can be found with a plain byte search."""
+    buffer = bytearray()
+    in_header = True
+    search_pos = 0
+    pages_end = 0  # end of the last complete page in the buffer
+    pages = 0
+    while True:
+        data = f.read(read_size)
+        buffer += data
+        if in_header:
+            pos = buffer.find(b"<page>")
+            if pos < 0:
+                if len(data) == 0:
+                    yield bytes(buffer)
+                    return
                 continue
+            yield bytes(buffer[:pos])
+            del buffer[:pos]
+            in_header = False
+        while (end := buffer.find(b"</page>", search_pos)) >= 0:
+            search_pos = pages_end = end + len(b"</page>")
+            pages += 1
+            if pages == pages_per_chunk:
+                yield bytes(buffer[:pages_end])
+                del buffer[:pages_end]
+                search_pos = pages_end = pages = 0
+        if len(data) == 0:
+            if pages > 0:
+                yield bytes(buffer[:pages_end])
+            return
+        # the end tag could be split between reads
+        search_pos = max(search_pos, len(buffer) - len(b"</page>") + 1)
+
+
+@dataclass
+class PageChanges:
+    """Result of an incremental update of the pages database from a newer
+    dump file.  Pages whose revision text has the same SHA-1 as the saved
+    page are skipped."""
+
+    changed_titles: Set[str] = field(default_factory=set)  # new or changed
+    deleted_titles: Set[str] = field(default_factory=set)
+    unchanged_pages: int = 0
+
+    def start(self, ctx: "Wtp") -> None:
+        ctx.require_sqlite_store("Incremental dump updates")
+        # Keys of all pages in the dump file, for finding deleted pages.
+        # Not a TEMP table: changing the "temp_store" setting in
+        # ``Wtp.bulk_load()`` deletes TEMP tables.
+        ctx.db_conn.execute(
+            """CREATE TABLE IF NOT EXISTS dump_pages (
+            title TEXT,
+            namespace_id INTEGER,
+            PRIMARY KEY(title, namespace_id)) WITHOUT ROWID"""
+        )
+        ctx.db_conn.execute("DELETE FROM dump_pages")
+
+    def is_changed(self, ctx: "Wtp", row: PageRow) -> bool:
+        title, namespace_id, *_, sha1 = row
+        ctx.db_conn.execute(
+            "INSERT OR IGNORE INTO dump_pages VALUES (?, ?)",
+            (title, namespace_id),
+        )
+        for (saved_sha1,) in ctx.db_conn.execute(
+            "SELECT sha1 FROM pages WHERE title = ? AND namespace_id = ?",
+            (title, namespace_id),
+        ):
+            if sha1 is not None and saved_sha1 == sha1:
+                self.unchanged_pages += 1
+                return False
+        self.changed_titles.add(title)
+        return True
+
+    def finish(
+        self, ctx: "Wtp", namespace_ids: Set[int], delete_missing_pages: bool
+    ) -> None:
+        """If ``delete_missing_pages`` is True, deletes the pages of the parsed
+        namespaces that are not in the dump file.  Pages without page id
+        weren't added from a dump file (e.g. the pages added in
+        ``process_dump()``) and are kept."""
+        ctx.flush_bulk_rows()
+        if delete_missing_pages:
+            query_str = f"""
+            FROM pages
+            WHERE page_id IS NOT NULL
+            AND namespace_id IN ({','.join('?' * len(namespace_ids))})
+            AND NOT EXISTS (
+              SELECT 1 FROM dump_pages
+              WHERE dump_pages.title = pages.title
+              AND dump_pages.namespace_id = pages.namespace_id
+            )
+            """
+            query_values = tuple(namespace_ids)
+            deleted_keys = ctx.db_conn.execute(
+                "SELECT title, namespace_id " + query_str, query_values
+            ).fetchall()
+            self.deleted_titles.update(title for title, _ in deleted_keys)
+            if ctx.has_search_index:
+                ctx.page_store.delete_from_search_index(deleted_keys)
+            ctx.db_conn.execute("DELETE " + query_str, query_values)
+            ctx.clear_page_caches()
+        ctx.db_conn.execute("DROP TABLE dump_pages")
+        ctx.db_conn.commit()
+        logging.info(
+            f"{len(self.changed_titles)} pages changed, "
+            f"{len(self.deleted_titles)} pages deleted, "
+            f"{self.unchanged_pages} pages unchanged"
+        )
+
+
+# Number of saved pages between dump parsing checkpoints
+CHECKPOINT_PAGES = 10000
+
 
-            text: Optional[str] = None
-            redirect_to: Optional[str] = None
-            model = page_element.findtext("revision/model", "", namespaces)
-            if (
-                redirect_element := page_element.find(
-                    "redirect", namespaces=namespaces
+@dataclass
+class DumpCheckpoint:
+    """Progress of parsing a dump file.  It is saved to the database in the
+    same transaction as the pages, so ``process_dump(resume=True)`` can
+    continue from it after the process was killed.  ``position`` is the
+    number of parsed bz2 streams of a multistream dump file, or the number of
+    parsed page chunks of other dump files."""
+
+    dump_name: str
+    position: int = 0
+    pages_collected: int = 0
+    last_title: Optional[str] = None
+    saved_pages: int = 0
+
+    @classmethod
+    def start(
+        cls, ctx: "Wtp", dump_name: str, resume: bool
+    ) -> "DumpCheckpoint":
+        """Returns the saved checkpoint if ``resume`` is True, or a
+        checkpoint at the beginning of the dump file."""
+        ctx.db_conn.execute(
+            """CREATE TABLE IF NOT EXISTS dump_checkpoint (
+            dump_name TEXT,
+            position INTEGER,
+            pages_collected INTEGER,
+            last_title TEXT)"""
+        )
+        if not resume:
+            ctx.db_conn.execute("DELETE FROM dump_checkpoint")
+        for saved_name, position, pages_collected, last_title in (
+            ctx.db_conn.execute(
+                """SELECT dump_name, position, pages_collected, last_title
+                FROM dump_checkpoint"""
+            )
+        ):
+            if saved_name != dump_name:
+                raise ValueError(
+                    f"The database has a checkpoint of dump file {saved_name}"
+                    f", not {dump_name}"
                 )
-            ) is not None:
-                redirect_to = redirect_element.get("title", "")
-                # redirect_to existing implies a redirection, but having a
-                # .get default to "" is a bit weird: redirect to empty string?
-                # But you can't use None either..?
-            else:
-                if model not in {"wikitext", "Scribunto", "json"}:
-                    # ignore css, javascript and sanitized-css pages
-                    page_element.clear(keep_tail=True)
-                    continue
-                text = page_element.findtext("revision/text", "", namespaces)
-
-            ctx.add_page(
-                title,
-                namespace_id,
-                body=text,
-                redirect_to=redirect_to,
-                model=model,
+            logging.info(
+                f"Resuming dump file {dump_name} after page {last_title}, "
+                f"{pages_collected} pages were collected"
             )
-            page_element.clear(keep_tail=True)
-            page_nums += 1
-            if page_nums % 10000 == 0:
-                logging.info(f"  ... {page_nums} raw pages collected")
+            return cls(
+                dump_name,
+                position,
+                pages_collected,
+                last_title,
+                saved_pages=pages_collected,
+            )
+        if resume:
+            logging.info(f"No checkpoint of dump file {dump_name} to resume")
+        return cls(dump_name)
+
+    def update(self, ctx: "Wtp", rows: List[PageRow]) -> None:
+        """Called by the database writer thread after the page rows of the
+        next stream or chunk are added."""
+        self.position += 1
+        self.pages_collected += len(rows)
+        if len(rows) > 0:
+            self.last_title = rows[-1][0]
+        if self.pages_collected - self.saved_pages >= CHECKPOINT_PAGES:
+            self.save(ctx)
+
+    def save(self, ctx: "Wtp") -> None:
+        ctx.db_conn.execute("DELETE FROM dump_checkpoint")
+        ctx.db_conn.execute(
+            "INSERT INTO dump_checkpoint VALUES (?, ?, ?, ?)",
+            (
+                self.dump_name,
+                self.position,
+                self.pages_collected,
+                self.last_title,
+            ),
+        )
+        # commits the checkpoint with the buffered pages
+        ctx.flush_bulk_rows()
+        ctx.db_conn.commit()
+        self.saved_pages = self.pages_collected
+
+    def clear(self, ctx: "Wtp") -> None:
+        ctx.db_conn.execute("DELETE FROM dump_checkpoint")
+        ctx.db_conn.commit()
+
+
+def save_page_rows(
+    ctx: "Wtp",
+    row_batches: Iterable[List[PageRow]],
+    changes: Optional[PageChanges] = None,
+    checkpoint: Optional[DumpCheckpoint] = None,
+    queue_size: int = 64,
+) -> None:
+    """Saves the page rows to the database in a dedicated writer thread,
+    which is the only thread using the database connection until this
+    returns.  Iterating ``row_batches`` (parsing the dump file) continues in
+    the calling thread; the bounded queue between the two stops parsing
+    when the writer falls behind.  If ``changes`` is given, only new and
+    changed pages are saved and their titles are collected.  Each item of
+    ``row_batches`` advances ``checkpoint`` by one position."""
+    rows_queue: "queue.Queue[Optional[List[PageRow]]]" = queue.Queue(
+        queue_size
+    )
+    errors: List[BaseException] = []
+
+    def writer() -> None:
+        page_nums = checkpoint.pages_collected if checkpoint else 0
+        finished = False
+        try:
+            with ctx.bulk_load():
+                while (rows := rows_queue.get()) is not None:
+                    for row in rows:
+                        if changes is not None and not changes.is_changed(
+                            ctx, row
+                        ):
+                            continue
+                        (
+                            title,
+                            namespace_id,
+                            text,
+                            redirect_to,
+                            model,
+                            page_id,
+                            revision_id,
+                            sha1,
+                        ) = row
+                        ctx._insert_page(
+                            title,
+                            namespace_id,
+                            text,
+                            redirect_to,
+                            False,
+                            model,
+                            page_id,
+                            revision_id,
+                            sha1,
+                        )
+                        page_nums += 1
+                        if page_nums % 10000 == 0:
+                            logging.info(
+                                f"  ... {page_nums} raw pages collected"
+                            )
+                    if checkpoint is not None:
+                        checkpoint.update(ctx, rows)
+                finished = True
+        except BaseException as e:
+            errors.append(e)
+            # don't block the parsing thread
+            while not finished and rows_queue.get() is not None:
+                pass
+
+    writer_thread = threading.Thread(target=writer, name="dump page writer")
+    writer_thread.start()
+    try:
+        for rows in row_batches:
+            rows_queue.put(rows)
+            if len(errors) > 0:
+                break
+    finally:
+        rows_queue.put(None)
+        writer_thread.join()
+    if len(errors) > 0:
+        raise errors[0]
+
+
+def parse_dump_xml(
+    ctx: "Wtp",
+    dump_path: DumpSource,
+    namespace_ids: Set[int],
+    num_processes: Optional[int] = None,
+    changes: Optional[PageChanges] = None,
+    checkpoint: Optional[DumpCheckpoint] = None,
+) -> None:
+    """Parses a single stream dump file as a pipeline of three stages:
+    decompression (usually in a subprocess, see ``open_dump_file()``),
+    ``num_processes`` worker processes (defaults to the number of CPUs) that
+    parse chunks of <page> elements, and the database writer thread.  The
+    file can't be seeked, so resuming from ``checkpoint`` decompresses the
+    file from the beginning but skips the already saved chunks without
+    parsing them."""
+    template_ns_id = ctx.NAMESPACE_DATA["Template"]["id"]
+    num_processes = num_processes or os.cpu_count() or 1
+    with open_dump_file(dump_path) as f:
+        chunks = iter_page_chunks(f)
+        xml_namespace = read_dump_header(ctx, next(chunks, b""))
+        if checkpoint is not None and checkpoint.position > 0:
+            chunks = itertools.islice(chunks, checkpoint.position, None)
+        with multiprocessing.Pool(num_processes) as pool, closing(
+            imap_bounded(
+                pool,
+                partial(
+                    parse_pages_xml,
+                    namespace_ids=namespace_ids,
+                    xml_namespace=xml_namespace,
+                    template_ns_id=template_ns_id,
+                ),
+                chunks,
+                num_processes * 4,
+            )
+        ) as row_batches:
+            save_page_rows(ctx, row_batches, changes, checkpoint)
+
+
+def get_multistream_index_path(dump_path: str) -> Optional[str]:
+    """Returns the path of the index file that is published next to a
+    "<project>-<date>-pages-articles-multistream.xml.bz2" dump file, or
+    None if there is no such file."""
+    if not dump_path.endswith("-multistream.xml.bz2"):
+        return None
+    index_path = dump_path.removesuffix(".xml.bz2") + "-index.txt.bz2"
+    return index_path if os.path.exists(index_path) else None
+
+
+def read_multistream_offsets(index_path: str) -> List[int]:
+    """Reads the "<offset>:<page id>:<title>" lines of a multistream index
+    file and returns the sorted byte offsets of the bz2 streams that
+    contain pages (each stream usually contains 100 pages)."""
+    offsets: Set[int] = set()
+    with bz2.open(index_path, "rt", encoding="utf-8") as f:
+        for line in f:
+            offset, _, _ = line.partition(":")
+            if offset:
+                offsets.add(int(offset))
+    return sorted(offsets)
+
+
+def read_bz2_stream(f: BinaryIO, start: int, end: Optional[int]) -> bytes:
+    """Decompresses the bz2 stream starting at byte offset ``start`` of
+    the file.  ``end`` is the offset of the next stream, or None for the
+    last stream."""
+    f.seek(start)
+    data = f.read(end - start) if end is not None else f.read()
+    return bz2.BZ2Decompressor().decompress(data)
+
+
+def _parse_dump_stream(
+    dump_path: str,
+    namespace_ids: Set[int],
+    xml_namespace: str,
+    template_ns_id: Optional[int],
+    stream_range: Tuple[int, Optional[int]],
+) -> List[PageRow]:
+    """Worker function that parses the <page> elements of one bz2 stream of a
+    multistream dump file."""
+    with open(dump_path, "rb") as f:
+        data = read_bz2_stream(f, *stream_range)
+    return parse_pages_xml(data, namespace_ids, xml_namespace, template_ns_id)
+
+
+def parse_multistream_dump_xml(
+    ctx: "Wtp",
+    dump_path: str,
+    index_path: str,
+    namespace_ids: Set[int],
+    num_processes: Optional[int] = None,
+    changes: Optional[PageChanges] = None,
+    checkpoint: Optional[DumpCheckpoint] = None,
+) -> None:
+    """Parses a "pages-articles-multistream.xml.bz2" dump file.  The index
+    file gives the offsets of the independently compressed bz2 streams,
+    so the streams are decompressed and parsed in a process pool.  Only the
+    writer thread uses the database connection."""
+    offsets = read_multistream_offsets(index_path)
+    if len(offsets) == 0:
+        logging.warning(f"Multistream index file {index_path} is empty")
+        return
+    # The first stream only contains the <mediawiki> start tag and
+    # <siteinfo>, get the XML namespace and title case rules from it.
+    with open(dump_path, "rb") as f:
+        xml_namespace = read_dump_header(
+            ctx, read_bz2_stream(f, 0, offsets[0])
+        )
+    template_ns_id = ctx.NAMESPACE_DATA["Template"]["id"]
+    stream_ranges = list(zip(offsets, offsets[1:] + [None]))
+    if checkpoint is not None:
+        stream_ranges = stream_ranges[checkpoint.position :]
+    num_processes = num_processes or os.cpu_count() or 1
+    logging.info(
+        f"Parsing {len(stream_ranges)} dump file streams in "
+        f"{num_processes} processes"
+    )
+    with multiprocessing.Pool(num_processes) as pool, closing(
+        imap_bounded(
+            pool,
+            partial(
+                _parse_dump_stream,
+                dump_path,
+                namespace_ids,
+                xml_namespace,
+                template_ns_id,
+            ),
+            stream_ranges,
+            num_processes * 4,
+        )
+    ) as row_batches:
+        save_page_rows(ctx, row_batches, changes, checkpoint)
 
 
 def process_dump(
     ctx: "Wtp",
-    path: str,
+    path: DumpSource,
     namespace_ids: Set[int],
     overwrite_folders: Optional[List[Path]] = None,
     skip_extract_dump: bool = False,
     save_pages_path: Optional[Path] = None,
     skip_analyze_templates: bool = False,
-) -> None:
+    index_path: Optional[str] = None,
+    num_processes: Optional[int] = None,
+    incremental: bool = False,
+    delete_missing_pages: bool = True,
+    resume: bool = False,
+    search_index: bool = False,
+) -> Optional[PageChanges]:
     """Parses a WikiMedia dump file ``path`` (which should point to a
-    "<project>-<date>-pages-articles.xml.bz2" file.  This implements
+    "<project>-<date>-pages-articles.xml.bz2" file, or a file compressed
+    with another format in ``DUMP_CODECS``, or be "-" for standard input
+    or a binary file object).  This implements
     the first phase of processing a dump - copying it to a temporary
     file with some preprocessing.  The Wtp.reprocess() must then be
-    called to actually process the data."""
+    called to actually process the data.  If ``path`` is a
+    "pages-articles-multistream.xml.bz2" file, ``index_path`` should point
+    to its "-index.txt.bz2" file (it is found automatically if it is in
+    the same directory) so that the streams can be decompressed in
+    parallel.  Pages are parsed in ``num_processes`` worker processes
+    (defaults to the number of CPUs).
+
+    If ``incremental`` is True, the database already has the pages of an
+    older dump file: only the pages whose revision SHA-1 changed are saved,
+    pages not in the new dump file are deleted if ``delete_missing_pages``
+    is True, and templates are analyzed again only if a template page
+    changed.  The changed and deleted page titles are returned.
+
+    Otherwise a checkpoint is committed to the database every
+    ``CHECKPOINT_PAGES`` pages.  If ``resume`` is True and the parsing of the
+    same dump file was interrupted, parsing continues from the last
+    checkpoint and the pages are added to the existing database.
+
+    The pages in ``overwrite_folders`` are saved as page overrides (see
+    ``Wtp.add_page_override()``) that replace the overrides of the last call,
+    the saved pages aren't changed.
+
+    If ``search_index`` is True, the full-text search index of page bodies
+    is built after saving the pages (see ``Wtp.build_search_index()``).  An
+    existing index is kept up to date while pages are saved."""
+    if incremental and resume:
+        raise ValueError("Incremental dump parsing can't be resumed")
 
     logging.info(
         f"skip_extract_dump: {skip_extract_dump}, save_pages_path: "
         f"{str(save_pages_path)}"
     )
     logging.info(f"dump file path: {path}")
+    if index_path is None and isinstance(path, (str, Path)):
+        index_path = get_multistream_index_path(str(path))
 
-    # Run Phase 1 in a single thread; this mostly just extracts pages into
-    # a SQLite database file.
+    # Phase 1 mostly just extracts pages into a SQLite database file.
+    # Pages are parsed in worker processes: multistream dump files are split
+    # by their streams, other dump files are split while decompressing.
+    changes = None
     if not skip_extract_dump:
-        parse_dump_xml(ctx, path, namespace_ids)
+        checkpoint = None
+        if incremental:
+            changes = PageChanges()
+            changes.start(ctx)
+        else:
+            checkpoint = DumpCheckpoint.start(
+                ctx,
+                Path(path).name if isinstance(path, (str, Path)) else "-",
+                resume,
+            )
+        if index_path is not None:
+            assert isinstance(path, (str, Path))
+            parse_multistream_dump_xml(
+                ctx,
+                str(path),
+                index_path,
+                namespace_ids,
+                num_processes,
+                changes,
+                checkpoint,
+            )
+        else:
+            parse_dump_xml(
+                ctx, path, namespace_ids, num_processes, changes, checkpoint
+            )
+        if changes is not None:
+            changes.finish(ctx, namespace_ids, delete_missing_pages)
+        if checkpoint is not None:
+            checkpoint.clear(ctx)
         if save_pages_path is not None:
             save_pages_to_file(ctx, save_pages_path)
 
+    # the redirect results and title filters are only built again if pages
+    # were saved or deleted
+    pages_changed = not skip_extract_dump and (
+        changes is None
+        or len(changes.changed_titles) > 0
+        or len(changes.deleted_titles) > 0
+    )
+
     # Add default templates
     template_ns = ctx.NAMESPACE_DATA.get("Template")
     template_ns_id = template_ns["id"]
     template_ns_local_name = template_ns["name"]
-    ctx.add_page(  # magic word
-        f"{template_ns_local_name}:!", template_ns_id, "|"
-    )
-    ctx.add_page(
-        f"{template_ns_local_name}:=", template_ns_id, "="
-    )
-    ctx.add_page(  # {{((}} -> {{
-        f"{template_ns_local_name}:((", template_ns_id, "&lbrace;&lbrace;"
-    )
-    ctx.add_page(  # {{))}} -> }}
-        f"{template_ns_local_name}:))", template_ns_id, "&rbrace;&rbrace;"
-    )
-    analyze_and_overwrite_pages(
-        ctx, overwrite_folders, skip_extract_dump, skip_analyze_templates
-    )
+    for name, body in (
+        ("!", "|"),  # magic word
+        ("=", "="),
+        ("((", "&lbrace;&lbrace;"),  # {{((}} -> {{
+        ("))", "&rbrace;&rbrace;"),  # {{))}} -> }}
+    ):
+        title = f"{template_ns_local_name}:{name}"
+        saved_pages = ctx.page_store.get_pages([(title, template_ns_id)])
+        if (
+            len(saved_pages) == 0
+            or saved_pages[0].body != body
+            or saved_pages[0].redirect_to is not None
+        ):
+            ctx.add_page(title, template_ns_id, body)
+            pages_changed = True
+    if changes is not None and not skip_analyze_templates:
+        template_prefix = template_ns_local_name + ":"
+        template_titles = [
+            title
+            for title in changes.changed_titles | changes.deleted_titles
+            if title.startswith(template_prefix)
+        ]
+        if len(template_titles) > 0 and ctx.has_template_links():
+            # only the changed templates and the templates that include
+            # them are analyzed again
+            ctx.update_template_analysis(template_titles)
+        elif len(template_titles) > 0:
+            # Analyze all templates again, a changed template could change
+            # the templates that include it.
+            ctx.db_conn.execute(
+                "UPDATE pages SET need_pre_expand = 0 WHERE namespace_id = ?",
+                (template_ns_id,),
+            )
+            ctx.clear_page_caches()
+            ctx.analyze_templates()
+    analyze_and_overwrite_pages(ctx, overwrite_folders, skip_analyze_templates)
+    if pages_changed or not ctx.redirect_targets_resolved:
+        ctx.resolve_redirects()
+    if pages_changed or not ctx.title_filters_saved:
+        ctx.build_title_filters()
+    if search_index and not ctx.has_search_index:
+        ctx.build_search_index()
+    return changes
 
 
 def analyze_and_overwrite_pages(
     ctx: "Wtp",
     overwrite_folders: Optional[List[Path]],
-    skip_extract_dump: bool,
     skip_analyze_templates: bool,
 ) -> None:
+    # the overrides of the last run are reverted, the pages table is never
+    # changed by them
+    ctx.clear_page_overrides()
     if overwrite_folders is not None:
         if overwrite_pages(ctx, overwrite_folders, False):
             # has template
-            if skip_extract_dump:
-                ctx.backup_db()
             overwrite_pages(ctx, overwrite_folders, True)
-            if not skip_analyze_templates:
+            if not skip_analyze_templates and ctx.has_template_links():
+                ctx.update_template_analysis(
+                    page.title
+                    for page in ctx.page_overrides.iter_pages(
+                        [ctx.NAMESPACE_DATA["Template"]["id"]]
+                    )
+                )
+            elif not skip_analyze_templates:
                 ctx.analyze_templates()
         else:
             if not skip_analyze_templates and not ctx.has_analyzed_templates():
                 ctx.analyze_templates()
-            if skip_extract_dump:
-                ctx.backup_db()
             overwrite_pages(ctx, overwrite_folders, True)
     elif not skip_analyze_templates and not ctx.has_analyzed_templates():
         ctx.analyze_templates()
@@ -164,7 +928,8 @@ def overwrite_pages(
     ctx: "Wtp", folder_paths: List[Path], do_overwrite: bool
 ) -> bool:
     """
-    Read text from passed paths and overwrite the correspond pages in database.
+    Read text from passed paths and override the correspond pages in database
+    with `Wtp.add_page_override()`.
     If `do_overwrite` is `False`, do not write to database and returns `True` if
     the overwritten pages include template.
     """
@@ -240,7 +1005,7 @@ def overwrite_single_page(
                 "id"
             )
             model = "Scribunto" if namespace_id == module_ns_id else "wikitext"
-        ctx.add_page(
+        ctx.add_page_override(
             title,
             namespace_id,
             body=body,
@@ -330,5 +1095,3 @@ def save_pages_to_file(ctx: "Wtp", directory: Path) -> None:
 
 
 # XXX parse <namespaces> and use that in both Python and Lua code
-
-# XXX parse <case> to determine whether titles are case-sensitive
@@ -224,11 +224,10 @@ def get_page_info(ctx: "Wtp", title: str, namespace_id: int) -> "_LuaTable":
     titles."""
     assert ctx.lua is not None
 
-    page_id = 0  # XXX collect required info in phase 1
-    page = ctx.get_page(title, namespace_id)
-    # whether the page exists and what its id might be
+    page = ctx.get_page(title, namespace_id, lazy_body=True)
+    # whether the page exists and its id in the dump file
     dt = {
-        "id": page_id,
+        "id": (page.page_id or 0) if page is not None else 0,
         "exists": page is not None,
         "redirectTo": page.redirect_to if page is not None else None,
     }
@@ -0,0 +1,352 @@
+# Cache of the pages returned by Wtp.get_page(), the in-memory index of
+# template and module pages and the title filters of missing pages
+#
+# Copyright (c) 2020-2022 Tatu Ylonen.  See file LICENSE and https://ylonen.org
+
+import hashlib
+import math
+import sys
+from collections import OrderedDict, defaultdict
+from dataclasses import dataclass
+from typing import (
+    TYPE_CHECKING,
+    DefaultDict,
+    Dict,
+    Iterable,
+    Iterator,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+
+from .compression import CompressedBody, DeferredBody
+
+if TYPE_CHECKING:
+    from .core import Page
+
+# get_page() arguments: title, namespace id, no_redirect.  no_redirect is
+# None for get_page_resolve_redirect() lookups.
+PageCacheKey = Tuple[str, Optional[int], Optional[bool]]
+
+# Estimated memory use of a cache entry without the page body
+ENTRY_OVERHEAD_SIZE = 300
+# False positive rate of the title Bloom filters
+TITLE_FILTER_ERROR_RATE = 0.01
+# Estimated compression ratio of compressed page bodies, they are
+# decompressed in the cache when they are used
+COMPRESSION_RATIO = 3
+
+
+@dataclass
+class PageCacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+
+def page_size(page: Optional["Page"]) -> int:
+    """Returns the estimated memory use of a cached page in bytes."""
+    if page is None:
+        return ENTRY_OVERHEAD_SIZE
+    body = page.__dict__.get("_body")
+    if isinstance(body, CompressedBody):
+        body_size = len(body.data) * COMPRESSION_RATIO
+    elif isinstance(body, DeferredBody):
+        body_size = body.length  # the size after it is read
+    else:
+        body_size = len(body or "")
+    return ENTRY_OVERHEAD_SIZE + len(page.title) + body_size
+
+
+class PageCachePool:
+    """Least recently used pages of some namespaces, at most ``max_size``
+    bytes."""
+
+    __slots__ = ("max_size", "size", "entries", "stats")
+
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self.size = 0
+        # key -> page, page size, titles used to invalidate the entry
+        self.entries: OrderedDict[
+            PageCacheKey, Tuple[Optional["Page"], int, Tuple[str, ...]]
+        ] = OrderedDict()
+        self.stats = PageCacheStats()
+
+
+class PageCache:
+    """Cache of page lookups of one ``Wtp`` object.  ``pool_sizes`` maps
+    namespace ids to the maximum size of their pool in bytes, the None key is
+    the pool of other namespaces.  Separate pools for templates and modules
+    keep their pages from being evicted when many other pages are read.
+
+    Lookups that didn't find a page are cached too.  An entry is invalidated
+    when a page with one of the titles the lookup could have found is
+    saved."""
+
+    def __init__(self, pool_sizes: Dict[Optional[int], int]) -> None:
+        self.pools: Dict[Optional[int], PageCachePool] = {
+            namespace_id: PageCachePool(size)
+            for namespace_id, size in pool_sizes.items()
+        }
+        self.pools.setdefault(None, PageCachePool(0))
+        self.title_keys: DefaultDict[
+            str, Set[Tuple[PageCachePool, PageCacheKey]]
+        ] = defaultdict(set)
+
+    def pool(self, namespace_id: Optional[int]) -> PageCachePool:
+        return self.pools.get(namespace_id, self.pools[None])
+
+    def get(self, key: PageCacheKey) -> Tuple[bool, Optional["Page"]]:
+        """Returns True and the cached page (None if the page doesn't exist),
+        or False and None if the lookup isn't cached."""
+        pool = self.pool(key[1])
+        entry = pool.entries.get(key)
+        if entry is None:
+            pool.stats.misses += 1
+            return False, None
+        pool.stats.hits += 1
+        pool.entries.move_to_end(key)
+        return True, entry[0]
+
+    def put(
+        self,
+        key: PageCacheKey,
+        page: Optional["Page"],
+        titles: Iterable[str],
+    ) -> None:
+        pool = self.pool(key[1])
+        size = page_size(page)
+        if size > pool.max_size:
+            return
+        self.remove(pool, key)
+        titles = tuple(set(titles))
+        pool.entries[key] = (page, size, titles)
+        pool.size += size
+        for title in titles:
+            self.title_keys[title].add((pool, key))
+        while pool.size > pool.max_size:
+            self.remove(pool, next(iter(pool.entries)))
+            pool.stats.evictions += 1
+
+    def remove(self, pool: PageCachePool, key: PageCacheKey) -> None:
+        entry = pool.entries.pop(key, None)
+        if entry is None:
+            return
+        _, size, titles = entry
+        pool.size -= size
+        for title in titles:
+            keys = self.title_keys[title]
+            keys.discard((pool, key))
+            if len(keys) == 0:
+                del self.title_keys[title]
+
+    def invalidate(self, title: str) -> None:
+        """Removes the entries that could have found a page titled
+        ``title``."""
+        for pool, key in list(self.title_keys.get(title, ())):
+            self.remove(pool, key)
+
+    def clear(self) -> None:
+        for pool in self.pools.values():
+            pool.entries.clear()
+            pool.size = 0
+        self.title_keys.clear()
+
+    @property
+    def stats(self) -> PageCacheStats:
+        """Hit, miss and eviction counts of all pools."""
+        stats = PageCacheStats()
+        for pool in self.pools.values():
+            stats.hits += pool.stats.hits
+            stats.misses += pool.stats.misses
+            stats.evictions += pool.stats.evictions
+        return stats
+
+
+# redirect_to, need_pre_expand, saved body (compressed or not), model,
+# page id
+IndexedPage = Tuple[
+    Optional[str], bool, Union[str, bytes, None], Optional[str], Optional[int]
+]
+
+
+class NamespaceIndex:
+    """All pages of some namespaces (usually templates and modules) in
+    memory, for answering ``Wtp.get_page()`` without database queries.
+    Bodies are kept as they are saved in the database, compressed bodies
+    stay compressed until they are used."""
+
+    __slots__ = ("pages", "title_keys", "load_time", "memory_size")
+
+    def __init__(self, namespace_ids: Iterable[int]) -> None:
+        self.pages: Dict[int, Dict[str, IndexedPage]] = {
+            namespace_id: {} for namespace_id in namespace_ids
+        }
+        # title key -> titles, of the titles that differ from their key
+        self.title_keys: Dict[int, DefaultDict[str, Set[str]]] = {
+            namespace_id: defaultdict(set) for namespace_id in self.pages
+        }
+        self.load_time = 0.0  # seconds
+        self.memory_size = 0  # estimated, in bytes
+
+    def add(
+        self,
+        title: str,
+        title_key: str,
+        namespace_id: int,
+        redirect_to: Optional[str],
+        need_pre_expand: bool,
+        body: Union[str, bytes, None],
+        model: Optional[str],
+        page_id: Optional[int],
+    ) -> None:
+        pages = self.pages.get(namespace_id)
+        if pages is not None:
+            pages[title] = (
+                redirect_to,
+                need_pre_expand,
+                body,
+                model and sys.intern(model),
+                page_id,
+            )
+            if title_key != title:
+                self.title_keys[namespace_id][title_key].add(title)
+
+    def lookup(
+        self,
+        namespace_id: int,
+        title: str,
+        title_key: str,
+        no_redirect: bool,
+    ) -> Optional[Tuple[str, IndexedPage]]:
+        """Returns the title and data of the page titled ``title``, or else
+        of the first page in title order that has the same title key, like
+        the SQL query of ``Wtp.get_page()``."""
+        pages = self.pages[namespace_id]
+        titles = sorted(
+            self.title_keys[namespace_id].get(title_key, set()) | {title_key}
+        )
+        for found_title in [title] + titles:
+            page = pages.get(found_title)
+            if page is not None and not (no_redirect and page[0] is not None):
+                return found_title, page
+        return None
+
+    def set_need_pre_expand(
+        self, title: str, need_pre_expand: bool = True
+    ) -> None:
+        for pages in self.pages.values():
+            page = pages.get(title)
+            if page is not None:
+                pages[title] = (
+                    page[0],
+                    need_pre_expand,
+                    page[2],
+                    page[3],
+                    page[4],
+                )
+
+    @property
+    def page_nums(self) -> int:
+        return sum(len(pages) for pages in self.pages.values())
+
+    def estimate_memory_size(self) -> int:
+        size = 0
+        for pages in self.pages.values():
+            size += sys.getsizeof(pages)
+            for title, page in pages.items():
+                size += sys.getsizeof(title) + sys.getsizeof(page)
+                size += sum(
+                    sys.getsizeof(value)
+                    for value in (page[0], page[2])
+                    if value is not None
+                )
+        for title_keys in self.title_keys.values():
+            size += sys.getsizeof(title_keys)
+            for title_key, titles in title_keys.items():
+                size += sys.getsizeof(title_key) + sys.getsizeof(titles)
+        return size
+
+
+class TitleFilter:
+    """Bloom filter of the page titles of one namespace.  If
+    ``might_contain()`` returns False the namespace doesn't have the page, if
+    it returns True the page exists or (with probability
+    ``TITLE_FILTER_ERROR_RATE``) it doesn't."""
+
+    __slots__ = ("bits", "size", "num_hashes")
+
+    def __init__(self, bits: bytearray, num_hashes: int) -> None:
+        self.bits = bits
+        self.size = len(bits) * 8
+        self.num_hashes = num_hashes
+
+    @classmethod
+    def for_capacity(cls, capacity: int) -> "TitleFilter":
+        # optimal size and number of hash functions for the error rate
+        size = math.ceil(
+            -max(capacity, 1)
+            * math.log(TITLE_FILTER_ERROR_RATE)
+            / math.log(2) ** 2
+        )
+        num_hashes = round(size / max(capacity, 1) * math.log(2))
+        return cls(bytearray((size + 7) // 8), min(max(num_hashes, 1), 8))
+
+    def positions(self, title: str) -> Iterator[int]:
+        # a 64-bit hash for each hash function from one BLAKE2 digest
+        digest = hashlib.blake2b(
+            title.encode("utf-8"), digest_size=8 * self.num_hashes
+        ).digest()
+        for i in range(0, len(digest), 8):
+            yield int.from_bytes(digest[i : i + 8], "little") % self.size
+
+    def add(self, title: str) -> None:
+        for position in self.positions(title):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def might_contain(self, title: str) -> bool:
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self.positions(title)
+        )
+
+
+class TitleFilters:
+    """Title Bloom filters of all namespaces, for answering lookups of missing
+    pages without database queries."""
+
+    __slots__ = ("filters", "unfiltered_namespaces")
+
+    def __init__(self, filters: Dict[int, TitleFilter]) -> None:
+        self.filters = filters
+        # namespaces of pages saved after the filters were built
+        self.unfiltered_namespaces: Set[Optional[int]] = set()
+
+    def add(self, namespace_id: Optional[int], title: str) -> None:
+        if namespace_id is not None and namespace_id in self.filters:
+            self.filters[namespace_id].add(title)
+        else:
+            self.unfiltered_namespaces.add(namespace_id)
+
+    def might_exist(
+        self, namespace_id: Optional[int], titles: Iterable[str]
+    ) -> bool:
+        """Returns False if no page has one of the titles in the namespace,
+        or in any namespace if ``namespace_id`` is None."""
+        if namespace_id is None:
+            if len(self.unfiltered_namespaces) > 0:
+                return True
+            title_filters = list(self.filters.values())
+        elif namespace_id in self.unfiltered_namespaces:
+            return True
+        elif namespace_id in self.filters:
+            title_filters = [self.filters[namespace_id]]
+        else:
+            return False  # the namespace has no pages
+        return any(
+            title_filter.might_contain(title)
+            for title in titles
+            for title_filter in title_filters
+        )
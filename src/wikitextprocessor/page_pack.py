@@ -0,0 +1,492 @@
+# Read-only page pack files: all saved pages in one immutable file that
+# worker processes memory-map
+#
+# Copyright (c) 2020-2022 Tatu Ylonen.  See file LICENSE and https://ylonen.org
+
+import array
+import json
+import logging
+import mmap
+import shutil
+import sqlite3
+import struct
+import sys
+import tempfile
+import time
+import zlib
+from collections import OrderedDict
+from functools import partial
+from pathlib import Path
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
+
+from . import core
+from .compression import DeferredBody
+from .page_store import PageKey, PageRecord, PageStore, like_pattern_regex
+
+if TYPE_CHECKING:
+    from .core import Page, Wtp
+
+# File layout: header, compressed body blocks, string heap (UTF-8 title
+# keys, titles and redirect targets), page records sorted by title key,
+# namespace id and title, hash table, block table, JSON metadata.
+PACK_MAGIC = b"WTPPACK\0"
+PACK_VERSION = 1
+# magic, version, page count, block count, hash table slot count, and the
+# offsets of the heap, records, hash table, block table and metadata
+HEADER = struct.Struct("<8sIIIIQQQQQ")
+# namespace id, title key offset and length, title offset and length,
+# redirect_to offset and length, model number, RECORD_FLAG_* bits, page id
+# (-1 if None), body block number, body offset in the uncompressed block and
+# body length in UTF-8 bytes
+RECORD = struct.Struct("<iIIIIIIHBqIII")
+# file offset and length of a compressed block
+BLOCK = struct.Struct("<QI")
+# Open addressing hash table of (title key, namespace id) pairs, with linear
+# probing.  A slot is 0 or the number of the first record of the pair + 1.
+HASH_SLOT = struct.Struct("<I")
+
+RECORD_FLAG_NEED_PRE_EXPAND = 1
+RECORD_FLAG_REDIRECT = 2
+RECORD_FLAG_BODY = 4
+NO_MODEL = 0xFFFF
+
+# Bodies are compressed together in blocks of about this many bytes, small
+# bodies compress better in a block than alone.  A larger block makes
+# reading one body slower.
+BLOCK_SIZE = 16 * 1024
+# Number of uncompressed blocks kept by each reader
+BLOCK_CACHE_SIZE = 64
+
+
+def title_key_hash(title_key: bytes, namespace_id: int) -> int:
+    # CRC-32 is stable between processes, unlike hash()
+    return zlib.crc32(title_key, namespace_id & 0xFFFFFFFF)
+
+
+def write_page_pack(wtp: "Wtp", path: Union[str, Path]) -> int:
+    """Writes all pages saved in the database of ``wtp`` to a new page pack
+    file, for opening with ``PackPageStore``.  Pages are read in title key
+    order, bodies are written as they are read and the heap and records go
+    through temporary files, so the pages don't have to fit in memory.
+    Returns the number of pages."""
+    wtp.require_sqlite_store("Writing a page pack")
+    wtp.flush_bulk_rows()
+    start_time = time.perf_counter()
+    models: Dict[str, int] = {}
+    block_offsets: List[Tuple[int, int]] = []
+    block = bytearray()
+    page_nums = 0
+    heap_size = 0
+    # hashes and record numbers of the first records of title keys
+    key_hashes = array.array("I")
+    key_records = array.array("I")
+    last_key: Optional[Tuple[bytes, int]] = None
+
+    with open(path, "wb") as f, tempfile.TemporaryFile() as heap_file, (
+        tempfile.TemporaryFile()
+    ) as record_file:
+        f.write(b"\0" * HEADER.size)
+
+        def write_block() -> None:
+            compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+            data = compressor.compress(block) + compressor.flush()
+            block_offsets.append((f.tell(), len(data)))
+            f.write(data)
+            block.clear()
+
+        def add_string(value: bytes) -> Tuple[int, int]:
+            nonlocal heap_size
+            offset = heap_size
+            heap_file.write(value)
+            heap_size += len(value)
+            return offset, len(value)
+
+        for (
+            namespace_id,
+            title_key,
+            title,
+            redirect_to,
+            need_pre_expand,
+            model,
+            page_id,
+            body,
+        ) in wtp.db_conn.execute(
+            """SELECT namespace_id, title_key, title, redirect_to,
+            need_pre_expand, model, page_id, page_body(body)
+            FROM pages ORDER BY title_key, namespace_id, title"""
+        ):
+            key_data = title_key.encode("utf-8")
+            if (key_data, namespace_id) != last_key:
+                last_key = key_data, namespace_id
+                key_hashes.append(title_key_hash(key_data, namespace_id))
+                key_records.append(page_nums)
+            key_offset, key_len = add_string(key_data)
+            if title == title_key:
+                title_offset, title_len = key_offset, key_len
+            else:
+                title_offset, title_len = add_string(title.encode("utf-8"))
+            flags = RECORD_FLAG_NEED_PRE_EXPAND if need_pre_expand else 0
+            redirect_offset = redirect_len = 0
+            if redirect_to is not None:
+                flags |= RECORD_FLAG_REDIRECT
+                redirect_offset, redirect_len = add_string(
+                    redirect_to.encode("utf-8")
+                )
+            body_offset = body_len = 0
+            if body is not None:
+                flags |= RECORD_FLAG_BODY
+                data = body.encode("utf-8")
+                if len(block) > 0 and len(block) + len(data) > BLOCK_SIZE:
+                    write_block()
+                body_offset, body_len = len(block), len(data)
+                block += data
+            if heap_size > 0xFFFFFFFF:
+                raise ValueError("Page titles don't fit in a page pack")
+            record_file.write(
+                RECORD.pack(
+                    namespace_id,
+                    key_offset,
+                    key_len,
+                    title_offset,
+                    title_len,
+                    redirect_offset,
+                    redirect_len,
+                    NO_MODEL
+                    if model is None
+                    else models.setdefault(model, len(models)),
+                    flags,
+                    -1 if page_id is None else page_id,
+                    len(block_offsets),
+                    body_offset,
+                    body_len,
+                )
+            )
+            page_nums += 1
+        if len(block) > 0:
+            write_block()
+
+        heap_offset = f.tell()
+        heap_file.seek(0)
+        shutil.copyfileobj(heap_file, f)
+        record_offset = f.tell()
+        record_file.seek(0)
+        shutil.copyfileobj(record_file, f)
+        hash_slots = 1
+        while hash_slots < 2 * len(key_hashes):
+            hash_slots *= 2
+        hash_table = array.array("I", bytes(HASH_SLOT.size * hash_slots))
+        for key_hash, record_number in zip(key_hashes, key_records):
+            slot = key_hash & (hash_slots - 1)
+            while hash_table[slot] != 0:
+                slot = (slot + 1) & (hash_slots - 1)
+            hash_table[slot] = record_number + 1
+        if sys.byteorder != "little":
+            hash_table.byteswap()
+        hash_table_offset = f.tell()
+        f.write(hash_table.tobytes())
+        block_table_offset = f.tell()
+        for offset, length in block_offsets:
+            f.write(BLOCK.pack(offset, length))
+        metadata_offset = f.tell()
+        f.write(
+            json.dumps(
+                {
+                    "lang_code": wtp.lang_code,
+                    "models": list(models),
+                    "first_letter_namespaces": sorted(
+                        wtp.first_letter_namespaces
+                    ),
+                }
+            ).encode("utf-8")
+        )
+        f.seek(0)
+        f.write(
+            HEADER.pack(
+                PACK_MAGIC,
+                PACK_VERSION,
+                page_nums,
+                len(block_offsets),
+                hash_slots,
+                heap_offset,
+                record_offset,
+                hash_table_offset,
+                block_table_offset,
+                metadata_offset,
+            )
+        )
+    logging.info(
+        f"Wrote {page_nums} pages to page pack {path} in "
+        f"{time.perf_counter() - start_time:.1f}s"
+    )
+    return page_nums
+
+
+class PackPageStore(PageStore):
+    """Pages of a page pack file written by ``write_page_pack()``.  The file
+    is memory-mapped, so all processes that open it share one copy in the
+    operating system's page cache.  Pages are found with the hash table of
+    title keys, without reading the other pages.  The store is read-only:
+    saving pages or changing their flags raises ``sqlite3.OperationalError``
+    like a database file opened with ``read_only=True``."""
+
+    def __init__(self, path: Union[str, Path]) -> None:
+        self.path = Path(path)
+        with open(self.path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (
+            magic,
+            version,
+            self.page_nums,
+            block_nums,
+            self.hash_slots,
+            self.heap_offset,
+            self.record_offset,
+            self.hash_table_offset,
+            block_table_offset,
+            metadata_offset,
+        ) = HEADER.unpack_from(self.data)
+        if magic != PACK_MAGIC or version != PACK_VERSION:
+            raise ValueError(
+                f"{self.path} isn't a version {PACK_VERSION} page pack file"
+            )
+        self.blocks = [
+            BLOCK.unpack_from(self.data, block_table_offset + i * BLOCK.size)
+            for i in range(block_nums)
+        ]
+        self.metadata: Dict[str, Any] = json.loads(
+            self.data[metadata_offset:]
+        )
+        self.models: List[str] = self.metadata["models"]
+        self.block_cache: OrderedDict[int, bytes] = OrderedDict()
+
+    def open(self, wtp: "Wtp") -> None:
+        if self.metadata["lang_code"] != wtp.lang_code:
+            raise ValueError(
+                f"Page pack {self.path} has pages of language "
+                f"{self.metadata['lang_code']}, not {wtp.lang_code}"
+            )
+        super().open(wtp)
+        # title keys of the records were computed with these namespaces
+        wtp.first_letter_namespaces = set(
+            self.metadata["first_letter_namespaces"]
+        )
+
+    def close(self) -> None:
+        self.data.close()
+
+    @property
+    def read_only(self) -> bool:
+        return True
+
+    def _read_only_error(self) -> sqlite3.OperationalError:
+        return sqlite3.OperationalError(f"Page pack {self.path} is read-only")
+
+    def _string(self, offset: int, length: int) -> bytes:
+        start = self.heap_offset + offset
+        return self.data[start : start + length]
+
+    def _record(self, index: int) -> Tuple:
+        return RECORD.unpack_from(
+            self.data, self.record_offset + index * RECORD.size
+        )
+
+    def _records_of_key(
+        self, title_key: str, namespace_id: int
+    ) -> Iterator[Tuple]:
+        """Yields the records of the title key in the namespace in title
+        order."""
+        key_data = title_key.encode("utf-8")
+        slot = title_key_hash(key_data, namespace_id) & (self.hash_slots - 1)
+        while True:
+            (record_number,) = HASH_SLOT.unpack_from(
+                self.data, self.hash_table_offset + slot * HASH_SLOT.size
+            )
+            if record_number == 0:
+                return
+            record = self._record(record_number - 1)
+            if (
+                record[0] == namespace_id
+                and self._string(record[1], record[2]) == key_data
+            ):
+                break
+            slot = (slot + 1) & (self.hash_slots - 1)
+        # the other records of the key follow the first one
+        for index in range(record_number - 1, self.page_nums):
+            record = self._record(index)
+            if (
+                record[0] != namespace_id
+                or self._string(record[1], record[2]) != key_data
+            ):
+                return
+            yield record
+
+    def _namespace_ids(self) -> List[int]:
+        if "namespace_ids" not in self.metadata:
+            self.metadata["namespace_ids"] = sorted(
+                {self._record(i)[0] for i in range(self.page_nums)}
+            )
+        return self.metadata["namespace_ids"]
+
+    def _block(self, number: int) -> bytes:
+        block = self.block_cache.get(number)
+        if block is not None:
+            self.block_cache.move_to_end(number)
+            return block
+        offset, length = self.blocks[number]
+        block = zlib.decompress(
+            self.data[offset : offset + length], wbits=-zlib.MAX_WBITS
+        )
+        self.block_cache[number] = block
+        if len(self.block_cache) > BLOCK_CACHE_SIZE:
+            self.block_cache.popitem(last=False)
+        return block
+
+    def _read_body(self, record: Tuple) -> Optional[str]:
+        if not record[8] & RECORD_FLAG_BODY:
+            return None
+        block = self._block(record[10])
+        return block[record[11] : record[11] + record[12]].decode("utf-8")
+
+    def _page(self, record: Tuple) -> "Page":
+        # bodies are always decompressed when they are used, like the
+        # compressed bodies of the SQLite store
+        return core.Page(
+            title=self._string(record[3], record[4]).decode("utf-8"),
+            namespace_id=record[0],
+            redirect_to=self._string(record[5], record[6]).decode("utf-8")
+            if record[8] & RECORD_FLAG_REDIRECT
+            else None,
+            need_pre_expand=bool(record[8] & RECORD_FLAG_NEED_PRE_EXPAND),
+            body=DeferredBody(partial(self._read_body, record), record[12])
+            if record[8] & RECORD_FLAG_BODY
+            else None,
+            model=None if record[7] == NO_MODEL else self.models[record[7]],
+            page_id=None if record[9] == -1 else record[9],
+        )
+
+    def put_pages(self, rows: Sequence[PageRecord]) -> None:
+        raise self._read_only_error()
+
+    def get_page(
+        self,
+        title: str,
+        title_key: str,
+        namespace_id: Optional[int],
+        no_redirect: bool,
+        lazy_body: bool,
+    ) -> Optional["Page"]:
+        title_data = title.encode("utf-8")
+        if namespace_id is None:
+            for found_namespace_id in self._namespace_ids():
+                for record in self._records_of_key(
+                    self.wtp.title_key(title, found_namespace_id),
+                    found_namespace_id,
+                ):
+                    if self._string(record[3], record[4]) == title_data and (
+                        not no_redirect or not record[8] & RECORD_FLAG_REDIRECT
+                    ):
+                        return self._page(record)
+            return None
+        found = None
+        for record in self._records_of_key(title_key, namespace_id):
+            if no_redirect and record[8] & RECORD_FLAG_REDIRECT:
+                continue
+            if self._string(record[3], record[4]) == title_data:
+                return self._page(record)
+            if found is None:
+                found = record
+        return None if found is None else self._page(found)
+
+    def get_pages(
+        self, keys: Iterable[PageKey], lazy_body: bool = False
+    ) -> List["Page"]:
+        pages = []
+        for title, namespace_id in keys:
+            title_data = title.encode("utf-8")
+            for record in self._records_of_key(
+                self.wtp.title_key(title, namespace_id), namespace_id
+            ):
+                if self._string(record[3], record[4]) == title_data:
+                    pages.append(self._page(record))
+        return pages
+
+    def iter_pages(
+        self,
+        namespace_ids: Optional[List[int]] = None,
+        include_redirects: bool = True,
+        model: Optional[str] = None,
+        search_pattern: Optional[str] = None,
+        columns: Optional[Iterable[str]] = None,
+    ) -> Iterator["Page"]:
+        regex = like_pattern_regex(search_pattern) if search_pattern else None
+        for index in range(self.page_nums):
+            record = self._record(index)
+            if (
+                (namespace_ids is None or record[0] in namespace_ids)
+                and (
+                    include_redirects
+                    or not record[8] & RECORD_FLAG_REDIRECT
+                )
+                and (
+                    model is None
+                    or record[7] != NO_MODEL
+                    and self.models[record[7]] == model
+                )
+            ):
+                page = self._page(record)
+                if regex is None or (
+                    page.body is not None and regex.fullmatch(page.body)
+                ):
+                    yield page
+
+    def count_pages(
+        self,
+        namespace_ids: Optional[List[int]] = None,
+        include_redirects: bool = True,
+        model: Optional[str] = None,
+        search_pattern: Optional[str] = None,
+    ) -> int:
+        if (
+            namespace_ids is None
+            and include_redirects
+            and model is None
+            and not search_pattern
+        ):
+            return self.page_nums
+        return sum(
+            1
+            for _ in self.iter_pages(
+                namespace_ids, include_redirects, model, search_pattern, ()
+            )
+        )
+
+    def set_need_pre_expand(
+        self, keys: Iterable[PageKey], need_pre_expand: bool = True
+    ) -> None:
+        raise self._read_only_error()
+
+    def has_pre_expand_pages(
+        self, namespace_ids: Optional[List[int]] = None
+    ) -> bool:
+        # only the records are read
+        for index in range(self.page_nums):
+            record = self._record(index)
+            if record[8] & RECORD_FLAG_NEED_PRE_EXPAND and (
+                namespace_ids is None or record[0] in namespace_ids
+            ):
+                return True
+        return False
+
+    def update_title_keys(self, namespace_ids: Iterable[int]) -> None:
+        raise self._read_only_error()
@@ -0,0 +1,554 @@
+# Storage backends of the pages saved by a Wtp object
+#
+# Copyright (c) 2020-2022 Tatu Ylonen.  See file LICENSE and https://ylonen.org
+
+import dataclasses
+import re
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from functools import partial
+from typing import (
+    TYPE_CHECKING,
+    DefaultDict,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
+
+from . import core
+from .compression import DeferredBody, compress_body, decompress_body
+
+if TYPE_CHECKING:
+    from .core import Page, Wtp
+
+# Saved page fields: title, namespace id, body, redirect_to,
+# need_pre_expand, model, page id, revision id, revision text SHA-1, title
+# key, body length in UTF-8 bytes, PAGE_FLAG_* bits
+PageRecord = Tuple
+
+# (title, namespace id) of a page
+PageKey = Tuple[str, Optional[int]]
+
+INSERT_PAGE_SQL = """INSERT INTO pages (title, namespace_id, body,
+redirect_to, need_pre_expand, model, page_id, revision_id, sha1, title_key,
+length, flags)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT(title, namespace_id) DO UPDATE SET
+body=excluded.body, redirect_to=excluded.redirect_to,
+need_pre_expand=excluded.need_pre_expand, model=excluded.model,
+page_id=excluded.page_id, revision_id=excluded.revision_id,
+sha1=excluded.sha1, title_key=excluded.title_key, length=excluded.length,
+flags=excluded.flags"""
+
+# Page keys per query of SQLitePageStore.select_keys(), two variables each
+# stay below the 999 variables of SQLite before version 3.32
+PAGE_KEY_BATCH_SIZE = 450
+
+
+class UnsupportedPageStoreError(TypeError):
+    """Raised by the ``Wtp`` features that query the pages table of the
+    database file directly when the pages are saved by another store:
+    ``Wtp.iter_pages()``, ``Wtp.build_search_index()``,
+    ``Wtp.load_namespace_index()``, ``write_page_pack()`` and incremental
+    dump updates."""
+
+
+class PageStore(ABC):
+    """Storage of the pages saved by a ``Wtp`` object.  ``Wtp`` normalizes
+    titles, computes title keys and keeps the page caches, a store only
+    saves and finds pages.  ``open()`` is called by ``Wtp.__init__()``."""
+
+    def open(self, wtp: "Wtp") -> None:
+        self.wtp = wtp
+
+    def close(self) -> None:
+        """Releases the resources of the store, ``Wtp.close_db_conn()``
+        calls this."""
+
+    @property
+    def read_only(self) -> bool:
+        """True if pages can't be saved or changed, then
+        ``Wtp.check_writable()`` raises before anything is written."""
+        return False
+
+    @abstractmethod
+    def put_pages(self, rows: Sequence[PageRecord]) -> None:
+        """Saves new pages or replaces saved pages."""
+
+    @abstractmethod
+    def get_page(
+        self,
+        title: str,
+        title_key: str,
+        namespace_id: Optional[int],
+        no_redirect: bool,
+        lazy_body: bool,
+    ) -> Optional["Page"]:
+        """Returns the page titled ``title``, or else the first page in title
+        order that has the title key in the namespace.  If ``namespace_id`` is
+        None, returns the page titled ``title`` in any namespace."""
+
+    @abstractmethod
+    def get_pages(
+        self, keys: Iterable[PageKey], lazy_body: bool = False
+    ) -> List["Page"]:
+        """Returns the saved pages of the (title, namespace id) pairs."""
+
+    @abstractmethod
+    def iter_pages(
+        self,
+        namespace_ids: Optional[List[int]] = None,
+        include_redirects: bool = True,
+        model: Optional[str] = None,
+        search_pattern: Optional[str] = None,
+        columns: Optional[Iterable[str]] = None,
+    ) -> Iterator["Page"]:
+        """Yields the pages that match the arguments, see
+        ``Wtp.get_all_pages()``."""
+
+    @abstractmethod
+    def count_pages(
+        self,
+        namespace_ids: Optional[List[int]] = None,
+        include_redirects: bool = True,
+        model: Optional[str] = None,
+        search_pattern: Optional[str] = None,
+    ) -> int:
+        """Returns the number of pages ``iter_pages()`` would yield."""
+
+    @abstractmethod
+    def set_need_pre_expand(
+        self, keys: Iterable[PageKey], need_pre_expand: bool = True
+    ) -> None:
+        """Sets or clears the ``need_pre_expand`` flag of the saved
+        pages."""
+
+    @abstractmethod
+    def update_title_keys(self, namespace_ids: Iterable[int]) -> None:
+        """Computes the title keys of the pages of the namespaces again after
+        their title case rules changed."""
+
+    def iter_redirects(self) -> Iterator[Tuple[str, int, str]]:
+        """Yields the title, namespace id and redirect target of every
+        redirect page."""
+        for page in self.iter_pages(columns=("redirect_to",)):
+            if page.redirect_to is not None:
+                yield page.title, page.namespace_id, page.redirect_to
+
+    def has_pre_expand_pages(
+        self, namespace_ids: Optional[List[int]] = None
+    ) -> bool:
+        """Returns True if a page of the namespaces has the
+        ``need_pre_expand`` flag."""
+        return any(
+            page.need_pre_expand
+            for page in self.iter_pages(
+                namespace_ids, columns=("need_pre_expand",)
+            )
+        )
+
+
+class SQLitePageStore(PageStore):
+    """Pages in the pages table of the ``Wtp`` database file.  Bodies are
+    saved compressed if ``Wtp.compress_bodies`` is True."""
+
+    def put_pages(self, rows: Sequence[PageRecord]) -> None:
+        search_index = self.wtp.has_search_index
+        if search_index:
+            self.delete_from_search_index([row[:2] for row in rows])
+        self.wtp.db_conn.executemany(
+            INSERT_PAGE_SQL, map(self._compress_row, rows)
+        )
+        if search_index:
+            bodies = {row[:2]: row[2] for row in rows}
+            self.wtp.db_conn.executemany(
+                "INSERT INTO page_search(rowid, body) VALUES (?, ?)",
+                [
+                    (rowid, bodies[(title, namespace_id)])
+                    for rowid, title, namespace_id in self.select_keys(
+                        ("rowid", "title", "namespace_id"), bodies
+                    )
+                ],
+            )
+
+    def delete_from_search_index(self, keys: Iterable[PageKey]) -> None:
+        """Deletes the saved pages of the keys from the full-text index of
+        ``Wtp.build_search_index()``, before they are replaced or deleted.
+        The index is updated here instead of with triggers, which would need
+        the ``page_body()`` function of the ``Wtp`` connection in every
+        SQLite client that changes the pages table."""
+        self.wtp.db_conn.executemany(
+            """INSERT INTO page_search(page_search, rowid, body)
+            VALUES ('delete', ?, ?)""",
+            [
+                (rowid, decompress_body(body, self.wtp.body_dictionaries))
+                for rowid, body in self.select_keys(("rowid", "body"), keys)
+            ],
+        )
+
+    def _compress_row(self, row: PageRecord) -> PageRecord:
+        wtp = self.wtp
+        if not wtp.compress_bodies:
+            return row
+        body = compress_body(
+            row[2],
+            wtp.body_dictionary_id,
+            wtp.body_dictionaries.get(wtp.body_dictionary_id),
+        )
+        flags = row[11]
+        if isinstance(body, bytes):
+            flags |= core.PAGE_FLAG_COMPRESSED
+        return row[:2] + (body,) + row[3:11] + (flags,)
+
+    def get_page(
+        self,
+        title: str,
+        title_key: str,
+        namespace_id: Optional[int],
+        no_redirect: bool,
+        lazy_body: bool,
+    ) -> Optional["Page"]:
+        columns = self.select_columns(
+            ("redirect_to", "need_pre_expand", "model", "page_id")
+            if lazy_body
+            else None
+        )
+        query_str = f"""
+        SELECT title, namespace_id, {", ".join(columns)}
+        FROM pages
+        """
+        query_values: List[object] = []
+        if namespace_id is None:
+            query_str += " WHERE title = ?"
+            query_values.append(title)
+        else:
+            query_str += " WHERE title_key = ? AND namespace_id = ?"
+            query_values.extend((title_key, namespace_id))
+        if no_redirect:
+            query_str += " AND redirect_to IS NULL"
+        if namespace_id is not None:
+            # Titles in case-sensitive namespaces could have the same key,
+            # prefer the exact title
+            query_str += " ORDER BY title = ? DESC, title"
+            query_values.append(title)
+        query_str += " LIMIT 1"
+        for row in self.wtp.db_conn.execute(query_str, query_values):
+            return self.page_from_row(columns, row)
+        return None
+
+    def get_pages(
+        self, keys: Iterable[PageKey], lazy_body: bool = False
+    ) -> List["Page"]:
+        columns = self.select_columns(
+            ("redirect_to", "need_pre_expand", "model", "page_id")
+            if lazy_body
+            else None
+        )
+        return [
+            self.page_from_row(columns, row)
+            for row in self.select_keys(
+                ("title", "namespace_id", *columns), keys
+            )
+        ]
+
+    def select_keys(
+        self, columns: Sequence[str], keys: Iterable[PageKey]
+    ) -> Iterator[Tuple]:
+        """Yields ``columns`` of the saved pages of the keys, with one query
+        per ``PAGE_KEY_BATCH_SIZE`` keys.  Each key is looked up in the
+        primary key index, the CROSS JOIN keeps the keys in the outer
+        loop."""
+        keys = list(keys)
+        for start in range(0, len(keys), PAGE_KEY_BATCH_SIZE):
+            batch = keys[start : start + PAGE_KEY_BATCH_SIZE]
+            yield from self.wtp.db_conn.execute(
+                f"""SELECT {", ".join("pages." + c for c in columns)}
+                FROM (VALUES {", ".join(["(?, ?)"] * len(batch))}) AS page_keys
+                CROSS JOIN pages ON pages.title = page_keys.column1
+                AND pages.namespace_id = page_keys.column2""",
+                [value for key in batch for value in key],
+            )
+
+    def iter_pages(
+        self,
+        namespace_ids: Optional[List[int]] = None,
+        include_redirects: bool = True,
+        model: Optional[str] = None,
+        search_pattern: Optional[str] = None,
+        columns: Optional[Iterable[str]] = None,
+    ) -> Iterator["Page"]:
+        columns = self.select_columns(columns)
+        query_str = (
+            "SELECT title, namespace_id"
+            + "".join(", " + column for column in columns)
+            + " FROM pages"
+        )
+        where_str, query_values = self.wtp.build_sql_where_query(
+            namespace_ids, include_redirects, model, search_pattern
+        )
+        query_str += where_str
+        for row in self.wtp.db_conn.execute(query_str, query_values):
+            yield self.page_from_row(columns, row)
+
+    def count_pages(
+        self,
+        namespace_ids: Optional[List[int]] = None,
+        include_redirects: bool = True,
+        model: Optional[str] = None,
+        search_pattern: Optional[str] = None,
+    ) -> int:
+        where_str, query_values = self.wtp.build_sql_where_query(
+            namespace_ids, include_redirects, model, search_pattern
+        )
+        (page_nums,) = self.wtp.db_conn.execute(
+            "SELECT count(*) FROM pages" + where_str, query_values
+        ).fetchone()
+        return page_nums
+
+    def set_need_pre_expand(
+        self, keys: Iterable[PageKey], need_pre_expand: bool = True
+    ) -> None:
+        self.wtp.db_conn.executemany(
+            """UPDATE pages SET need_pre_expand = ?
+            WHERE title = ? AND namespace_id = ?""",
+            ((need_pre_expand, *key) for key in keys),
+        )
+
+    def update_title_keys(self, namespace_ids: Iterable[int]) -> None:
+        namespace_ids = tuple(namespace_ids)
+        self.wtp.db_conn.execute(
+            f"""UPDATE pages
+            SET title_key = page_title_key(title, namespace_id)
+            WHERE namespace_id IN ({','.join('?' * len(namespace_ids))})""",
+            namespace_ids,
+        )
+
+    def iter_redirects(self) -> Iterator[Tuple[str, int, str]]:
+        yield from self.wtp.db_conn.execute(
+            """SELECT title, namespace_id, redirect_to FROM pages
+            WHERE redirect_to IS NOT NULL"""
+        )
+
+    def has_pre_expand_pages(
+        self, namespace_ids: Optional[List[int]] = None
+    ) -> bool:
+        # answered from the pages_need_pre_expand index
+        where_str, query_values = self.wtp.build_sql_where_query(
+            namespace_ids
+        )
+        where_str += " AND " if where_str else " WHERE "
+        (result,) = self.wtp.db_conn.execute(
+            "SELECT EXISTS(SELECT 1 FROM pages"
+            + where_str
+            + "need_pre_expand = 1)",
+            query_values,
+        ).fetchone()
+        return result == 1
+
+    def select_columns(
+        self, columns: Optional[Iterable[str]]
+    ) -> Tuple[str, ...]:
+        """Returns the columns to select for ``page_from_row()``."""
+        columns = core.PAGE_COLUMNS if columns is None else tuple(columns)
+        unknown_columns = set(columns) - set(core.PAGE_COLUMNS)
+        if len(unknown_columns) > 0:
+            raise ValueError(f"Unknown page columns {unknown_columns}")
+        if "body" not in columns:
+            columns += ("length",)
+        return columns
+
+    def page_from_row(self, columns: Sequence[str], row: Sequence) -> "Page":
+        """Returns the page of a row of the title, namespace id and
+        ``columns`` values (``PAGE_COLUMNS`` fields and the length column).
+        The body is read when it is first used if it isn't in ``columns``,
+        fields not in ``PAGE_COLUMNS`` have their default values."""
+        fields = dict(zip(columns, row[2:]))
+        length = fields.pop("length", None)
+        if "need_pre_expand" in fields:
+            fields["need_pre_expand"] = fields["need_pre_expand"] == 1
+        if "body" in fields:
+            fields["body"] = self.wtp._page_body(fields["body"])
+        else:
+            fields["body"] = DeferredBody(
+                partial(self.read_body, row[0], row[1]), length or 0
+            )
+        return core.Page(title=row[0], namespace_id=row[1], **fields)
+
+    def read_body(self, title: str, namespace_id: int) -> Optional[str]:
+        self.wtp.flush_bulk_rows()
+        for (body,) in self.wtp.db_conn.execute(
+            "SELECT body FROM pages WHERE title = ? AND namespace_id = ?",
+            (title, namespace_id),
+        ):
+            return decompress_body(body, self.wtp.body_dictionaries)
+        return None
+
+
+def like_pattern_regex(pattern: str) -> "re.Pattern[str]":
+    """Compiles an SQL LIKE pattern, which is case-insensitive for ASCII
+    letters."""
+    regex = "".join(
+        ".*" if c == "%" else "." if c == "_" else re.escape(c)
+        for c in pattern
+    )
+    return re.compile(regex, re.ASCII | re.DOTALL | re.IGNORECASE)
+
+
+def page_matches(
+    page: "Page",
+    namespace_ids: Optional[List[int]],
+    include_redirects: bool,
+    model: Optional[str],
+    regex: Optional["re.Pattern[str]"],
+) -> bool:
+    """Returns True if the page matches the ``iter_pages()`` arguments,
+    ``regex`` is the compiled ``search_pattern``."""
+    return (
+        (namespace_ids is None or page.namespace_id in namespace_ids)
+        and (include_redirects or page.redirect_to is None)
+        and (model is None or page.model == model)
+        and (
+            regex is None
+            or page.body is not None
+            and regex.fullmatch(page.body) is not None
+        )
+    )
+
+
+class MemoryPageStore(PageStore):
+    """Pages in a dictionary, for tests and small wikis.  The pages aren't
+    saved in the database file, so features that query the pages table
+    (``Wtp.iter_pages()``, the search index, the namespace index and
+    incremental dump parsing) can't be used with this store."""
+
+    def __init__(self) -> None:
+        self.pages: Dict[PageKey, "Page"] = {}
+        self.page_title_keys: Dict[PageKey, str] = {}
+        # (title key, namespace id) -> titles
+        self.titles: DefaultDict[PageKey, Set[str]] = defaultdict(set)
+        # title -> namespace ids, in the order the pages were added
+        self.title_namespace_ids: DefaultDict[str, List[Optional[int]]] = (
+            defaultdict(list)
+        )
+
+    def put_pages(self, rows: Sequence[PageRecord]) -> None:
+        for row in rows:
+            title, namespace_id, body, redirect_to, need_pre_expand, model = (
+                row[:6]
+            )
+            if (title, namespace_id) not in self.pages:
+                self.title_namespace_ids[title].append(namespace_id)
+            self._set_title_key((title, namespace_id), row[9])
+            self.pages[(title, namespace_id)] = core.Page(
+                title=title,
+                namespace_id=namespace_id,
+                redirect_to=redirect_to,
+                need_pre_expand=bool(need_pre_expand),
+                body=body,
+                model=model,
+                page_id=row[6],
+            )
+
+    def _set_title_key(self, key: PageKey, title_key: str) -> None:
+        old_title_key = self.page_title_keys.get(key)
+        if old_title_key is not None:
+            self.titles[(old_title_key, key[1])].discard(key[0])
+        self.page_title_keys[key] = title_key
+        self.titles[(title_key, key[1])].add(key[0])
+
+    def get_page(
+        self,
+        title: str,
+        title_key: str,
+        namespace_id: Optional[int],
+        no_redirect: bool,
+        lazy_body: bool,
+    ) -> Optional["Page"]:
+        if namespace_id is None:
+            candidates = [
+                (title, found_namespace_id)
+                for found_namespace_id in self.title_namespace_ids.get(
+                    title, ()
+                )
+            ]
+        else:
+            candidates = [(title, namespace_id)] + [
+                (found_title, namespace_id)
+                for found_title in sorted(
+                    self.titles.get((title_key, namespace_id), ())
+                )
+            ]
+        for key in candidates:
+            page = self.pages.get(key)
+            if page is not None and not (
+                no_redirect and page.redirect_to is not None
+            ):
+                return dataclasses.replace(page)
+        return None
+
+    def get_pages(
+        self, keys: Iterable[PageKey], lazy_body: bool = False
+    ) -> List["Page"]:
+        return [
+            dataclasses.replace(self.pages[key])
+            for key in keys
+            if key in self.pages
+        ]
+
+    def iter_pages(
+        self,
+        namespace_ids: Optional[List[int]] = None,
+        include_redirects: bool = True,
+        model: Optional[str] = None,
+        search_pattern: Optional[str] = None,
+        columns: Optional[Iterable[str]] = None,
+    ) -> Iterator["Page"]:
+        # pages always have all fields
+        regex = like_pattern_regex(search_pattern) if search_pattern else None
+        for page in list(self.pages.values()):
+            if page_matches(
+                page, namespace_ids, include_redirects, model, regex
+            ):
+                yield dataclasses.replace(page)
+
+    def count_pages(
+        self,
+        namespace_ids: Optional[List[int]] = None,
+        include_redirects: bool = True,
+        model: Optional[str] = None,
+        search_pattern: Optional[str] = None,
+    ) -> int:
+        return sum(
+            1
+            for _ in self.iter_pages(
+                namespace_ids, include_redirects, model, search_pattern
+            )
+        )
+
+    def set_need_pre_expand(
+        self, keys: Iterable[PageKey], need_pre_expand: bool = True
+    ) -> None:
+        for key in keys:
+            page = self.pages.get(key)
+            if page is not None:
+                page.need_pre_expand = need_pre_expand
+
+    def has_pre_expand_pages(
+        self, namespace_ids: Optional[List[int]] = None
+    ) -> bool:
+        return any(
+            page.need_pre_expand
+            and (namespace_ids is None or page.namespace_id in namespace_ids)
+            for page in self.pages.values()
+        )
+
+    def update_title_keys(self, namespace_ids: Iterable[int]) -> None:
+        namespace_ids = set(namespace_ids)
+        for key in list(self.page_title_keys):
+            if key[1] in namespace_ids:
+                self._set_title_key(key, self.wtp.title_key(*key))
@@ -103,7 +103,7 @@ def ifexist_fn(
     arg0 = args[0] if args else ""
     arg1 = args[1] if len(args) >= 2 else ""
     arg2 = args[2] if len(args) >= 3 else ""
-    if ctx.get_page(expander(arg0).strip()) is not None:
+    if ctx.get_page(expander(arg0).strip(), lazy_body=True) is not None:
         return expander(arg1).strip()
     return expander(arg2).strip()
 
@@ -1,3 +1,15 @@
+import bz2
+import gzip
+import io
+import json
+import logging
+import lzma
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
 import unittest
 from collections import namedtuple
 from pathlib import Path
@@ -5,6 +17,12 @@ from unittest.mock import patch
 
 from wikitextprocessor import Wtp
 from wikitextprocessor.dumpparser import (
+    DumpCheckpoint,
+    analyze_and_overwrite_pages,
+    get_first_letter_namespaces,
+    iter_page_chunks,
+    open_dump_file,
+    parse_dump_xml,
     path_is_on_windows_partition,
     process_dump,
 )
@@ -53,3 +71,381 @@ class DumpParserTests(unittest.TestCase):
             {0, 4, 10, 14, 100, 110, 118, 828},
         )
         self.assertGreater(self.wtp.saved_page_nums(), 0)
+        # enwiktionary titles are case-sensitive except in some namespaces
+        self.assertEqual(
+            self.wtp.first_letter_namespaces, {-1, 2, 3, 8, 9, 10, 828}
+        )
+        self.assertIsNotNone(self.wtp.get_page("dictionary", 0).page_id)
+        self.assertIsNone(self.wtp.get_page("Dictionary", 0))
+        self.assertTrue(self.wtp.redirect_targets_resolved)
+        self.assertGreater(self.wtp.redirect_report().resolved, 0)
+
+    def test_process_dump_skip_extract_dump(self):
+        path = "tests/test-pages-articles.xml.bz2"
+        process_dump(self.wtp, path, {0, 10})
+        with patch.object(
+            Wtp, "resolve_redirects"
+        ) as resolve_redirects, patch.object(
+            Wtp, "build_title_filters"
+        ) as build_title_filters:
+            process_dump(self.wtp, path, {0, 10}, skip_extract_dump=True)
+            changes = process_dump(self.wtp, path, {0, 10}, incremental=True)
+        self.assertEqual(changes.changed_titles, set())
+        resolve_redirects.assert_not_called()
+        build_title_filters.assert_not_called()
+        self.assertTrue(self.wtp.redirect_targets_resolved)
+        self.assertTrue(self.wtp.title_filters_saved)
+
+    def test_get_first_letter_namespaces(self):
+        header = b"""<siteinfo>
+        <case>first-letter</case>
+        <namespaces>
+          <namespace key="-2" case="first-letter">Media</namespace>
+          <namespace key="0" />
+          <namespace key="10" case="case-sensitive">Template</namespace>
+        </namespaces>
+        </siteinfo>"""
+        self.assertEqual(get_first_letter_namespaces(header), {-2, 0})
+        self.assertIsNone(get_first_letter_namespaces(b"<mediawiki>"))
+
+    def test_analyze_and_overwrite_pages(self):
+        self.wtp.add_page("Module:foo", 828, "return 1", model="Scribunto")
+        with tempfile.TemporaryDirectory() as temp_dir:
+            override_path = Path(temp_dir, "override.json")
+            override_path.write_text(
+                json.dumps(
+                    {
+                        "Module:foo": {
+                            "body": "return 2",
+                            "model": "Scribunto",
+                        }
+                    }
+                ),
+                encoding="utf-8",
+            )
+            analyze_and_overwrite_pages(self.wtp, [override_path], False)
+        self.assertEqual(self.wtp.get_page_body("foo", 828), "return 2")
+        self.assertFalse(self.wtp.backup_db_path.exists())
+        self.assertEqual(
+            self.wtp.db_conn.execute(
+                "SELECT body FROM pages WHERE title = 'Module:foo'"
+            ).fetchone(),
+            ("return 1",),
+        )
+        # the next run without overrides reverts them
+        analyze_and_overwrite_pages(self.wtp, None, False)
+        self.assertEqual(self.wtp.get_page_body("foo", 828), "return 1")
+
+    def test_iter_page_chunks(self):
+        with bz2.open("tests/test-pages-articles.xml.bz2", "rb") as f:
+            xml = f.read()
+        # page end tags are split between reads
+        chunks = list(iter_page_chunks(io.BytesIO(xml), 10, read_size=5))
+        self.assertTrue(chunks[0].endswith(b"</siteinfo>\n  "))
+        self.assertEqual(
+            b"".join(chunks), xml[: xml.rindex(b"</page>") + len(b"</page>")]
+        )
+        self.assertEqual(
+            [c.count(b"</page>") for c in chunks[1:-1]], [10] * 138
+        )
+        self.assertEqual(chunks[-1].count(b"</page>"), 9)
+
+    def test_open_dump_file(self):
+        with bz2.open("tests/test-pages-articles.xml.bz2", "rb") as f:
+            xml = f.read()
+        compressed = {
+            "bz2": bz2.compress(xml),
+            "gz": gzip.compress(xml),
+            "xz": lzma.compress(xml),
+            "xml": xml,
+        }
+        if shutil.which("zstd") is not None:
+            compressed["zst"] = subprocess.run(
+                ["zstd", "-c"], input=xml, capture_output=True, check=True
+            ).stdout
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for suffix, data in compressed.items():
+                with self.subTest(suffix=suffix):
+                    # the format is detected from the file content
+                    path = Path(temp_dir) / f"{suffix}.dump"
+                    path.write_bytes(data)
+                    with open_dump_file(path) as f:
+                        self.assertEqual(f.read(), xml)
+                    with open_dump_file(io.BytesIO(data)) as f:
+                        self.assertEqual(f.read(), xml)
+
+    def test_open_dump_file_unknown_format(self):
+        with self.assertRaises(ValueError):
+            with open_dump_file(io.BytesIO(b"PK\x03\x04")):
+                pass
+
+    def test_process_dump_file_object(self):
+        with bz2.open("tests/test-pages-articles.xml.bz2", "rb") as f:
+            dump = io.BytesIO(gzip.compress(f.read()))
+        process_dump(self.wtp, dump, {0})
+        self.assertEqual(self.wtp.get_page("dictionary", 0).title, "dictionary")
+
+    def test_process_multistream_dump(self):
+        # Split the test dump file into the multistream format: a header
+        # stream, streams of 100 pages and a footer stream, plus an index
+        # file of "offset:page_id:title" lines.
+        with bz2.open("tests/test-pages-articles.xml.bz2", "rb") as f:
+            xml = f.read()
+        first_page = xml.index(b"<page>")
+        footer = xml.rindex(b"</mediawiki>")
+        pages = [
+            b"<page>" + page
+            for page in xml[first_page:footer].split(b"<page>")
+            if page
+        ]
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp_dir = Path(temp_dir)
+            dump_path = temp_dir / "test-pages-articles-multistream.xml.bz2"
+            index_path = (
+                temp_dir / "test-pages-articles-multistream-index.txt.bz2"
+            )
+            index_lines = []
+            with dump_path.open("wb") as f:
+                f.write(bz2.compress(xml[:first_page]))
+                for i in range(0, len(pages), 100):
+                    offset = f.tell()
+                    for page_id, page in enumerate(pages[i : i + 100], i):
+                        index_lines.append(f"{offset}:{page_id}:title\n")
+                    f.write(bz2.compress(b"".join(pages[i : i + 100])))
+                f.write(bz2.compress(xml[footer:]))
+            with bz2.open(index_path, "wt") as f:
+                f.writelines(index_lines)
+
+            namespace_ids = {0, 4, 10, 14, 100, 110, 118, 828}
+            process_dump(self.wtp, str(dump_path), namespace_ids)
+            wtp = Wtp()
+            process_dump(
+                wtp,
+                "tests/test-pages-articles.xml.bz2",
+                namespace_ids,
+            )
+            self.assertEqual(
+                self.wtp.saved_page_nums(), wtp.saved_page_nums()
+            )
+            self.assertEqual(
+                self.wtp.get_page("dictionary", 0),
+                wtp.get_page("dictionary", 0),
+            )
+            wtp.close_db_conn()
+
+    def test_process_dump_incremental(self):
+        namespace_ids = {0, 4, 10, 14, 100, 110, 118, 828}
+        process_dump(self.wtp, "tests/test-pages-articles.xml.bz2", {4, 0})
+        changes = process_dump(
+            self.wtp,
+            "tests/test-pages-articles.xml.bz2",
+            namespace_ids,
+            incremental=True,
+        )
+        self.assertEqual(changes.deleted_titles, set())
+        self.assertEqual(changes.unchanged_pages, 1374)
+        # pages of the new namespaces
+        self.assertEqual(len(changes.changed_titles), 10)
+
+        # newer dump file: one page changed, one page deleted and one
+        # template added
+        with bz2.open("tests/test-pages-articles.xml.bz2", "rb") as f:
+            xml = f.read()
+        first_page = xml.index(b"<page>")
+        deleted_page = xml.index(b"<page>", first_page + 1)
+        xml = xml[:first_page] + xml[deleted_page:]
+        changed_page = xml.index(b"<title>dictionary</title>")
+        sha1_start = xml.index(b"<sha1>", changed_page) + len(b"<sha1>")
+        sha1_end = xml.index(b"</sha1>", sha1_start)
+        xml = (
+            xml[:changed_page]
+            + xml[changed_page:sha1_start].replace(
+                b"{{also|Dictionary}}", b"{{also|Dictionaries}}"
+            )
+            + b"changed"
+            + xml[sha1_end:]
+        )
+        footer = xml.rindex(b"</mediawiki>")
+        xml = (
+            xml[:footer]
+            + b"""<page><title>Template:test</title><ns>10</ns><id>1</id>
+            <revision><id>2</id><model>wikitext</model>
+            <text>{{#if:1|a}}</text><sha1>test</sha1></revision></page>"""
+            + xml[footer:]
+        )
+        self.wtp.build_search_index()
+        changes = process_dump(
+            self.wtp, io.BytesIO(xml), namespace_ids, incremental=True
+        )
+        self.assertEqual(
+            changes.changed_titles, {"dictionary", "Template:test"}
+        )
+        self.assertEqual(
+            changes.deleted_titles, {"Wiktionary:Welcome, newcomers"}
+        )
+        self.assertIsNone(
+            self.wtp.get_page("Wiktionary:Welcome, newcomers", 4)
+        )
+        self.assertTrue(
+            self.wtp.get_page("dictionary", 0).body.startswith(
+                "{{also|Dictionaries}}"
+            )
+        )
+        self.assertIsNotNone(self.wtp.get_page("Template:test", 10))
+        # pages not from the dump file are kept
+        self.assertIsNotNone(self.wtp.get_page("Template:!", 10))
+        # the search index is updated
+        self.assertEqual(
+            self.wtp.saved_page_nums(search_pattern="%{{also|Dictionaries}}%"),
+            1,
+        )
+        self.assertEqual(
+            self.wtp.saved_page_nums(search_pattern="%{{#if:1|a}}%"), 1
+        )
+        self.wtp.db_conn.execute(
+            "INSERT INTO page_search(page_search, rank) "
+            "VALUES ('integrity-check', 1)"
+        )
+
+    @patch("wikitextprocessor.dumpparser.CHECKPOINT_PAGES", 100)
+    def test_process_dump_resume(self):
+        class InterruptedReader(io.RawIOBase):
+            # raises an error after reading half of the file
+            def __init__(self, data):
+                self.f = io.BytesIO(data)
+                self.limit = len(data) // 2
+
+            def readable(self):
+                return True
+
+            def readinto(self, b):
+                if self.f.tell() >= self.limit:
+                    raise OSError("interrupted")
+                return self.f.readinto(b)
+
+        with bz2.open("tests/test-pages-articles.xml.bz2", "rb") as f:
+            xml = f.read()
+        namespace_ids = {0, 4, 10, 14, 100, 110, 118, 828}
+        with self.assertRaises(OSError):
+            process_dump(self.wtp, InterruptedReader(xml), namespace_ids)
+        checkpoint = DumpCheckpoint.start(self.wtp, "-", True)
+        self.assertGreater(checkpoint.position, 0)
+        self.assertGreaterEqual(checkpoint.pages_collected, 100)
+        self.assertEqual(
+            self.wtp.saved_page_nums(), checkpoint.pages_collected
+        )
+        with self.assertRaises(ValueError):
+            DumpCheckpoint.start(self.wtp, "another-dump.xml.bz2", True)
+
+        process_dump(self.wtp, io.BytesIO(xml), namespace_ids, resume=True)
+        self.assertEqual(self.wtp.saved_page_nums(), 1388)
+        self.assertEqual(
+            DumpCheckpoint.start(self.wtp, "-", True).position, 0
+        )
+
+    @unittest.skipUnless(
+        os.environ.get("WIKITEXTPROCESSOR_BENCHMARK"),
+        "set WIKITEXTPROCESSOR_BENCHMARK=1 to run benchmarks",
+    )
+    def test_parse_dump_memory(self):
+        # Memory use of parsing a dump file should not depend on its size.
+        # The database connection has a cache of up to 256 MiB.
+        from psutil import Process
+
+        page_nums = 1_000_000
+        main_process = Process()
+        start_rss = main_process.memory_info().rss
+        peak_rss = start_rss
+        peak_worker_rss = 0
+        stop_event = threading.Event()
+
+        def sample_rss() -> None:
+            nonlocal peak_rss, peak_worker_rss
+            while not stop_event.wait(0.1):
+                peak_rss = max(peak_rss, main_process.memory_info().rss)
+                for child in main_process.children():
+                    try:
+                        rss = child.memory_info().rss
+                    except Exception:  # exited child process
+                        continue
+                    peak_worker_rss = max(peak_worker_rss, rss)
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            dump_path = Path(temp_dir) / "synthetic-pages-articles.xml.bz2"
+            with bz2.open(dump_path, "wb", compresslevel=1) as f:
+                f.write(
+                    b'<mediawiki xmlns="http://www.mediawiki.org/xml/'
+                    b'export-0.10/">\n  <siteinfo>\n  </siteinfo>\n'
+                )
+                for i in range(page_nums):
+                    f.write(
+                        f"""  <page>
+    <title>page {i}</title>
+    <ns>0</ns>
+    <id>{i}</id>
+    <revision>
+      <model>wikitext</model>
+      <text bytes="30" xml:space="preserve">==English==
+{{{{head|en|noun}}}} # page {i}</text>
+    </revision>
+  </page>
+""".encode()
+                    )
+                f.write(b"</mediawiki>\n")
+
+            wtp = Wtp(db_path=Path(temp_dir) / "synthetic.db")
+            sampler = threading.Thread(target=sample_rss)
+            sampler.start()
+            try:
+                parse_dump_xml(wtp, str(dump_path), {0})
+            finally:
+                stop_event.set()
+                sampler.join()
+            self.assertEqual(wtp.saved_page_nums(), page_nums)
+            wtp.close_db_conn()
+
+        mib = 1024 * 1024
+        self.assertLess(peak_rss - start_rss, 384 * mib)
+        self.assertLess(peak_worker_rss - start_rss, 128 * mib)
+
+    @unittest.skipUnless(
+        os.environ.get("WIKITEXTPROCESSOR_BENCHMARK"),
+        "set WIKITEXTPROCESSOR_BENCHMARK=1 to run benchmarks",
+    )
+    def test_compressed_body_benchmark(self):
+        # Database file size and page scan throughput with and without
+        # compressed page bodies
+        results = {}
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for compress_bodies in (False, True):
+                db_path = Path(temp_dir) / f"{compress_bodies}.db"
+                wtp = Wtp(db_path=db_path, compress_bodies=compress_bodies)
+                process_dump(
+                    wtp,
+                    "tests/test-pages-articles.xml.bz2",
+                    {0, 4, 10, 14, 100, 110, 118, 828},
+                    skip_analyze_templates=True,
+                )
+                wtp.db_conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+                wtp.db_conn.execute("VACUUM")
+                start = time.perf_counter()
+                body_size = sum(len(p.body or "") for p in wtp.get_all_pages())
+                body_scan_time = time.perf_counter() - start
+                start = time.perf_counter()
+                page_nums = sum(1 for _ in wtp.get_all_pages())
+                title_scan_time = time.perf_counter() - start
+                results[compress_bodies] = (
+                    db_path.stat().st_size,
+                    body_size,
+                    page_nums,
+                )
+                logging.info(
+                    f"compress_bodies={compress_bodies}: "
+                    f"{db_path.stat().st_size / 1024 / 1024:.1f} MiB, "
+                    f"{page_nums / body_scan_time:.0f} pages/s with bodies, "
+                    f"{page_nums / title_scan_time:.0f} pages/s without"
+                )
+                wtp.close_db_conn()
+
+        self.assertLess(results[True][0], results[False][0] / 2)
+        self.assertEqual(results[True][1:], results[False][1:])
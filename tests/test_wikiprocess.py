@@ -2,14 +2,67 @@
 #
 # Copyright (c) 2020, 2021, 2022 Tatu Ylonen.  See file LICENSE and https://ylonen.org
 
+import itertools
 import math
+import pickle
+import random
+import sqlite3
+import tempfile
 import time
 import unittest
-from typing import Optional
+from pathlib import Path
+from typing import List, Optional, Set
 from unittest.mock import patch
 
-from wikitextprocessor import Page, Wtp
+from wikitextprocessor import (
+    MemoryPageStore,
+    PackPageStore,
+    Page,
+    UnsupportedPageStoreError,
+    Wtp,
+    write_page_pack,
+)
+from wikitextprocessor.braces import (
+    TEMPLATE_ARG_RE,
+    TEMPLATE_RE,
+    remove_templates,
+    scan_braces,
+)
 from wikitextprocessor.common import MAGIC_NOWIKI_CHAR
+from wikitextprocessor.compression import CompressedBody, DeferredBody
+from wikitextprocessor.core import analyze_template
+from wikitextprocessor.page_cache import PageCache
+
+
+def remove_templates_with_regex_loop(text: str) -> str:
+    # the loop that Wtp.analyze_templates() used before remove_templates()
+    while True:
+        prev = text
+        while True:
+            newt = TEMPLATE_ARG_RE.sub("", prev)
+            if newt == prev:
+                break
+            prev = newt
+        newt = TEMPLATE_RE.sub("", newt)
+        if newt == text:
+            return text
+        text = newt
+
+
+def random_template_body(rng: random.Random, depth: int) -> str:
+    if depth == 0:
+        return rng.choice(["a", "{{{1}}}", "", "|", "}", "{", "{{b}}", "\n"])
+    body = "".join(
+        random_template_body(rng, depth - 1) for _ in range(rng.randrange(3))
+    )
+    kind = rng.random()
+    if kind < 0.4:
+        return "{{" + body + "}}"
+    if kind < 0.7:
+        return "{{{" + body + "}}}"
+    if kind < 0.8:
+        return body + rng.choice(["}", "{", "}}", "{{", "{|", "|}"])
+    return body
 
 
 class WikiProcTests(unittest.TestCase):
@@ -4058,6 +4111,402 @@ return export
         new_ctx.close_db_conn()
         self.assertEqual(ret2, "atest content 2b")
 
+    def test_bulk_load(self):
+        synchronous = self.ctx.db_conn.execute("PRAGMA synchronous").fetchone()
+        with self.ctx.bulk_load(batch_size=2):
+            self.ctx.add_page("Template:a", 10, "a")
+            self.ctx.add_page("Template:b", 10, "b<noinclude>doc</noinclude>")
+            self.ctx.add_page("Template:c", 10, "c")
+            self.assertEqual(len(self.ctx.bulk_rows), 1)  # flushed 2 rows
+            self.assertEqual(
+                self.ctx.db_conn.execute("PRAGMA synchronous").fetchone(),
+                (0,),
+            )
+            # pending rows are written before reading
+            self.assertEqual(self.ctx.get_page("Template:c", 10).body, "c")
+        self.assertIsNone(self.ctx.bulk_rows)
+        self.assertEqual(self.ctx.get_page("Template:b", 10).body, "b")
+        self.assertEqual(self.ctx.saved_page_nums([10]), 6)
+        self.assertEqual(
+            self.ctx.db_conn.execute("PRAGMA synchronous").fetchone(),
+            synchronous,
+        )
+
+    def test_compressed_body(self):
+        body = "==English==\n===Noun===\n{{en-noun}}\n\n# A test.\n" * 20
+        self.ctx.compress_bodies = True
+        self.ctx.add_page("test", 0, body)
+        self.ctx.add_page("short", 0, "short body")
+        saved = dict(
+            self.ctx.db_conn.execute(
+                "SELECT title, body FROM pages WHERE namespace_id = 0"
+            )
+        )
+        self.assertIsInstance(saved["test"], bytes)
+        self.assertLess(len(saved["test"]), len(body))
+        self.assertEqual(saved["short"], "short body")
+        page = self.ctx.get_page("test", 0)
+        self.assertIsInstance(page._body, CompressedBody)
+        self.assertEqual(page.body, body)
+        page = self.ctx.get_page("test", 0)
+        self.assertEqual(pickle.loads(pickle.dumps(page)), page)
+        self.assertEqual(
+            self.ctx.saved_page_nums([0], search_pattern="%en-noun%"), 1
+        )
+
+        # bodies are saved as text by default
+        ctx = Wtp()
+        ctx.add_page("test", 0, body)
+        self.assertEqual(
+            ctx.db_conn.execute("SELECT body FROM pages").fetchone(), (body,)
+        )
+        ctx.close_db_conn()
+
+    def test_compressed_body_dictionary(self):
+        self.ctx.compress_bodies = True
+        with self.ctx.bulk_load():
+            for i in range(100):
+                self.ctx.add_page(
+                    f"page{i}",
+                    0,
+                    f"==English==\n===Noun===\n{{{{en-noun|{i}}}}}\n\n"
+                    f"# A test {i}.\n" * 10,
+                )
+        self.assertEqual(self.ctx.body_dictionary_id, 1)
+        self.assertIn(b"===Noun===\n", self.ctx.body_dictionaries[1])
+        (saved,) = self.ctx.db_conn.execute(
+            "SELECT body FROM pages WHERE title = 'page1'"
+        ).fetchone()
+        self.assertEqual(saved[0], 1)  # dictionary id
+        self.assertTrue(
+            self.ctx.get_page("page1", 0).body.startswith("==English==\n")
+        )
+
+    def test_read_only_db(self):
+        # the file is in the temporary directory, where close_db_conn()
+        # deletes database files it created
+        ctx = Wtp()
+        ctx.add_page("Template:test", 10, "test body")
+        ctx.db_conn.commit()
+        with self.assertRaises(ValueError):  # uncheckpointed WAL file
+            Wtp(db_path=ctx.db_path, read_only=True)
+        ctx.db_conn.close()
+
+        read_only_ctx = Wtp(db_path=ctx.db_path, read_only=True)
+        self.assertEqual(
+            read_only_ctx.get_page("Template:test", 10).body, "test body"
+        )
+        with self.assertRaises(sqlite3.OperationalError):
+            read_only_ctx.add_page("Template:test2", 10, "test")
+        with self.assertRaises(sqlite3.OperationalError):
+            read_only_ctx.analyze_templates()
+        read_only_ctx.close_db_conn()
+        self.assertTrue(ctx.db_path.exists())
+        ctx.db_path.unlink()
+
+    def test_page_cache(self):
+        cache = self.ctx.page_cache
+        self.assertIsNone(self.ctx.get_page("foo", 10))
+        self.assertIsNone(self.ctx.get_page("foo", 10))
+        self.assertEqual(cache.stats.hits, 1)
+        # saving the page invalidates the cached lookup
+        self.ctx.add_page("Template:Foo", 10, "foo")
+        self.assertEqual(self.ctx.get_page("foo", 10).body, "foo")
+        self.assertEqual(self.ctx.get_page("foo", 10).body, "foo")
+        self.assertEqual(cache.stats.hits, 2)
+        self.ctx.add_page("Template:Foo", 10, "bar")
+        self.assertEqual(self.ctx.get_page("foo", 10).body, "bar")
+        self.ctx.set_template_pre_expand("Template:Foo")
+        self.assertTrue(self.ctx.get_page("foo", 10).need_pre_expand)
+        # pages of other namespaces don't evict templates
+        self.ctx.page_cache = PageCache({10: 100000, None: 1000})
+        cache = self.ctx.page_cache
+        self.ctx.get_page("foo", 10)
+        for i in range(10):
+            self.ctx.add_page(f"page{i}", 0, f"page {i}")
+            self.ctx.get_page(f"page{i}", 0)
+        self.assertEqual(len(cache.pool(0).entries), 3)
+        self.assertEqual(cache.stats.evictions, 7)
+        self.ctx.get_page("foo", 10)
+        self.assertEqual(cache.pool(10).stats.hits, 1)
+
+    def test_namespace_index(self):
+        self.ctx.add_page("Template:Foo", 10, "foo")
+        self.ctx.add_page("Template:bar", 10, redirect_to="Template:Foo")
+        self.ctx.add_page("Module:baz", 828, "return {}", model="Scribunto")
+        self.ctx.add_page("page", 0, "page")
+        index = self.ctx.load_namespace_index()
+        self.assertEqual(index.page_nums, 6)
+        self.assertGreater(index.memory_size, 0)
+        queries = []
+        self.ctx.db_conn.set_trace_callback(queries.append)
+        self.assertEqual(self.ctx.get_page("foo", 10).title, "Template:Foo")
+        self.assertIsNone(self.ctx.get_page("bar", 10, True))
+        self.assertFalse(self.ctx.page_exists("Template:missing", 10))
+        self.assertEqual(
+            self.ctx.get_page_resolve_redirect("Template:bar", 10).body, "foo"
+        )
+        self.assertEqual(self.ctx.get_page_body("baz", 828), "return {}")
+        self.assertEqual(queries, [])
+        self.assertEqual(self.ctx.get_page("page", 0).body, "page")
+        self.assertEqual(len(queries), 1)
+        self.ctx.db_conn.set_trace_callback(None)
+        # saved pages are added to the index
+        self.ctx.add_page("Template:new", 10, "new")
+        self.ctx.set_template_pre_expand("Template:new")
+        self.assertTrue(self.ctx.namespace_index.pages[10]["Template:new"][1])
+        self.assertTrue(self.ctx.get_page("new", 10).need_pre_expand)
+
+    def test_title_filters(self):
+        self.ctx.add_page("Template:Foo", 10, "foo")
+        self.ctx.add_page("page", 0, "page")
+        self.ctx.build_title_filters()
+        queries = []
+        self.ctx.db_conn.set_trace_callback(queries.append)
+        self.assertFalse(self.ctx.page_exists("undefined", 10))
+        self.assertIsNone(self.ctx.get_page("Template:undefined"))
+        self.assertFalse(self.ctx.page_exists("page", 14))
+        self.assertEqual(queries, [])
+        self.assertTrue(self.ctx.page_exists("foo", 10))
+        self.assertTrue(self.ctx.page_exists("page"))
+        self.ctx.db_conn.set_trace_callback(None)
+
+        # filters are loaded from the database
+        ctx = Wtp(db_path=self.ctx.db_path)
+        self.assertIsNotNone(ctx.title_filters)
+        self.assertFalse(ctx.title_filters.might_exist(10, ["Template:bar"]))
+        self.assertTrue(ctx.title_filters.might_exist(10, ["Template:Foo"]))
+        ctx.db_conn.close()  # close_db_conn() would delete the file
+
+        # saving a page updates the filters and deletes the saved filters
+        self.ctx.add_page("Template:bar", 10, "bar")
+        self.assertTrue(self.ctx.page_exists("bar", 10))
+        self.ctx.add_page("Category:baz", 14, "baz")
+        self.assertIsNotNone(self.ctx.get_page("Category:baz"))
+        self.assertTrue(self.ctx.page_exists("baz", 14))
+        self.assertEqual(
+            self.ctx.db_conn.execute(
+                "SELECT count(*) FROM title_filters"
+            ).fetchone(),
+            (0,),
+        )
+
+    def test_search_index(self):
+        body = "==English==\n{{en-noun}}\n" + "# a definition\n" * 50
+        self.ctx.add_page("foo", 0, body)
+        self.ctx.add_page("bar", 0, "{{en-verb}}")
+        self.ctx.build_search_index()
+        self.assertTrue(self.ctx.has_search_index)
+        self.assertEqual(
+            [
+                page.title
+                for page in self.ctx.get_all_pages(search_pattern="%en-noun%")
+            ],
+            ["foo"],
+        )
+        # the index is updated when pages are saved or deleted
+        self.ctx.add_page("baz", 0, "{{EN-NOUN}}")
+        self.ctx.add_page("bar", 0, "{{en-noun}}")
+        self.assertEqual(
+            self.ctx.saved_page_nums([0], search_pattern="%en-noun%"), 3
+        )
+        self.ctx.page_store.delete_from_search_index([("foo", 0)])
+        self.ctx.db_conn.execute("DELETE FROM pages WHERE title = 'foo'")
+        self.assertEqual(
+            self.ctx.saved_page_nums([0], search_pattern="%en-noun%"), 2
+        )
+        self.assertEqual(
+            self.ctx.saved_page_nums(search_pattern="%en-verb%"), 0
+        )
+        # other SQLite clients can change the pages, without the
+        # page_body() function of Wtp
+        self.ctx.db_conn.commit()
+        other_conn = sqlite3.connect(self.ctx.db_path)
+        with other_conn:
+            other_conn.execute(
+                "UPDATE pages SET body = '{{en-verb}}' WHERE title = 'bar'"
+            )
+        other_conn.close()
+        self.assertEqual(
+            self.ctx.saved_page_nums(search_pattern="%en-verb%"), 0
+        )
+        self.ctx.build_search_index()
+        self.assertEqual(
+            self.ctx.saved_page_nums(search_pattern="%en-verb%"), 1
+        )
+        self.ctx.drop_search_index()
+        self.assertEqual(
+            self.ctx.saved_page_nums([0], search_pattern="%en-noun%"), 1
+        )
+
+    def test_iter_pages(self):
+        for i in range(10):
+            self.ctx.add_page(f"page{i}", 0, f"body{i}")
+        titles = {page.title for page in self.ctx.get_all_pages([0])}
+
+        def shard_titles() -> List[List[str]]:
+            return [
+                [
+                    page.title
+                    for _, page in self.ctx.iter_pages(
+                        shard,
+                        3,
+                        batch_size=2,
+                        namespace_ids=[0],
+                        shard_block_size=2,
+                    )
+                ]
+                for shard in range(3)
+            ]
+
+        shards = shard_titles()
+        self.assertEqual(sum(len(shard) for shard in shards), 10)
+        self.assertEqual(set().union(*shards), titles)
+        self.assertTrue(all(len(shard) > 0 for shard in shards))
+        # adding pages doesn't move the other pages to another shard
+        for i in range(10, 20):
+            self.ctx.add_page(f"page{i}", 0, f"body{i}")
+        self.assertEqual(
+            [
+                new_shard[: len(shard)]
+                for shard, new_shard in zip(shards, shard_titles())
+            ],
+            shards,
+        )
+
+        # resume after the cursor of the third page
+        pages = list(self.ctx.iter_pages(namespace_ids=[0]))
+        self.assertEqual(
+            list(self.ctx.iter_pages(after=pages[2][0], namespace_ids=[0])),
+            pages[3:],
+        )
+        pages = list(self.ctx.iter_pages(1, 3, shard_block_size=2))
+        self.assertEqual(
+            list(
+                self.ctx.iter_pages(
+                    1, 3, after=pages[2][0], shard_block_size=2
+                )
+            ),
+            pages[3:],
+        )
+        _, page = next(
+            self.ctx.iter_pages(
+                columns=["need_pre_expand"], namespace_ids=[0]
+            )
+        )
+        self.assertEqual(page.title, "page0")
+        self.assertFalse(page.need_pre_expand)
+        self.assertIsNone(page.model)
+        self.assertEqual(page.body, "body0")  # read when it is used
+        with self.assertRaises(ValueError):
+            next(self.ctx.iter_pages(columns=["text"]))
+        with self.assertRaises(ValueError):
+            next(self.ctx.iter_pages(3, 3))
+
+    def test_iter_pages_overrides(self):
+        self.ctx.add_page("a", 0, "a")
+        self.ctx.add_page("b", 0, "b")
+        self.ctx.add_page("c", 0, "c")
+        self.ctx.add_page_override("b", 0, redirect_to="a")
+        self.ctx.add_page_override("d", 0, "d", model="text")
+
+        def titles(**kwargs) -> List[str]:
+            return [
+                page.title
+                for _, page in self.ctx.iter_pages(namespace_ids=[0], **kwargs)
+            ]
+
+        pages = list(
+            self.ctx.iter_pages(columns=["redirect_to"], namespace_ids=[0])
+        )
+        self.assertEqual(
+            [(page.title, page.redirect_to) for _, page in pages],
+            [("b", "a"), ("d", None), ("a", None), ("c", None)],
+        )
+        self.assertIsNone(pages[1][1].model)
+        self.assertEqual(pages[1][1].body, "d")
+        self.assertEqual(titles(after=pages[0][0]), ["d", "a", "c"])
+        self.assertEqual(titles(include_redirects=False), ["d", "a", "c"])
+        self.assertEqual(titles(model="text"), ["d"])
+        self.assertEqual(
+            [
+                titles(shard=shard, num_shards=2, shard_block_size=3)
+                for shard in range(2)
+            ],
+            [["b", "d"], ["a", "c"]],
+        )
+
+    def test_lazy_body(self):
+        body = "{{en-noun}}\n" * 100
+        self.ctx.add_page("foo", 0, body)
+        queries = []
+        self.ctx.db_conn.set_trace_callback(queries.append)
+        page = self.ctx.get_page("foo", 0, lazy_body=True)
+        self.assertIsInstance(page._body, DeferredBody)
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(page.body, body)
+        self.assertEqual(len(queries), 2)
+        self.ctx.db_conn.set_trace_callback(None)
+        # the cached page has the body now
+        self.assertEqual(self.ctx.get_page("foo", 0).body, body)
+
+        pages = list(
+            self.ctx.get_all_pages([0], columns=["need_pre_expand", "model"])
+        )
+        self.assertEqual(len(pages), 1)
+        self.assertIsInstance(pages[0]._body, DeferredBody)
+        self.assertEqual(pages[0]._body.length, len(body))
+        self.assertEqual(pages[0].body, body)
+        self.assertEqual(pickle.loads(pickle.dumps(pages[0])), pages[0])
+        self.assertEqual(list(self.ctx.get_all_pages([0])), pages)
+
+    def test_title_key(self):
+        self.ctx.add_page("Template:foo", 10, "foo")
+        self.ctx.add_page("User:bar", 2, "bar")
+        self.ctx.add_page("baz", 0, "baz")
+        self.assertEqual(self.ctx.get_page("Foo", 10).title, "Template:foo")
+        self.assertIsNone(self.ctx.get_page("Bar", 2))
+        self.assertIsNone(self.ctx.get_page("Baz", 0))
+        # the saved title keys are updated for the new case rules
+        self.ctx.set_first_letter_namespaces({0, 2})
+        self.assertEqual(self.ctx.get_page("User:Bar", 2).title, "User:bar")
+        self.assertEqual(self.ctx.get_page("Baz", 0).body, "baz")
+        self.assertEqual(self.ctx.get_page("foo", 10).body, "foo")
+        # the exact title is preferred
+        self.ctx.add_page("Baz", 0, "Baz")
+        self.assertEqual(self.ctx.get_page("Baz", 0).body, "Baz")
+        self.assertEqual(self.ctx.get_page("baz", 0).body, "baz")
+        # other letters are case-sensitive
+        self.assertIsNone(self.ctx.get_page("BAZ", 0))
+
+    def test_migrate_db(self):
+        self.ctx.add_page("Template:foo", 10, "foo")
+        self.ctx.db_conn.executescript(
+            """
+            DROP INDEX pages_title_key;
+            DROP INDEX pages_redirect_to;
+            DROP INDEX pages_need_pre_expand;
+            ALTER TABLE pages DROP COLUMN title_key;
+            ALTER TABLE pages DROP COLUMN length;
+            ALTER TABLE pages DROP COLUMN flags;
+            ALTER TABLE pages DROP COLUMN page_id;
+            ALTER TABLE pages DROP COLUMN revision_id;
+            ALTER TABLE pages DROP COLUMN sha1;
+            PRAGMA user_version = 0;
+            """
+        )
+        self.ctx.db_conn.close()
+        ctx = Wtp(db_path=self.ctx.db_path)
+        self.assertEqual(
+            ctx.db_conn.execute(
+                "SELECT title_key, length, flags FROM pages WHERE title = ?",
+                ("Template:foo",),
+            ).fetchall(),
+            [("Template:Foo", 3, 0)],
+        )
+        self.assertEqual(ctx.get_page("Foo", 10).body, "foo")
+        ctx.db_conn.close()  # the file is deleted in tearDown()
+
     def test_lua_max_time1(self):
         t = time.time()
         self.scribunto(
@@ -4148,10 +4597,235 @@ return export
         )
         self.ctx.add_page("Template:En-nm", 10, body="{{-n2-|英語}}")
         self.ctx.analyze_templates()
-        self.ctx.get_page.cache_clear()
         page = self.ctx.get_page("Template:En-nm", 10)
         self.assertTrue(page.need_pre_expand)
 
+    @patch("wikitextprocessor.core.ANALYZE_BATCH_SIZE", 2)
+    def test_analyze_templates_processes(self) -> None:
+        self.ctx.add_page("Template:list", 10, body="* item")
+        self.ctx.add_page("Template:uses list", 10, body="{{list}}")
+        self.ctx.add_page("Template:uses uses list", 10, body="{{uses list}}")
+        self.ctx.add_page("Template:table", 10, body='{| class="wikitable"')
+        self.ctx.add_page("Template:text", 10, body="text")
+        self.ctx.analyze_templates(num_processes=2)
+        for title, need_pre_expand in [
+            ("Template:list", True),
+            ("Template:uses list", True),
+            ("Template:uses uses list", True),
+            ("Template:table", True),
+            ("Template:text", False),
+            ("Template:!", False),
+        ]:
+            with self.subTest(title=title):
+                page = self.ctx.get_page(title, 10)
+                self.assertEqual(page.need_pre_expand, need_pre_expand)
+
+    def test_analyze_templates_propagation(self) -> None:
+        self.ctx.add_page("Template:list", 10, body="* item")
+        self.ctx.add_page(
+            "Template:list alias", 10, redirect_to="Template:list"
+        )
+        self.ctx.add_page("Template:uses alias", 10, body="{{list alias}}")
+        self.ctx.add_page("Template:uses uses alias", 10, body="{{uses alias}}")
+        self.ctx.add_page("Template:text", 10, body="text")
+        self.ctx.add_page(
+            "Template:text alias", 10, redirect_to="Template:text"
+        )
+        self.ctx.analyze_templates()
+        for title, need_pre_expand in [
+            ("Template:list", True),
+            ("Template:list alias", True),
+            ("Template:uses alias", True),
+            ("Template:uses uses alias", True),
+            ("Template:text", False),
+            ("Template:text alias", False),
+        ]:
+            with self.subTest(title=title):
+                page = self.ctx.get_page(title, 10)
+                self.assertEqual(page.need_pre_expand, need_pre_expand)
+
+    def test_update_template_analysis(self) -> None:
+        self.ctx.add_page("Template:a", 10, body="{{b}}")
+        self.ctx.add_page("Template:b", 10, body="text")
+        self.ctx.add_page("Template:b alias", 10, redirect_to="Template:b")
+        self.ctx.add_page("Template:c", 10, body="{{b alias}}")
+        self.ctx.add_page("Template:d", 10, body="{{e}}")
+        self.ctx.add_page("Template:e", 10, body="* item")
+        self.assertFalse(self.ctx.has_analyzed_templates())
+        self.ctx.analyze_templates()
+        self.assertTrue(self.ctx.has_analyzed_templates())
+        self.assertFalse(self.ctx.page_store.has_pre_expand_pages([0]))
+        self.assertTrue(self.ctx.has_template_links())
+
+        def need_pre_expand() -> Set[str]:
+            return {
+                page.title
+                for page in self.ctx.get_all_pages([10])
+                if page.need_pre_expand
+            }
+
+        self.assertEqual(need_pre_expand(), {"Template:d", "Template:e"})
+        self.ctx.add_page("Template:b", 10, body='{| class="wikitable"')
+        self.ctx.add_page("Template:e", 10, body="text")
+        self.ctx.update_template_analysis(["Template:b", "e"])
+        self.assertEqual(
+            need_pre_expand(),
+            {"Template:a", "Template:b", "Template:b alias", "Template:c"},
+        )
+        self.ctx.add_page("Template:b", 10, body="text")
+        self.ctx.update_template_analysis(["Template:b"])
+        self.assertEqual(need_pre_expand(), set())
+
+        self.ctx.add_page_override("Template:e", 10, body="* item")
+        self.ctx.update_template_analysis(["Template:e"])
+        self.assertEqual(need_pre_expand(), {"Template:d", "Template:e"})
+        # only the flag of the saved page is overridden
+        self.assertEqual(
+            list(self.ctx.page_overrides.pages), [("Template:e", 10)]
+        )
+        self.assertEqual(
+            self.ctx.pre_expand_overrides, {("Template:d", 10): True}
+        )
+        self.assertTrue(self.ctx.get_page("Template:d", 10).need_pre_expand)
+        self.ctx.clear_page_overrides()
+        self.assertEqual(need_pre_expand(), set())
+        self.assertFalse(self.ctx.get_page("Template:d", 10).need_pre_expand)
+        self.assertEqual(self.ctx.pre_expand_overrides, {})
+
+        # a Chinese subtitle template that redirects
+        self.ctx.close_db_conn()
+        self.ctx = Wtp(lang_code="zh")
+        self.ctx.add_page("Template:noun", 10, body="名詞")
+        self.ctx.add_page("Template:-n-", 10, redirect_to="Template:noun")
+        self.ctx.add_page("Template:x", 10, body="{{-n-}}")
+        self.ctx.analyze_templates()
+        zh_titles = {"Template:noun", "Template:-n-", "Template:x"}
+        self.assertEqual(need_pre_expand(), zh_titles)
+        self.ctx.add_page("Template:-n-", 10, redirect_to="Template:noun")
+        self.ctx.update_template_analysis(["Template:-n-"])
+        self.assertEqual(need_pre_expand(), zh_titles)
+
+    def test_compiled_template_body(self) -> None:
+        body = "[[{{{1}}}|{{{2|{{{1}}}}}}]]{{#if:{{{3|}}}|({{{3}}})}}"
+        compiled = self.ctx.compile_template_body(body)
+        self.assertEqual(len(compiled.text), 2)
+        self.assertEqual(compiled.cookies[0], ("A", ("1",), False))
+        self.assertEqual(len(compiled.parts), 2)
+        self.assertEqual(compiled.arg_parts[0], (("1",),))
+        self.assertEqual(self.ctx.cookies, [])
+        self.ctx.add_page("Template:l", 10, body=body)
+        for title in ["Tt", "Tt2"]:
+            with self.subTest(title=title):
+                self.ctx.start_page(title)
+                self.assertEqual(
+                    self.ctx.expand("{{l|a}} {{l|a|b|c}} {{l|d}}"),
+                    "[[a|a]] [[a|b]](c) [[d|d]]",
+                )
+        self.assertEqual(list(self.ctx.compiled_bodies), [body])
+
+    def test_compiled_template_body_same_as_expand_args(self) -> None:
+        bodies = [
+            "a{{{1}}}b{{{x y|d}}}c",
+            "{{{ {{{2|1}}} }}}|{{{{{{3}}}|e}}}",
+            "[[{{{1}}}]] [http://x.org/{{{2|}}} {{{1}}}] [[:{{{n|}}}]]",
+            "{{#if:{{{1|}}}|[[{{{1}}}|{{{2|{{{1}}}}}}]]|none}}",
+            "<nowiki>{{{1}}}</nowiki>{{{1}}}{{{1<nowiki />}}}",
+            "{{{1|{{{2|{{{3|{{lc:ABC}}}}}}}}}}",
+        ]
+        text = "{{t|A|B}} {{t|x y=C|3=D}} {{t}}"
+        results = []
+        for body in bodies:
+            self.ctx.add_page("Template:t", 10, body=body)
+            self.ctx.start_page("Tt")
+            results.append(self.ctx.expand(text))
+        with patch.object(Wtp, "_get_compiled_body", return_value=None):
+            for body, result in zip(bodies, results):
+                with self.subTest(body=body):
+                    self.ctx.add_page("Template:t", 10, body=body)
+                    self.ctx.start_page("Tt")
+                    self.assertEqual(self.ctx.expand(text), result)
+
+    def test_remove_templates(self) -> None:
+        for text, expected in [
+            ("a{{b}}c", "ac"),
+            ("a{{{1|{{b|{{{2}}}}}}}}c", "ac"),
+            ("{{{{{1}}}|x}}", ""),
+            ("{{{{a}}}}", "{}"),
+            ("{{{a}}}}}", "}}"),
+            ("{{a}{b}}", ""),
+            ("{{{a}}b}}}", ""),
+            ("x}}{{y", "x}}{{y"),
+            # a table start stops the template from being removed
+            ("{{a|\n{|\n|}\n}}", "{{a|\n{|\n|}\n}}"),
+        ]:
+            with self.subTest(text=text):
+                self.assertEqual(remove_templates(text), expected)
+                self.assertEqual(scan_braces(text), expected)
+
+    def test_remove_templates_same_as_regex_loop(self) -> None:
+        rng = random.Random(0)
+        texts = [
+            "{{{{{{{   }}{{{}} b}}}}|",
+            "aa{{{{{{{{{\n}}}{{ \na}}}",
+            "{{}{{{{}}}}}",
+        ]
+        # all short texts of braces and one other character
+        for length in range(9):
+            texts.extend(
+                "".join(chars)
+                for chars in itertools.product("{}a", repeat=length)
+            )
+        texts.extend(
+            "".join(rng.choice("{}a| \n") for _ in range(rng.randrange(40)))
+            for _ in range(3000)
+        )
+        texts.extend(
+            random_template_body(rng, rng.randrange(1, 12)) for _ in range(1000)
+        )
+        for text in texts:
+            expected = remove_templates_with_regex_loop(text)
+            if (
+                remove_templates(text) != expected
+                or scan_braces(text) != expected
+            ):
+                with self.subTest(text=text):
+                    self.assertEqual(remove_templates(text), expected)
+                    self.assertEqual(scan_braces(text), expected)
+
+    def test_analyze_template_after_regex_passes(self) -> None:
+        # nested deeper than the regular expression passes of
+        # remove_templates(), all templates are removed
+        body = (
+            "{{<div>{{{{{{{{{{{{{{{{{{{{{{{{|}}}}}}}}}}{{{{{{{{{{{{{b}}{{b}}}}}"
+            "{{|{{b}}}}}}}}}}{{{{{{{{{{{{b}}}}}}}}}}}}}}}}}}}}}}}}}}}}}}"
+        )
+        self.assertEqual(remove_templates_with_regex_loop(body), "")
+        self.assertEqual(remove_templates(body), "")
+        self.assertEqual(
+            analyze_template("Template:a", body, "en", "Template"),
+            ({"b"}, False),
+        )
+
+    def test_remove_deeply_nested_templates(self) -> None:
+        text = "<div>" + "{{#if:{{{1|}}}|{{a}}|" * 2000 + "}}" * 2000 + "\n|-"
+        self.assertEqual(remove_templates(text), "<div>\n|-")
+        self.assertEqual(
+            analyze_template("Template:b", text, "en", "Template"),
+            ({"a"}, True),
+        )
+
+    def test_analyze_template_files(self) -> None:
+        # benchmark fixtures of slow template bodies
+        for path, used_templates, pre_expand in [
+            ("tests/nested-template.txt", {"documentation"}, False),
+            ("tests/navbox-template.txt", {"#invoke:navbox", "l", "q"}, True),
+        ]:
+            with self.subTest(path=path), open(path) as f:
+                self.assertEqual(
+                    analyze_template("Template:a", f.read(), "en", "Template"),
+                    (used_templates, pre_expand),
+                )
+
     def test_get_page_resolve_redirect_infinite_recursion(self):
         self.ctx.add_page("Template:cite-book", 10, body="cite-book")
         self.ctx.add_page(
@@ -4162,6 +4836,51 @@ return export
         self.assertEqual(page.title, "Template:cite-book")
         self.assertEqual(page.body, "cite-book")
 
+    def test_get_page_resolve_redirect_chain(self):
+        self.ctx.add_page("Template:foo", 10, body="foo")
+        self.ctx.add_page("Template:bar", 10, redirect_to="Template:foo")
+        self.ctx.add_page("Template:baz", 10, redirect_to="Template:bar")
+        self.ctx.add_page("Template:a", 10, redirect_to="Template:b")
+        self.ctx.add_page("Template:b", 10, redirect_to="Template:a")
+        self.ctx.add_page("Template:c", 10, redirect_to="Template:missing")
+        # followed one page at a time
+        self.assertEqual(self.ctx.get_page_body("baz", 10), "foo")
+        self.assertIsNone(self.ctx.get_page_resolve_redirect("a", 10))
+
+        report = self.ctx.resolve_redirects()
+        self.assertEqual(report.resolved, 2)
+        self.assertEqual(report.broken, [("Template:c", 10)])
+        self.assertEqual(
+            report.cyclic, [("Template:a", 10), ("Template:b", 10)]
+        )
+        self.assertEqual(self.ctx.redirect_report(), report)
+        queries = []
+        self.ctx.db_conn.set_trace_callback(queries.append)
+        page = self.ctx.get_page_resolve_redirect("Baz", 10)
+        self.assertEqual(page.title, "Template:foo")
+        self.assertEqual(len(queries), 1)
+        self.ctx.db_conn.set_trace_callback(None)
+        self.assertEqual(self.ctx.get_page_body("foo", 10), "foo")
+        self.assertIsNone(self.ctx.get_page_resolve_redirect("b", 10))
+        self.assertIsNone(self.ctx.get_page_resolve_redirect("c", 10))
+        self.assertIsNone(self.ctx.get_page_resolve_redirect("d", 10))
+
+        # saving a page deletes the resolved chains that look it up
+        self.ctx.add_page("Template:missing", 10, body="missing")
+        self.assertTrue(self.ctx.redirect_targets_resolved)
+        self.assertEqual(self.ctx.get_page_body("c", 10), "missing")
+        report = self.ctx.redirect_report()
+        self.assertEqual((report.resolved, report.broken), (2, []))
+        self.assertEqual(len(report.cyclic), 2)
+        self.ctx.add_page("Template:foo", 10, redirect_to="Template:missing")
+        self.assertEqual(self.ctx.redirect_report().resolved, 0)
+        self.assertEqual(self.ctx.get_page_body("baz", 10), "missing")
+        self.assertIsNone(self.ctx.get_page_resolve_redirect("b", 10))
+        self.ctx.add_page("Template:b", 10, body="b")
+        self.assertEqual(self.ctx.redirect_report().cyclic, [])
+        self.assertEqual(self.ctx.get_page_body("a", 10), "b")
+        self.assertEqual(self.ctx.resolve_redirects().resolved, 5)
+
     def test_query_page_title_case(self):
         self.ctx.add_page("Template:Q", 10, "")
         self.ctx.add_page("Template:q", 10, "")
@@ -4172,6 +4891,179 @@ return export
     def test_get_page_empty_title(self):
         self.assertEqual(self.ctx.get_page(""), None)
 
+    @patch("wikitextprocessor.page_store.PAGE_KEY_BATCH_SIZE", 2)
+    def test_sqlite_page_store_get_pages(self):
+        for title in "abcde":
+            self.ctx.add_page(title, 0, title * 2)
+        pages = self.ctx.page_store.get_pages(
+            [(title, 0) for title in "edcbax"] + [("Template:!", 10)]
+        )
+        self.assertEqual(
+            sorted((page.title, page.body) for page in pages),
+            [
+                ("Template:!", "|"),
+                ("a", "aa"),
+                ("b", "bb"),
+                ("c", "cc"),
+                ("d", "dd"),
+                ("e", "ee"),
+            ],
+        )
+
+    def test_memory_page_store(self):
+        ctx = Wtp(page_store=MemoryPageStore())
+        try:
+            ctx.add_page("Template:Q", 10, "Q")
+            ctx.add_page("Template:q", 10, "q")
+            ctx.add_page("Template:foo", 10, "{|")
+            ctx.add_page("Template:bar", 10, redirect_to="Template:foo")
+            ctx.add_page("Template:baz", 10, "{{foo}}")
+            ctx.add_page("Foo", 0, "en-noun text")
+            ctx.add_page("foo", 0, "fi-noun text")
+            self.assertEqual(ctx.get_page("q", 10).body, "q")
+            self.assertEqual(ctx.get_page("Template:q").body, "q")
+            self.assertEqual(ctx.get_page("Foo", 0).title, "Foo")
+            self.assertIsNone(ctx.get_page("Missing", 0))
+            self.assertIsNone(ctx.get_page("bar", 10, no_redirect=True))
+            self.assertEqual(ctx.get_page_body("bar", 10), "{|")
+            self.assertEqual(ctx.saved_page_nums([10]), 5)
+            self.assertEqual(ctx.saved_page_nums(include_redirects=False), 6)
+            self.assertEqual(
+                [
+                    page.title
+                    for page in ctx.get_all_pages(search_pattern="%EN-noun%")
+                ],
+                ["Foo"],
+            )
+            self.assertFalse(ctx.has_analyzed_templates())
+            ctx.analyze_templates()
+            self.assertTrue(ctx.has_analyzed_templates())
+            for title in ("foo", "bar", "baz"):
+                self.assertTrue(ctx.get_page(title, 10).need_pre_expand)
+            self.assertFalse(ctx.get_page("q", 10).need_pre_expand)
+            self.assertEqual(ctx.resolve_redirects().resolved, 1)
+            self.assertEqual(ctx.get_page_body("bar", 10), "{|")
+            # main namespace titles are case-insensitive in some wikis
+            ctx.set_first_letter_namespaces({0, 10})
+            self.assertEqual(ctx.get_page("foo", 0).title, "foo")
+            ctx.add_page("Bar", 0, "bar")
+            self.assertEqual(ctx.get_page("bar", 0).title, "Bar")
+            self.assertEqual(
+                ctx.db_conn.execute("SELECT count(*) FROM pages").fetchone(),
+                (0,),
+            )
+            with self.assertRaises(UnsupportedPageStoreError):
+                list(ctx.iter_pages())
+            with self.assertRaises(UnsupportedPageStoreError):
+                ctx.build_search_index()
+        finally:
+            ctx.close_db_conn()
+
+    def test_page_overrides(self):
+        self.ctx.add_page("Template:foo", 10, "foo")
+        self.ctx.add_page("Template:bar", 10, "{{foo}}")
+        self.ctx.add_page("Module:baz", 828, "return {}", model="Scribunto")
+        self.ctx.analyze_templates()
+        self.ctx.build_title_filters()
+        self.ctx.add_page_override(
+            "Module:baz", 828, "return {1}", model="Scribunto"
+        )
+        self.ctx.add_page_override("Template:foo", 10, "{|")
+        self.ctx.add_page_override("Template:new", 10, "new")
+        self.assertEqual(self.ctx.get_page_body("baz", 828), "return {1}")
+        self.assertEqual(self.ctx.get_page_body("new", 10), "new")
+        self.assertEqual(self.ctx.saved_page_nums([10]), 6)
+        self.assertEqual(
+            sorted(
+                page.body for page in self.ctx.get_all_pages([10, 828])
+            ),
+            [
+                "&lbrace;&lbrace;",
+                "&rbrace;&rbrace;",
+                "new",
+                "return {1}",
+                "{{foo}}",
+                "{|",
+                "|",
+            ],
+        )
+        self.ctx.analyze_templates()
+        self.assertTrue(self.ctx.get_page("foo", 10).need_pre_expand)
+        self.assertTrue(self.ctx.get_page("bar", 10).need_pre_expand)
+        self.assertEqual(
+            self.ctx.db_conn.execute(
+                """SELECT count(*) FROM pages
+                WHERE need_pre_expand = 1 OR body = 'return {1}'"""
+            ).fetchone(),
+            (0,),
+        )
+
+        # the overrides are loaded from the database
+        self.ctx.db_conn.commit()
+        ctx = Wtp(db_path=self.ctx.db_path)
+        self.assertEqual(ctx.get_page_body("baz", 828), "return {1}")
+        self.assertTrue(ctx.get_page("bar", 10).need_pre_expand)
+        ctx.db_conn.close()
+
+        self.ctx.clear_page_overrides()
+        self.assertEqual(self.ctx.get_page_body("baz", 828), "return {}")
+        self.assertEqual(self.ctx.get_page_body("foo", 10), "foo")
+        self.assertFalse(self.ctx.get_page("bar", 10).need_pre_expand)
+        self.assertIsNone(self.ctx.get_page("new", 10))
+        self.assertEqual(self.ctx.saved_page_nums([10]), 5)
+
+    def test_page_pack(self):
+        self.ctx.add_page("Template:Q", 10, "Q")
+        self.ctx.add_page("Template:q", 10, "q")
+        self.ctx.add_page("Template:foo", 10, "foo" * 10000)
+        self.ctx.add_page("Template:bar", 10, redirect_to="Template:foo")
+        self.ctx.add_page("Foo", 0, "en-noun text", model="text")
+        self.ctx.set_template_pre_expand("Template:foo")
+        with tempfile.TemporaryDirectory() as temp_dir:
+            pack_path = Path(temp_dir, "pages.pack")
+            self.assertEqual(write_page_pack(self.ctx, pack_path), 8)
+            ctx = Wtp(page_store=PackPageStore(pack_path))
+            try:
+                for title, namespace_id in (
+                    ("q", 10),
+                    ("Q", 10),
+                    ("Template:foo", None),
+                    ("bar", 10),
+                    ("Foo", 0),
+                    ("foo", 0),
+                    ("Missing", 0),
+                ):
+                    self.assertEqual(
+                        ctx.get_page(title, namespace_id),
+                        self.ctx.get_page(title, namespace_id),
+                    )
+                page = ctx.get_page("Template:foo", 10)
+                self.assertIsInstance(page.__dict__["_body"], DeferredBody)
+                self.assertTrue(page.need_pre_expand)
+                self.assertEqual(page.body, "foo" * 10000)
+                self.assertEqual(ctx.get_page_body("bar", 10), page.body)
+                self.assertIsNone(ctx.get_page("bar", 10, no_redirect=True))
+                self.assertEqual(ctx.saved_page_nums(), 8)
+                self.assertEqual(ctx.saved_page_nums(model="text"), 1)
+                self.assertEqual(
+                    ctx.saved_page_nums(search_pattern="%EN-noun%"), 1
+                )
+                self.assertTrue(ctx.has_analyzed_templates())
+                self.assertFalse(ctx.page_store.has_pre_expand_pages([0]))
+                with patch.object(PackPageStore, "iter_pages") as iter_pages:
+                    for method, args in (
+                        (ctx.add_page, ("Template:new", 10, "new")),
+                        (ctx.analyze_templates, ()),
+                        (ctx.set_template_pre_expand, ("Template:Q",)),
+                    ):
+                        with self.subTest(method=method.__name__):
+                            with self.assertRaises(sqlite3.OperationalError):
+                                method(*args)
+                    # the templates aren't analyzed before raising
+                    iter_pages.assert_not_called()
+            finally:
+                ctx.close_db_conn()
+
     @patch(
         "wikitextprocessor.parserfns.get_interwiki_map",
         return_value={"s": {"url": "https://en.wikisource.org/wiki/$1"}}
@@ -0,0 +1,51 @@
+import argparse
+import time
+from pathlib import Path
+
+from wikitextprocessor.braces import remove_templates, scan_braces
+from wikitextprocessor.core import analyze_template
+
+
+def benchmark(func, text, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func(text)
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def main():
+    """
+    Time the analysis of template bodies, by default of the template files
+    in the tests folder.  nested-template.txt and navbox-template.txt are
+    the slow cases: deeply nested conditionals and a long table.
+    """
+    parser = argparse.ArgumentParser(
+        description="Time Wtp.analyze_templates() on template bodies"
+    )
+    parser.add_argument(
+        "paths",
+        nargs="*",
+        type=Path,
+        default=sorted(Path(__file__).parent.parent.glob("tests/*.txt")),
+    )
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"{'file':<24}{'bytes':>8}{'analyze':>10}{'remove':>10}{'scan':>10}")
+    for path in args.paths:
+        text = path.read_text()
+        analyze_ms = benchmark(
+            lambda text: analyze_template("Template:a", text, "en", "Template"),
+            text,
+            args.repeat,
+        )
+        remove_ms = benchmark(remove_templates, text, args.repeat)
+        scan_ms = benchmark(scan_braces, text, args.repeat)
+        print(
+            f"{path.name:<24}{len(text):>8}{analyze_ms:>9.2f}ms"
+            f"{remove_ms:>8.2f}ms{scan_ms:>8.2f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()